@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules of the project import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cli
+
+cli.main()
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+import activity_log
+import data_collection
+import snapshot
+
+DAY = activity_log.DAY_NS
+
+# Feature columns of the cube, in type-code order: the four activity table
+# types of activity_log.ACTIVITY_TYPES, then connections received
+# (connections.to_user_id), which are not part of the activity table.
+CUBE_COLUMNS = ['send_notification', 'response_likes', 'no_responses',
+                'made_connections', 'accepted_connections']
+
+N_TYPES = len(CUBE_COLUMNS)
+
+
+class ActivityCube(object):
+    '''
+    User x day x activity type count cube stored sparsely with prefix sums.
+    Only the (user, type, day) cells with activity are kept, as sorted int64
+    keys ((user position * N_TYPES + type) * n_days + day) with the running
+    total of the counts, so memory is proportional to the number of active
+    user-days. The count of a type over any range of days is the difference
+    of two running totals, found with two binary searches, and the counts of
+    thousands of windows are a single vectorized gather.
+
+    Counts are kept per day: a window (pre_churn_date, churn_date) counts the
+    activity from the start of the day of pre_churn_date up to churn_date,
+    rounded up to a whole day. For windows that start and end at midnight,
+    as built by the notebook from churn days, this matches the SQL counts of
+    feature_building.feature_maker.
+
+    Parameters
+    ----------
+    user_ids: sorted int64 array of the users in the cube
+    origin: int containing the first day of the cube in nanoseconds
+    n_days: int containing the number of days of the cube
+    keys: sorted int64 array of the non-empty cells
+    cumulative: int64 array of len(keys) + 1 running totals of the counts
+
+    Example
+    -------
+    >>> cube = activity_cube.ActivityCube.load(db, db_user)
+    >>> counts = cube.count_frame(X_train)
+    >>> sweep = cube.sweep(X_train, days=(7, 14, 28))
+    '''
+
+    def __init__(self, user_ids, origin, n_days, keys, cumulative):
+        self.user_ids = user_ids
+        self.origin = origin
+        self.n_days = n_days
+        self.keys = keys
+        self.cumulative = cumulative
+
+    @classmethod
+    def build(cls, log, accepted=None):
+        '''
+        Build a cube from an ActivityLog of the activity table and an optional
+        ActivityLog of received connections (to_user_id, created_at).
+        '''
+        logs = [(log, None)]
+        if accepted is not None:
+            logs.append((accepted, N_TYPES - 1))
+        user_ids = np.unique(np.concatenate([l.user_ids.astype(np.int64)
+                                             for l, t in logs]))
+        times = [l.times for l, t in logs if len(l.times)]
+        if not times:
+            return cls(user_ids, 0, 0, np.zeros(0, dtype=np.int64),
+                       np.zeros(1, dtype=np.int64))
+        origin = min(t.min() for t in times)
+        origin -= origin % DAY
+        n_days = int((max(t.max() for t in times) - origin) // DAY) + 1
+        keys = []
+        for l, code in logs:
+            users = np.searchsorted(user_ids, l.user_ids[l.segments()])
+            types = l.types.astype(np.int64) if code is None else code
+            keys.append((users * N_TYPES + types) * n_days
+                        + (l.times - origin) // DAY)
+        keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+        cumulative = np.zeros(len(keys) + 1, dtype=np.int64)
+        cumulative[1:] = np.cumsum(counts)
+        return cls(user_ids, int(origin), n_days, keys, cumulative)
+
+    @classmethod
+    def load(cls, db, db_user, user_ids=None, log=None):
+        '''
+        Build the cube from the activity and connections tables of the
+        database or a Snapshot.
+
+        Parameters
+        ----------
+        db: DBSession, Snapshot or string containing name of local postgreSQL
+        data base
+        db_user: string containing the user name for login to database
+        user_ids: optional list of user_ids to restrict the cube to
+        log: optional ActivityLog of the activity table already loaded for
+        the same users
+
+        Returns
+        -------
+        ActivityCube
+        '''
+        if log is None:
+            log = activity_log.ActivityLog.load(db, db_user, 'activity', user_ids)
+        if isinstance(db, snapshot.Snapshot):
+            connections = db.read('connections', ['to_user_id', 'created_at'])
+            connections.columns = ['user_id', 'date']
+        else:
+            sql = '''SELECT to_user_id, created_at
+            FROM connections
+            WHERE to_user_id > 0
+            '''
+            connections = data_collection.collect_chunks(
+                data_collection.stream_df(db, db_user, sql, ['user_id', 'date']),
+                ['user_id', 'date'])
+        if user_ids is not None:
+            connections = connections[connections.user_id.isin(user_ids)]
+        accepted = activity_log.ActivityLog.from_frame(connections)
+        return cls.build(log, accepted)
+
+    @property
+    def nbytes(self):
+        '''Memory held by the cube's arrays in bytes.'''
+        return self.user_ids.nbytes + self.keys.nbytes + self.cumulative.nbytes
+
+    def _days(self, dates, ceil):
+        offset = activity_log._as_ns(dates) - self.origin
+        days = -(-offset // DAY) if ceil else offset // DAY
+        return np.clip(days, 0, self.n_days)
+
+    def window_counts(self, user_ids, lo, hi):
+        '''
+        Count each activity type of many users over many windows.
+
+        Parameters
+        ----------
+        user_ids: array of user_ids, one per window
+        lo: array of window starts (pre_churn_date)
+        hi: array of window ends (churn_date)
+
+        Returns
+        -------
+        int64 array with one row per window and one column per CUBE_COLUMNS
+        '''
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        pos = np.searchsorted(self.user_ids, user_ids)
+        known = pos < len(self.user_ids)
+        known[known] = self.user_ids[pos[known]] == user_ids[known]
+        first = self._days(lo, False)[:, None]
+        last = self._days(hi, True)[:, None]
+        base = (pos[:, None] * N_TYPES + np.arange(N_TYPES)) * self.n_days
+        start = np.searchsorted(self.keys, base + first)
+        end = np.searchsorted(self.keys, base + np.maximum(last, first))
+        counts = self.cumulative[end] - self.cumulative[start]
+        counts[~known] = 0
+        return counts
+
+    def count_frame(self, user_df):
+        '''
+        Window counts of a DataFrame of windows, with the count columns of
+        feature_building.feature_df_maker.
+
+        Parameters
+        ----------
+        user_df: dataframe containing user_id, pre_churn_date and churn_date
+
+        Returns
+        -------
+        pandas DataFrame with user_id and the CUBE_COLUMNS, in the order of
+        user_df
+        '''
+        counts = self.window_counts(user_df.user_id.values,
+                                    user_df.pre_churn_date.values,
+                                    user_df.churn_date.values)
+        frame = pd.DataFrame(counts, columns=CUBE_COLUMNS)
+        frame.insert(0, 'user_id', user_df.user_id.values)
+        return frame
+
+    def sweep(self, user_df, days=(7, 14, 28)):
+        '''
+        Window counts for several lengths of the pre churn window, ending at
+        each churn_date.
+
+        Parameters
+        ----------
+        user_df: dataframe containing user_id and churn_date
+        days: list of window lengths in days (pre_curn_monitoring_days)
+
+        Returns
+        -------
+        pandas DataFrame with a pre_churn_days column and the columns of
+        count_frame, one block of rows per window length
+        '''
+        frames = []
+        churn = pd.to_datetime(user_df.churn_date).values
+        for length in days:
+            windows = pd.DataFrame({'user_id': user_df.user_id.values,
+                                    'pre_churn_date': churn - np.timedelta64(length, 'D'),
+                                    'churn_date': churn})
+            frame = self.count_frame(windows)
+            frame.insert(0, 'pre_churn_days', length)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    def save(self, path):
+        '''Write the cube to a .npz file.'''
+        np.savez(path, user_ids=self.user_ids, keys=self.keys,
+                 cumulative=self.cumulative,
+                 shape=np.array([self.origin, self.n_days], dtype=np.int64))
+
+    @classmethod
+    def read(cls, path):
+        '''Read a cube written by save.'''
+        data = np.load(path)
+        origin, n_days = data['shape']
+        return cls(data['user_ids'], int(origin), int(n_days), data['keys'],
+                   data['cumulative'])
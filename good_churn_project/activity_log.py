@@ -0,0 +1,299 @@
+import numpy as np
+import pandas as pd
+import db_session
+import snapshot
+
+# Activity type codes stored in ActivityLog.types, in the order the sources
+# are merged into the activity table.
+ACTIVITY_TYPES = ['notifications', 'answer_likes', 'answers', 'connections']
+
+DAY_NS = 24 * 60 * 60 * 10**9
+
+
+class ActivityLog(object):
+    '''
+    Compact in-memory representation of the activity table. Activities are
+    grouped by user in CSR layout: the activities of the user at position i
+    of user_ids are times[offsets[i]:offsets[i + 1]], sorted by time.
+
+    Parameters
+    ----------
+    user_ids: int32 array of the sorted, unique user_ids
+    offsets: int64 array of len(user_ids) + 1 positions into times
+    times: int64 array of activity times in nanoseconds since the epoch
+    types: uint8 array of activity type codes (see ACTIVITY_TYPES)
+
+    Example
+    -------
+    >>> log = activity_log.ActivityLog.load(db, db_user)
+    >>> times, types = log.user(2848)
+    '''
+
+    def __init__(self, user_ids, offsets, times, types):
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.times = times
+        self.types = types
+        self._by_type = {}
+
+    @classmethod
+    def from_frame(cls, activity):
+        '''
+        Build a log from a DataFrame with user_id and date columns and an
+        optional type column holding activity table type names.
+        '''
+        activity = activity[activity.user_id > 0]
+        users = activity.user_id.values.astype(np.int32)
+        times = pd.to_datetime(activity.date).values.astype('datetime64[ns]').astype(np.int64)
+        if 'type' in activity:
+            codes = pd.Categorical(activity.type, categories=ACTIVITY_TYPES).codes
+            types = codes.astype(np.uint8)
+        else:
+            types = np.zeros(len(users), dtype=np.uint8)
+        order = np.lexsort((times, users))
+        users = users[order]
+        user_ids, counts = np.unique(users, return_counts=True)
+        offsets = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return cls(user_ids.astype(np.int32), offsets, times[order],
+                   types[order])
+
+    @classmethod
+    def load(cls, db, db_user, table='activity', user_ids=None):
+        '''
+        Load the activity table from the database or a Snapshot.
+
+        Parameters
+        ----------
+        db: DBSession, Snapshot or string containing name of local postgreSQL
+        data base
+        db_user: string containing the user name for login to database
+        table: string containing the database table to querry
+        user_ids: optional list of user_ids to restrict the log to
+
+        Returns
+        -------
+        ActivityLog
+        '''
+        if isinstance(db, snapshot.Snapshot):
+            activity = db.read(table, ['user_id', 'date', 'type'], user_ids)
+            return cls.from_frame(activity)
+        session = db_session.get_session(db, db_user)
+        sql = '''
+        SELECT user_id, date, type
+        FROM {}
+        WHERE user_id > 0
+        '''.format(table)
+        params = None
+        if user_ids is not None:
+            sql += 'AND user_id = ANY(%s)'
+            params = ([int(u) for u in user_ids],)
+        activity = pd.DataFrame(session.query(sql, params),
+                                columns=['user_id', 'date', 'type'])
+        return cls.from_frame(activity)
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def nbytes(self):
+        '''Memory held by the log's arrays in bytes.'''
+        return (self.user_ids.nbytes + self.offsets.nbytes + self.times.nbytes
+                + self.types.nbytes)
+
+    def positions(self, user_ids):
+        '''Position of each user_id in the log, -1 for users without activity.'''
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        pos = np.searchsorted(self.user_ids, user_ids)
+        pos = np.minimum(pos, max(len(self.user_ids) - 1, 0))
+        found = len(self.user_ids) > 0
+        if found:
+            found = self.user_ids[pos] == user_ids
+        return np.where(found, pos, -1)
+
+    def user(self, user_id):
+        '''
+        Zero-copy views of one user's activity times and type codes.
+        '''
+        pos = self.positions([user_id])[0]
+        if pos < 0:
+            return self.times[:0], self.types[:0]
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        return self.times[start:end], self.types[start:end]
+
+    def segments(self):
+        '''Position of the user of every activity.'''
+        return np.repeat(np.arange(len(self.user_ids)), np.diff(self.offsets))
+
+    def by_type(self, activity_type):
+        '''
+        Log restricted to one activity type, e.g. 'answers'. Cached.
+        '''
+        if activity_type not in self._by_type:
+            keep = self.types == ACTIVITY_TYPES.index(activity_type)
+            counts = np.bincount(self.segments()[keep],
+                                 minlength=len(self.user_ids))
+            offsets = np.zeros(len(self.user_ids) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(counts)
+            self._by_type[activity_type] = ActivityLog(self.user_ids, offsets,
+                                                       self.times[keep],
+                                                       self.types[keep])
+        return self._by_type[activity_type]
+
+    def search(self, user_ids, q_times, side='left'):
+        '''
+        Vectorized binary search of query times inside each user's history.
+
+        Parameters
+        ----------
+        user_ids: array of user_ids, one per query
+        q_times: int64 array of query times in nanoseconds
+        side: 'left' counts activities strictly before the query time,
+        'right' also counts activities at the query time.
+
+        Returns
+        -------
+        int64 array holding, per query, the number of the user's activities
+        before the query time
+        '''
+        pos = self.positions(user_ids)
+        missing = pos < 0
+        pos = np.where(missing, 0, pos)
+        start = self.offsets[pos]
+        low = start.copy()
+        high = np.where(missing, start, self.offsets[pos + 1])
+        q_times = np.asarray(q_times, dtype=np.int64)
+        while True:
+            active = low < high
+            if not active.any():
+                break
+            mid = (low + high) // 2
+            value = self.times[np.where(active, mid, 0)]
+            if side == 'left':
+                go_right = active & (value < q_times)
+            else:
+                go_right = active & (value <= q_times)
+            low = np.where(go_right, mid + 1, low)
+            high = np.where(active & ~go_right, mid, high)
+        return low - start
+
+    def window_counts(self, user_ids, lo, hi, activity_type=None):
+        '''
+        Count each user's activities strictly between lo and hi.
+
+        Parameters
+        ----------
+        user_ids: array of user_ids, one per window
+        lo: array of window starts (datetimes or int64 nanoseconds)
+        hi: array of window ends (datetimes or int64 nanoseconds)
+        activity_type: optional activity type name to count
+
+        Returns
+        -------
+        int64 array of counts
+        '''
+        log = self if activity_type is None else self.by_type(activity_type)
+        lo = _as_ns(lo)
+        hi = _as_ns(hi)
+        return log.search(user_ids, hi, 'left') - log.search(user_ids, lo, 'right')
+
+    def gap_stats(self, legacy=True):
+        '''
+        Compute the user_stats columns for every user in the log, with the
+        same values as data_collection.user_stats_df.
+
+        Parameters
+        ----------
+        legacy: bool, if True return the object columns of user_stats_df,
+        where every time of a user with one activity is Timedelta(0);
+        otherwise datetime64/timedelta64 columns in the layout of the
+        user_stats table, where such users have no first_use or last_use
+
+        Returns
+        -------
+        DataFrame containing the activity statistics, ordered by user_id.
+        '''
+        n_users = len(self.user_ids)
+        counts = np.diff(self.offsets)
+        first = self.times[self.offsets[:-1]]
+        last = self.times[self.offsets[1:] - 1]
+        seg = self.segments()
+        same = seg[1:] == seg[:-1]
+        gaps = (self.times[1:] - self.times[:-1])[same]
+        gap_seg = seg[1:][same]
+        n_gaps = counts - 1
+        gap_offsets = np.zeros(n_users + 1, dtype=np.int64)
+        gap_offsets[1:] = np.cumsum(n_gaps)
+
+        has_gaps = n_gaps > 0
+        starts = gap_offsets[:-1][has_gaps]
+        gap_min = np.zeros(n_users, dtype=np.int64)
+        gap_max = np.zeros(n_users, dtype=np.int64)
+        gap_sum = np.zeros(n_users, dtype=np.int64)
+        median = np.zeros(n_users, dtype=np.float64)
+        if len(gaps):
+            gap_min[has_gaps] = np.minimum.reduceat(gaps, starts)
+            gap_max[has_gaps] = np.maximum.reduceat(gaps, starts)
+            gap_sum[has_gaps] = np.add.reduceat(gaps, starts)
+            ordered = gaps[np.lexsort((gaps, gap_seg))]
+            m = n_gaps[has_gaps]
+            median[has_gaps] = (ordered[starts + (m - 1) // 2].astype(np.float64)
+                                + ordered[starts + m // 2]) / 2
+
+        single = counts == 1
+        nat = np.datetime64('NaT', 'ns')
+        stats = pd.DataFrame({
+            'app_user': self.user_ids.astype(np.int64),
+            'first_use': np.where(single, nat, first.view('datetime64[ns]')),
+            'last_use': np.where(single, nat, last.view('datetime64[ns]')),
+            'time_with_app': (last - first).view('timedelta64[ns]'),
+            'num_uses': counts.astype(np.int64),
+            'min_away': gap_min.view('timedelta64[ns]'),
+            'max_away': gap_max.view('timedelta64[ns]'),
+            'avg_away': _timedelta_div(gap_sum, np.maximum(n_gaps, 1)).view('timedelta64[ns]'),
+            'median_away': pd.to_timedelta(median).values},
+            columns=['app_user', 'first_use', 'last_use', 'time_with_app',
+                     'num_uses', 'min_away', 'max_away', 'avg_away',
+                     'median_away'])
+        if not legacy:
+            return stats
+        stats = stats.astype(object)
+        # Addresses users that only have one activity.
+        for column in ['first_use', 'last_use']:
+            stats.loc[single, column] = pd.tslib.Timedelta(0)
+        return stats
+
+
+def _timedelta_div(total, count):
+    # total / count in nanoseconds as pd.Timedelta(total) / count computes
+    # it: the quotient rounded to the nearest double, then truncated
+    total = np.asarray(total, dtype=np.int64)
+    count = np.asarray(count, dtype=np.int64)
+    q, r = np.divmod(total, count)
+    result = q.copy()
+    pos = q > 0
+    exp = np.zeros(len(q), dtype=np.int64)
+    exp[pos] = np.floor(np.log2(q[pos].astype(np.float64))).astype(np.int64)
+    exp[pos & ((np.int64(1) << exp) > q)] -= 1
+    exp[pos & ((np.int64(1) << (exp + 1)) <= q)] += 1
+    # below 2**52 doubles are finer than 1ns: round up to q + 1 when the
+    # remainder is within half a double spacing of count
+    small = pos & (exp < 52)
+    shift = 53 - exp[small]
+    result[small] += (count[small] - r[small]) <= (count[small] >> shift)
+    # from 2**52 on doubles are integers 2**k apart: round half to even
+    big = pos & (exp >= 52)
+    k = exp[big] - 52
+    step = count[big] << k
+    m, rem = np.divmod(total[big], step)
+    up = (2 * rem > step) | ((2 * rem == step) & (m % 2 == 1))
+    result[big] = (m + up) << k
+    return result
+
+
+def _as_ns(values):
+    # Convert datetimes (or int64 nanoseconds) to an int64 array.
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64)
+    return pd.to_datetime(pd.Series(values)).values.astype('datetime64[ns]').astype(np.int64)
@@ -1,10 +1,10 @@
 import numpy as np
-from sklearn.metrics import confusion_matrix
-import matplotlib.pyplot as plt
 
 
 def plot_confusion_matrix(model, X_test, y_true):
     '''Code stolen from sklearn example.'''
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import confusion_matrix
     cm = confusion_matrix(y_true, model.predict(X_test))
 
     print(cm)
@@ -22,6 +22,7 @@ def plot_importance(clf, X, max_features=10):
     Plot feature importance
     code from lecture
     '''
+    import matplotlib.pyplot as plt
     feature_importance = clf.feature_importances_
     # make importances relative to max importance
     feature_importance = 100.0 * (feature_importance / feature_importance.max())
@@ -40,27 +41,164 @@ def plot_importance(clf, X, max_features=10):
 
 def ROC_values(score, y):
     '''
-    code adopted from stackoverflow
+    False and true positive rates at 30 thresholds linearly spaced between
+    the lowest and the highest score. Scores are sorted once and the counts
+    above each threshold are read from cumulative sums.
+
+    Parameters
+    ----------
+    score: array of predicted probabilities
+    y: array of true labels (1 for good churn)
+
+    Returns
+    -------
+    roc_x: list of false positive rates
+    roc_y: list of true positive rates
     '''
-    roc_x = []
-    roc_y = []
-    min_score = min(score)
-    max_score = max(score)
-    thr = np.linspace(min_score, max_score, 30)
-    FP=0
-    TP=0
-    N = sum(y)
-    P = len(y) - N
-
-    for (i, T) in enumerate(thr):
-        for i in range(0, len(score)):
-            if (score[i] > T):
-                if (y[i]==1):
-                    TP = TP + 1
-                if (y[i]==0):
-                    FP = FP + 1
-        roc_x.append(FP/float(N))
-        roc_y.append(TP/float(P))
-        FP=0
-        TP=0
+    score = np.asarray(score, dtype=float)
+    y = np.asarray(y)
+    thr = np.linspace(score.min(), score.max(), 30)
+    order = np.argsort(score, kind='mergesort')
+    # positives among the k lowest scores, for k = 0 .. n
+    positives_below = np.concatenate([[0], np.cumsum(y[order] == 1)])
+    below = np.searchsorted(score[order], thr, side='right')
+    P = positives_below[-1]
+    N = len(y) - P
+    TP = P - positives_below[below]
+    FP = (len(y) - below) - TP
+    roc_x = list(FP/float(N))
+    roc_y = list(TP/float(P))
     return roc_x, roc_y
+
+def _tie_groups(score):
+    '''
+    Sort scores once in decreasing order and return the order, the start of
+    each run of tied scores and the score of each run.
+    '''
+    order = np.argsort(-score, kind='mergesort')
+    sorted_score = score[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_score)) + 1])
+    return order, starts, sorted_score[starts]
+
+def _weighted_roc(weights, positive, order, starts):
+    '''
+    Cumulative true and false positive weights at every distinct threshold,
+    one row per row of weights.
+    '''
+    weights = weights[:, order]
+    tp = np.add.reduceat(weights * positive[order], starts, axis=1)
+    fp = np.add.reduceat(weights * ~positive[order], starts, axis=1)
+    return np.cumsum(tp, axis=1), np.cumsum(fp, axis=1)
+
+def _auc(tps, fps):
+    # trapezoidal area, ties contribute half a pair each
+    tps = np.concatenate([np.zeros((len(tps), 1)), tps], axis=1)
+    fps = np.concatenate([np.zeros((len(fps), 1)), fps], axis=1)
+    area = (np.diff(fps, axis=1) * (tps[:, 1:] + tps[:, :-1])).sum(axis=1) / 2.0
+    return area / (tps[:, -1] * fps[:, -1])
+
+def roc_curve(score, y):
+    '''
+    Exact ROC curve with one point per distinct score.
+
+    Parameters
+    ----------
+    score: array of predicted probabilities
+    y: array of true labels (1 for good churn)
+
+    Returns
+    -------
+    fpr: array of false positive rates
+    tpr: array of true positive rates
+    thresholds: array of the scores at which a user is called positive
+    (score >= threshold)
+
+    Example
+    -------
+    >>> fpr, tpr, thresholds = analysis.roc_curve(rfc.predict_proba(X_test)[:, 1],
+    ...                                           y_test)
+    '''
+    score = np.asarray(score, dtype=float)
+    positive = np.asarray(y) == 1
+    order, starts, thresholds = _tie_groups(score)
+    tps, fps = _weighted_roc(np.ones((1, len(score))), positive, order, starts)
+    tpr = np.concatenate([[0], tps[0] / tps[0, -1]])
+    fpr = np.concatenate([[0], fps[0] / fps[0, -1]])
+    return fpr, tpr, np.concatenate([[np.inf], thresholds])
+
+def roc_auc(score, y):
+    '''
+    Exact area under the ROC curve.
+
+    Parameters
+    ----------
+    score: array of predicted probabilities
+    y: array of true labels (1 for good churn)
+
+    Returns
+    -------
+    float
+    '''
+    score = np.asarray(score, dtype=float)
+    positive = np.asarray(y) == 1
+    order, starts, thresholds = _tie_groups(score)
+    tps, fps = _weighted_roc(np.ones((1, len(score))), positive, order, starts)
+    return float(_auc(tps, fps)[0])
+
+def bootstrap_roc(score, y, threshold=0.22, n_boot=2000, alpha=0.05,
+                  chunk_size=250, random_state=None):
+    '''
+    Bootstrap confidence intervals of the AUC and of the true and false
+    positive rates at an operating threshold. Each resample is a row of
+    multinomial weights over the users, so a chunk of resamples is evaluated
+    at once with matrix operations on the scores sorted once.
+
+    Parameters
+    ----------
+    score: array of predicted probabilities
+    y: array of true labels (1 for good churn)
+    threshold: float probability above which a user is called good churn
+    n_boot: int containing the number of resamples
+    alpha: float; the intervals cover 1 - alpha
+    chunk_size: int containing the number of resamples evaluated at once
+    random_state: int seeding the resamples
+
+    Returns
+    -------
+    dict mapping 'auc', 'tpr' and 'fpr' to (estimate, low, high)
+
+    Example
+    -------
+    >>> analysis.bootstrap_roc(rfc.predict_proba(X_test)[:, 1], y_test)
+    {'auc': (0.81, 0.78, 0.84), 'tpr': (0.8, 0.75, 0.85), 'fpr': ...}
+    '''
+    score = np.asarray(score, dtype=float)
+    positive = np.asarray(y) == 1
+    n = len(score)
+    order, starts, thresholds = _tie_groups(score)
+    # number of distinct scores above the operating threshold
+    above = np.searchsorted(-thresholds, -threshold, side='left')
+    rng = np.random.RandomState(random_state)
+    results = {'auc': [], 'tpr': [], 'fpr': []}
+    for start in range(0, n_boot, chunk_size):
+        size = min(chunk_size, n_boot - start)
+        weights = rng.multinomial(n, np.full(n, 1.0 / n), size=size).astype(float)
+        tps, fps = _weighted_roc(weights, positive, order, starts)
+        tp_above = tps[:, above - 1] if above else np.zeros(size)
+        fp_above = fps[:, above - 1] if above else np.zeros(size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['auc'].append(_auc(tps, fps))
+            results['tpr'].append(tp_above / tps[:, -1])
+            results['fpr'].append(fp_above / fps[:, -1])
+
+    tps, fps = _weighted_roc(np.ones((1, n)), positive, order, starts)
+    estimates = {'auc': _auc(tps, fps)[0],
+                 'tpr': tps[0, above - 1] / tps[0, -1] if above else 0.0,
+                 'fpr': fps[0, above - 1] / fps[0, -1] if above else 0.0}
+    intervals = {}
+    for name, values in results.items():
+        # resamples without both classes give nan and are left out
+        low, high = np.nanpercentile(np.concatenate(values),
+                                     [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        intervals[name] = (float(estimates[name]), float(low), float(high))
+    return intervals
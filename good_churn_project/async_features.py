@@ -0,0 +1,170 @@
+import asyncio
+import pandas as pd
+import data_collection
+import feature_building
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# Per-user version of text_processing.RESPONSE_TEXT_QUERY.
+RESPONSE_TEXT_QUERY = '''SELECT string_agg(body,' ') AS response_text,
+    count(user_id) AS response_count
+    FROM answers
+    WHERE user_id = $1
+    AND created_at > $2
+    AND created_at < $3'''
+
+
+async def create_pool(db, db_user, concurrency=8, host='localhost'):
+    '''
+    Open an asyncpg connection pool sized for a concurrency limit.
+
+    Parameters
+    ----------
+    db: string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    concurrency: int containing the most queries run at the same time
+
+    Returns
+    -------
+    asyncpg Pool
+    '''
+    if asyncpg is None:
+        raise ImportError('async feature extraction requires asyncpg')
+    return await asyncpg.create_pool(database=db, user=db_user, host=host,
+                                     min_size=1, max_size=concurrency)
+
+
+async def _fetch(pool, semaphore, sql, *params):
+    async with semaphore:
+        return await pool.fetchrow(sql, *params)
+
+
+async def feature_row(pool, semaphore, user_id, date1, date2,
+                      as_of=data_collection.AS_OF):
+    '''
+    Async version of feature_building.feature_maker. The five window counts,
+    the user_stats lookup and the birthdate lookup are issued concurrently.
+
+    Parameters
+    ----------
+    pool: asyncpg Pool from create_pool
+    semaphore: asyncio.Semaphore bounding the concurrent queries
+    user_id: int containing user id
+    date1: earliest day of the time window
+    date2: last day of the time window
+    as_of: day the age of the user is computed at
+
+    Returns
+    -------
+    list containing the features, as returned by feature_maker
+    '''
+    window = (int(user_id), _timestamp(date1), _timestamp(date2))
+    queries = [_fetch(pool, semaphore, sql, *window)
+               for name, sql in feature_building.FEATURE_COUNT_QUERIES]
+    queries.append(_fetch(pool, semaphore, feature_building.USER_STATS_QUERY,
+                          int(user_id)))
+    queries.append(_fetch(pool, semaphore, feature_building.BIRTHDATE_QUERY,
+                          int(user_id)))
+    rows = await asyncio.gather(*queries)
+    counts = [int(row[0]) for row in rows[:5]]
+    user_stats = rows[5]
+    age = (pd.tslib.Timestamp(as_of)-pd.tslib.Timestamp(rows[6][0]))
+    age = age.days/365.0
+    return [user_id] + counts + [int(user_stats[0]), int(user_stats[1]), age]
+
+
+async def response_row(pool, semaphore, user_id, date1, date2):
+    '''
+    Async version of the text_processing.fetch_response_text row for one
+    user window.
+
+    Returns
+    -------
+    list containing user_id, response_text, response_count and response_len
+    '''
+    row = await _fetch(pool, semaphore, RESPONSE_TEXT_QUERY, int(user_id),
+                       _timestamp(date1), _timestamp(date2))
+    if row['response_text'] is None:
+        return [user_id, '0', 0, 0]
+    return [user_id, row['response_text'], int(row['response_count']),
+            len(row['response_text'])]
+
+
+async def user_features(pool, user_df, concurrency=8,
+                        as_of=data_collection.AS_OF):
+    '''
+    Build the numeric and text feature rows of a small batch of users, with
+    every query of every user in flight at once up to the concurrency limit.
+
+    Parameters
+    ----------
+    pool: asyncpg Pool from create_pool
+    user_df: dataframe containing user_id, earliest day of the time window
+    (pre_churn_date) and the last day of the time window (churn_date)
+    concurrency: int containing the most queries run at the same time
+    as_of: day the age of the users is computed at
+
+    Returns
+    -------
+    feature_df: pandas DataFrame with the columns of feature_df_maker
+    response_df: pandas DataFrame with the columns of fetch_response_text
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    windows = list(zip(user_df.user_id, user_df.pre_churn_date,
+                       user_df.churn_date))
+    features = asyncio.gather(*[feature_row(pool, semaphore, *w, as_of=as_of)
+                                for w in windows])
+    responses = asyncio.gather(*[response_row(pool, semaphore, *w) for w in windows])
+    features, responses = await asyncio.gather(features, responses)
+    feature_df = pd.DataFrame(features, columns=['user_id', 'response_likes',
+                                                 'no_responses',
+                                                 'accepted_connections',
+                                                 'made_connections',
+                                                 'send_notification',
+                                                 'median_away', 'avg_away',
+                                                 'age'])
+    response_df = pd.DataFrame(responses, columns=['user_id', 'response_text',
+                                                   'response_count',
+                                                   'response_len'])
+    return feature_df, response_df
+
+
+def async_feature_df(db, db_user, user_df, concurrency=8,
+                     as_of=data_collection.AS_OF):
+    '''
+    Blocking entry point for low-latency scoring of a small batch of users:
+    opens a pool, runs user_features and closes the pool.
+
+    Parameters
+    ----------
+    db: string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    user_df: dataframe containing user_id, pre_churn_date and churn_date
+    concurrency: int containing the most queries run at the same time
+    as_of: day the age of the users is computed at
+
+    Returns
+    -------
+    feature_df: pandas DataFrame
+    response_df: pandas DataFrame
+
+    Example
+    -------
+    >>> feature_df, response_df = async_features.async_feature_df(db, db_user,
+    ...                                                           users_df)
+    '''
+    async def run():
+        pool = await create_pool(db, db_user, concurrency)
+        try:
+            return await user_features(pool, user_df, concurrency, as_of)
+        finally:
+            await pool.close()
+    return asyncio.run(run())
+
+
+def _timestamp(value):
+    # asyncpg binds timestamps as datetime objects, not strings
+    return pd.tslib.Timestamp(value).to_pydatetime()
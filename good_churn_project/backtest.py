@@ -0,0 +1,351 @@
+import time
+import numpy as np
+import pandas as pd
+import activity_cube
+import activity_log
+import data_collection
+import db_session
+import define_classes
+import feature_store
+import snapshot
+import text_processing
+
+DAY = activity_log.DAY_NS
+
+BACKTEST_COLUMNS = ['user_id', 'response_likes', 'no_responses',
+                    'accepted_connections', 'made_connections',
+                    'send_notification', 'median_away', 'avg_away', 'age']
+
+
+def weekly_cutoffs(start, end, weeks=1):
+    '''
+    Cutoff days every weeks weeks from start to end.
+
+    Example
+    -------
+    >>> cutoffs = backtest.weekly_cutoffs('2015-04-01', '2016-04-01')
+    '''
+    return list(pd.date_range(pd.tslib.Timestamp(start).normalize(),
+                              pd.tslib.Timestamp(end),
+                              freq='{}D'.format(7 * weeks)))
+
+
+def last_activity(log, cutoff):
+    '''
+    Activity count and last activity time (nanoseconds) of every user of the
+    log before cutoff; users without activity get a count of 0.
+    '''
+    counts = log.search(log.user_ids, np.full(len(log.user_ids),
+                                              pd.tslib.Timestamp(cutoff).value))
+    last = log.times[log.offsets[:-1] + np.maximum(counts, 1) - 1]
+    return counts, last
+
+
+def _day_after(times):
+    # whole-day window end: midnight after each time (nanoseconds)
+    times = activity_log._as_ns(times)
+    return times - times % DAY + DAY
+
+
+def away_stats(log, user_ids, until):
+    '''
+    median_away and avg_away (nanoseconds) of each user computed from the
+    activity before until, as data_collection.user_stats_df would have
+    computed them on that day.
+
+    Parameters
+    ----------
+    log: ActivityLog
+    user_ids: array of user_ids
+    until: array of datetimes, one per user
+
+    Returns
+    -------
+    median_away, avg_away: int64 arrays
+    '''
+    until = activity_log._as_ns(until)
+    pos = log.positions(user_ids)
+    counts = log.search(user_ids, until)
+    median = np.zeros(len(pos), dtype=np.int64)
+    # the average gap is the time between the first and last activity
+    # divided by the number of gaps
+    has_gaps = (pos >= 0) & (counts > 1)
+    start = log.offsets[pos[has_gaps]]
+    end = start + counts[has_gaps]
+    average = np.zeros(len(pos), dtype=np.int64)
+    average[has_gaps] = (log.times[end - 1] - log.times[start]) // (counts[has_gaps] - 1)
+    for i, s, e in zip(np.flatnonzero(has_gaps), start, end):
+        median[i] = int(np.median(np.diff(log.times[s:e])))
+    return median, average
+
+
+class Backtest(object):
+    '''
+    Rolling backtest of the good churn model over a sequence of cutoff days.
+    At each cutoff the churn labels are computed from the activity up to
+    that day, the notebook's model (features of the 14 days before churn,
+    TF-IDF/SVD text features and a random forest) is trained on them and the
+    test users of the day (define_classes.idendify_test_users) are scored.
+    Their outcome is read from the later activity: a test user is good
+    churn if they come back within time_gone days of their last activity
+    and have more than postchurn_act activities in the postchurn_time days
+    after their return. Cutoffs too close to the end of the data to observe
+    the outcome get no AUC.
+
+    The activity is loaded once into an ActivityLog and an ActivityCube,
+    and state is carried from one cutoff to the next: good churn is only
+    relabeled for users with recent activity, and the
+    features of a window are computed once and reused by every later
+    cutoff. Features are point-in-time: counts, away statistics and age are
+    those of the window's churn_date, so a window's features do not change
+    with the cutoff. Windows are whole days (churn_date is the day after the
+    last activity for bad churn and test users).
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    leave_time, prechurn_time, prechurn_act, postchurn_time, postchurn_act:
+    good churn parameters, as in define_classes.label_good_churn
+    time_gone: int containing the days without activity of bad churn
+    time_gone_low, time_gone_high: ints containing the test user window
+    pre_churn_days: int containing the days of the feature window
+    no_SVs: int containing the number of singular values of the text model
+    classifier: function returning an unfitted classifier, a balanced
+    random forest of 100 trees by default
+    random_state: int seeding the text model and the default classifier
+
+    Example
+    -------
+    >>> bt = backtest.Backtest(db, db_user)
+    >>> results = bt.run(backtest.weekly_cutoffs('2015-04-01', '2016-04-01'))
+    '''
+
+    def __init__(self, db, db_user, leave_time=28, prechurn_time=14,
+                 prechurn_act=5, postchurn_time=14, postchurn_act=5,
+                 time_gone=200, time_gone_low=28, time_gone_high=60,
+                 pre_churn_days=14, no_SVs=15, classifier=None,
+                 random_state=67):
+        self.db = db
+        self.db_user = db_user
+        self.labels = (leave_time, prechurn_time, prechurn_act,
+                       postchurn_time, postchurn_act)
+        self.prechurn_act = prechurn_act
+        self.postchurn_time = postchurn_time
+        self.postchurn_act = postchurn_act
+        self.time_gone = time_gone
+        self.time_gone_low = time_gone_low
+        self.time_gone_high = time_gone_high
+        self.pre_churn_days = pre_churn_days
+        self.no_SVs = no_SVs
+        self.random_state = random_state
+        self.classifier = classifier or self._random_forest
+        self.log = activity_log.ActivityLog.load(db, db_user)
+        self.cube = activity_cube.ActivityCube.load(db, db_user, log=self.log)
+        self.birthdates = self._birthdates()
+        self.watermark = data_collection.activity_watermark(db, db_user)
+        self.store = feature_store.FeatureStore()
+        self.reset()
+
+    def _random_forest(self):
+        from sklearn.ensemble import RandomForestClassifier
+        return RandomForestClassifier(n_estimators=100, n_jobs=-1,
+                                      class_weight='balanced',
+                                      random_state=self.random_state)
+
+    def _birthdates(self):
+        if isinstance(self.db, snapshot.Snapshot):
+            users = self.db.read('users', ['id', 'birthdate'])
+        else:
+            session = db_session.get_session(self.db, self.db_user)
+            users = pd.DataFrame(session.query('SELECT id, birthdate FROM users'),
+                                 columns=['id', 'birthdate'])
+        users = users.drop_duplicates('id')
+        return pd.to_datetime(users.set_index('id').birthdate)
+
+    def reset(self):
+        '''Forget the labels carried between cutoffs.'''
+        self.cutoff = None
+        self.good = None
+        self.relabeled = 0
+        self.new_windows = 0
+
+    def good_churn(self, as_of):
+        '''
+        Good churn events known at the end of the day as_of. After a first
+        cutoff, only the users with activity in the postchurn_time days
+        before the previous cutoff or since are relabeled.
+
+        Returns
+        -------
+        pandas DataFrame, as define_classes.label_good_churn
+        '''
+        cutoff = data_collection.activity_cutoff(as_of)
+        if self.cutoff is None or cutoff < self.cutoff:
+            users = self.log.user_ids
+            previous = None
+        else:
+            # an event becomes known when its postchurn window ends, so it
+            # returns within postchurn_time days before the cutoff
+            since = self.cutoff - pd.tslib.Timedelta(days=self.postchurn_time + 1)
+            n = len(self.log.user_ids)
+            active = self.log.window_counts(self.log.user_ids,
+                                            np.full(n, since.value),
+                                            np.full(n, cutoff.value)) > 0
+            users = self.log.user_ids[active]
+            previous = self.good[~self.good.user_id.isin(users)]
+        good = define_classes.label_good_churn(self.log, users, *self.labels,
+                                               as_of=as_of)
+        self.relabeled = len(users)
+        if previous is not None:
+            good = pd.concat([previous, good], ignore_index=True)
+        self.cutoff, self.good = cutoff, good
+        return good
+
+    def features(self, windows):
+        '''
+        Point-in-time features of user windows, cached across cutoffs.
+
+        Parameters
+        ----------
+        windows: dataframe containing user_id, pre_churn_date and churn_date
+
+        Returns
+        -------
+        pandas DataFrame with the columns of feature_building.feature_df_maker
+        plus response_text and response_len, in the order of windows
+        '''
+        def compute(df):
+            self.new_windows += len(df)
+            counts = self.cube.count_frame(df)
+            median, average = away_stats(self.log, df.user_id.values,
+                                         df.churn_date.values)
+            counts['median_away'] = median
+            counts['avg_away'] = average
+            birthdate = self.birthdates.reindex(df.user_id.values).values
+            age = pd.to_datetime(df.churn_date).values - birthdate
+            counts['age'] = pd.to_timedelta(age).days / 365.0
+            return counts
+        features = self.store.cached_frame('backtest', windows, compute,
+                                           self.watermark, BACKTEST_COLUMNS)
+        response_df = text_processing.fetch_response_text(self.db, self.db_user,
+                                                          windows, store=self.store)
+        features['response_text'] = response_df.response_text.values
+        features['response_len'] = response_df.response_len.values
+        return features
+
+    def _windows(self, user_ids, churn_date):
+        windows = pd.DataFrame({'user_id': np.asarray(user_ids, dtype=np.int64),
+                                'churn_date': pd.to_datetime(churn_date).values})
+        windows['pre_churn_date'] = (windows.churn_date
+                                     - pd.tslib.Timedelta(days=self.pre_churn_days))
+        return windows
+
+    def _matrix(self, features, vectorizer, svd, fit=False):
+        texts = features.response_text
+        if fit:
+            svd_matrix = svd.fit_transform(vectorizer.fit_transform(texts))
+        else:
+            svd_matrix = svd.transform(vectorizer.transform(texts))
+        numeric = features.drop(['user_id', 'response_text'], axis=1).fillna(0)
+        return np.hstack([numeric.values.astype(np.float64), svd_matrix])
+
+    def outcomes(self, test, cutoff):
+        '''
+        Observed outcome of test users: 1 for good churn, 0 otherwise, NaN
+        when the data ends before the outcome is known.
+        '''
+        users = test.user_id.values
+        last = activity_log._as_ns(test.last_day.values)
+        pos = np.maximum(self.log.positions(users), 0)
+        # first activity after the cutoff, if any
+        index = self.log.offsets[pos] + self.log.search(
+            users, np.full(len(users), cutoff.value))
+        has_next = index < self.log.offsets[pos + 1]
+        next_time = self.log.times[np.where(has_next, index, 0)]
+        back = has_next & (next_time - last <= self.time_gone * DAY)
+        return_day = next_time - next_time % DAY
+        post_end = return_day + self.postchurn_time * DAY
+        post = self.log.window_counts(users, return_day, post_end)
+        outcome = (back & (post > self.postchurn_act)).astype(np.float64)
+        watermark = self.watermark.value
+        outcome[~back & (last + self.time_gone * DAY > watermark)] = np.nan
+        outcome[back & (post_end > watermark)] = np.nan
+        return outcome
+
+    def step(self, as_of):
+        '''
+        Label, train, score and evaluate at one cutoff day.
+
+        Returns
+        -------
+        dict with as_of, n_good, n_bad, n_train, n_test, n_observed, auc,
+        relabeled (users relabeled for good churn), new_windows (windows
+        whose features were computed) and seconds
+        '''
+        start = time.time()
+        as_of = pd.tslib.Timestamp(as_of).normalize()
+        cutoff = data_collection.activity_cutoff(as_of)
+        self.new_windows = 0
+        good = self.good_churn(as_of)
+
+        counts, last = last_activity(self.log, cutoff)
+        date_of_leave = as_of - pd.tslib.Timedelta(days=self.time_gone)
+        gone_low = as_of - pd.tslib.Timedelta(days=self.time_gone_high)
+        gone_high = as_of - pd.tslib.Timedelta(days=self.time_gone_low)
+        seen = counts > self.prechurn_act
+        bad = seen & (last <= date_of_leave.value)
+        in_test = seen & (last > gone_low.value) & (last < gone_high.value)
+        excluded = self.log.user_ids[bad | in_test]
+
+        # first good churn event of users that are not bad churn or test
+        good = good[~good.user_id.isin(excluded)]
+        good = good.sort_values(['user_id', 'churn_date']).drop_duplicates('user_id')
+        train = pd.concat([
+            self._windows(good.user_id.values, pd.to_datetime(good.churn_date)),
+            self._windows(self.log.user_ids[bad], _day_after(last[bad]))],
+            ignore_index=True)
+        y = np.r_[np.ones(len(good)), np.zeros(bad.sum())]
+        test = pd.DataFrame({'user_id': self.log.user_ids[in_test].astype(np.int64),
+                             'last_day': last[in_test]})
+        row = {'as_of': as_of, 'n_good': len(good), 'n_bad': int(bad.sum()),
+               'n_train': len(train), 'n_test': len(test), 'n_observed': 0,
+               'auc': np.nan}
+        if len(test) and len(good) and bad.any():
+            from sklearn.decomposition import TruncatedSVD
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            from sklearn.metrics import roc_auc_score
+            vectorizer = TfidfVectorizer(stop_words='english')
+            svd = TruncatedSVD(n_components=self.no_SVs,
+                               random_state=self.random_state)
+            X_train = self._matrix(self.features(train), vectorizer, svd, fit=True)
+            model = self.classifier()
+            model.fit(X_train, y)
+            test_windows = self._windows(test.user_id.values,
+                                         _day_after(test.last_day.values))
+            X_test = self._matrix(self.features(test_windows), vectorizer, svd)
+            probability = model.predict_proba(X_test)[:, 1]
+            outcome = self.outcomes(test, cutoff)
+            observed = ~np.isnan(outcome)
+            row['n_observed'] = int(observed.sum())
+            if len(np.unique(outcome[observed])) == 2:
+                row['auc'] = roc_auc_score(outcome[observed], probability[observed])
+        row['relabeled'] = self.relabeled
+        row['new_windows'] = self.new_windows
+        row['seconds'] = time.time() - start
+        return row
+
+    def run(self, cutoffs):
+        '''
+        Run step over cutoff days in increasing order.
+
+        Returns
+        -------
+        pandas DataFrame with one row per cutoff, the columns of step
+        '''
+        rows = [self.step(as_of) for as_of in sorted(cutoffs)]
+        return pd.DataFrame(rows, columns=['as_of', 'n_good', 'n_bad',
+                                           'n_train', 'n_test', 'n_observed',
+                                           'auc', 'relabeled', 'new_windows',
+                                           'seconds'])
@@ -0,0 +1,195 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from psycopg2.extensions import cursor as _cursor
+import data_collection
+import db_session
+import define_classes
+import feature_building
+import snapshot
+import text_processing
+
+
+class CountingCursor(_cursor):
+    '''
+    psycopg2 cursor counting database round-trips: every statement sent and
+    every fetch of a named (server-side) cursor. Pass it as the
+    cursor_factory of a DBSession.
+    '''
+    round_trips = 0
+
+    def execute(self, sql, params=None):
+        CountingCursor.round_trips += 1
+        return _cursor.execute(self, sql, params)
+
+    def executemany(self, sql, params):
+        CountingCursor.round_trips += 1
+        return _cursor.executemany(self, sql, params)
+
+    def copy_expert(self, sql, file, size=8192):
+        CountingCursor.round_trips += 1
+        return _cursor.copy_expert(self, sql, file, size)
+
+    def fetchmany(self, size=None):
+        if self.name is not None:
+            CountingCursor.round_trips += 1
+        if size is None:
+            return _cursor.fetchmany(self)
+        return _cursor.fetchmany(self, size)
+
+    def fetchall(self):
+        if self.name is not None:
+            CountingCursor.round_trips += 1
+        return _cursor.fetchall(self)
+
+
+def measure(name, func, *args, **kwargs):
+    '''
+    Run one stage and record its wall time and database round-trips. Unless
+    memory=False is passed, the stage is run a second time under tracemalloc
+    to record its peak Python memory (numpy and pandas buffers included);
+    tracing slows allocation-heavy code several times over, so it is kept out
+    of the timed run.
+
+    Returns
+    -------
+    result: return value of func
+    row: dict with stage, seconds, round_trips, peak_mb and rows
+    '''
+    memory = kwargs.pop('memory', True)
+    trips = CountingCursor.round_trips
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    row = {'stage': name, 'seconds': seconds,
+           'round_trips': CountingCursor.round_trips - trips,
+           'peak_mb': None,
+           'rows': len(result) if hasattr(result, '__len__') else None}
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            row['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2.0**20
+        finally:
+            tracemalloc.stop()
+    return result, row
+
+
+def same_labels(a, b):
+    '''
+    True if two good churn DataFrames hold the same churn events and counts,
+    whatever their dtypes.
+    '''
+    columns = ['user_id', 'churn_date', 'No_prechurn_activities',
+               'No_postchurn_activities']
+    if len(a) != len(b):
+        return False
+    if len(a) == 0:
+        return True
+    a = a[columns].astype(str).sort_values(columns).values
+    b = b[columns].astype(str).sort_values(columns).values
+    return bool((a == b).all())
+
+
+def run_benchmarks(db, db_user, sample_size=500, legacy=True, memory=True,
+                   leave_time=28, prechurn_time=14, prechurn_act=5,
+                   postchurn_time=14, postchurn_act=5, time_gone=200,
+                   time_gone_low=28, time_gone_high=60, no_SVs=15, seed=0):
+    '''
+    Time the pipeline stages on a database or Snapshot, e.g. one loaded by
+    synthetic.SyntheticData: user_stats_df, the churn labeling functions,
+    feature_df_maker and the text stages. Stages that only run against
+    PostgreSQL (the per-user legacy functions and the text stages) are
+    skipped for a Snapshot. The legacy per-user stages run on a sample of
+    users, next to their vectorized versions on the same sample, and the
+    good churn labels of both are checked to be identical.
+
+    Parameters
+    ----------
+    db: Snapshot or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    sample_size: int containing the number of users of the per-user stages
+    legacy: bool, if True also time the original per-user functions
+    memory: bool, if True rerun every stage to record its peak memory
+    leave_time, prechurn_time, prechurn_act, postchurn_time, postchurn_act:
+    good churn parameters, as in define_classes.label_good_churn
+    time_gone: int containing the days without activity of bad churn
+    time_gone_low, time_gone_high: ints containing the test user window
+    no_SVs: int containing the number of singular values of the text model
+    seed: int seeding the user sample
+
+    Returns
+    -------
+    DataFrame with one row per stage: stage, seconds, round_trips, peak_mb,
+    rows and, for labeling, whether the legacy labels match
+
+    Example
+    -------
+    >>> data = synthetic.SyntheticData(10000)
+    >>> data.load_postgres(db, db_user)
+    >>> benchmark.run_benchmarks(db, db_user, sample_size=200)
+    '''
+    on_snapshot = isinstance(db, snapshot.Snapshot)
+    if not on_snapshot:
+        db = db_session.DBSession(db, db_user, cursor_factory=CountingCursor)
+    rows = []
+
+    def stage(name, func, *args, **kwargs):
+        kwargs['memory'] = memory
+        result, row = measure(name, func, *args, **kwargs)
+        rows.append(row)
+        return result
+
+    try:
+        stats = stage('user_stats_bulk', data_collection.user_stats_df,
+                      db, db_user, 'activity', bulk=True)
+
+        rng = np.random.RandomState(seed)
+        users = stats.app_user[stats.num_uses > 1].values
+        sample = rng.choice(users, min(sample_size, len(users)), replace=False)
+        if legacy and not on_snapshot:
+            stage('user_stats_sample', data_collection.user_stats_df,
+                  db, db_user, 'activity', bulk=True, user_ids=sample)
+            stage('user_stats_legacy', data_collection.user_stats_df,
+                  db, db_user, 'activity', user_ids=sample)
+        labels = (leave_time, prechurn_time, prechurn_act, postchurn_time,
+                  postchurn_act)
+        good = stage('good_churn', define_classes.idendify_good_churn_vectorized,
+                     db, db_user, 'activity', sample, *labels)
+        if legacy and not on_snapshot:
+            good_legacy = stage('good_churn_legacy',
+                                define_classes.idendify_good_churn_across_user,
+                                db, db_user, 'activity', sample, *labels)
+            rows[-1]['matches'] = same_labels(good, good_legacy)
+        bad = stage('bad_churn', define_classes.idendify_bad_churn_users,
+                    db, db_user, 'activity', time_gone, prechurn_act)
+        stage('test_users', define_classes.idendify_test_users, db, db_user,
+              'activity', time_gone_low, time_gone_high, prechurn_act)
+
+        # training windows as in the notebook: the churn day of good churn
+        # and the last day of bad churn, with the 14 days before
+        windows = pd.concat([
+            pd.DataFrame({'user_id': good.user_id.values,
+                          'churn_date': pd.to_datetime(good.churn_date).values}),
+            pd.DataFrame({'user_id': bad.user_id.values,
+                          'churn_date': pd.to_datetime(bad.last_day).values})],
+            ignore_index=True)
+        windows = windows.drop_duplicates('user_id').head(sample_size)
+        windows['pre_churn_date'] = (windows.churn_date
+                                     - pd.tslib.Timedelta(days=prechurn_time))
+        stage('features_batch', feature_building.feature_df_maker,
+              db, db_user, windows, batch=True)
+        if not on_snapshot:
+            if legacy:
+                stage('features', feature_building.feature_df_maker,
+                      db, db_user, windows)
+            stage('response_text', text_processing.fetch_response_text,
+                  db, db_user, windows)
+            stage('train_text_clusters', text_processing.train_text_clusters,
+                  db, db_user, windows, no_SVs)
+    finally:
+        if not on_snapshot:
+            db.close()
+    return pd.DataFrame(rows, columns=['stage', 'seconds', 'round_trips',
+                                       'peak_mb', 'rows', 'matches'])
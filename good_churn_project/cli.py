@@ -0,0 +1,330 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Set before any project module is imported, so --timing can report the
+# start-up cost of a command.
+_START = time.time()
+
+# Project modules imported by each command; every command imports them
+# when it runs, so start-up only pays for what the command uses.
+COMMAND_MODULES = {
+    'stats': ['data_collection'],
+    'label': ['activity_log', 'define_classes'],
+    'features': ['feature_building', 'text_processing'],
+    'train': ['feature_building', 'scoring', 'text_processing'],
+    'score': ['scoring'],
+}
+
+
+def _source(args):
+    # Snapshot or database session named on the command line.
+    if args.snapshot:
+        import snapshot
+        return snapshot.Snapshot(args.snapshot), None
+    import db_session
+    return db_session.DBSession(args.db, args.db_user, host=args.host), args.db_user
+
+
+def _as_of(args):
+    # --as-of, or the export day of the data
+    if args.as_of is not None:
+        return args.as_of
+    import data_collection
+    return data_collection.AS_OF
+
+
+def _write(frame, path):
+    if path in (None, '-'):
+        frame.to_csv(sys.stdout, index=False)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def _windows(frame, date_column, pre_churn_days):
+    # user windows of the pre_churn_days before each date
+    import pandas as pd
+    windows = pd.DataFrame({'user_id': frame.user_id.values,
+                            'churn_date': pd.to_datetime(frame[date_column]).values})
+    windows['pre_churn_date'] = (windows.churn_date
+                                 - pd.tslib.Timedelta(days=pre_churn_days))
+    return windows
+
+
+def _matrix(nf_matrix, text_matrix):
+    # numeric and text features joined on user_id, as in the notebook
+    matrix = nf_matrix.set_index('user_id').join(text_matrix.set_index('user_id'))
+    return matrix.fillna(0)
+
+
+def stats(args, db, db_user):
+    '''Write the user_stats of every user (data_collection.user_stats_df).'''
+    import data_collection
+    _write(data_collection.user_stats_df(db, db_user, args.table, bulk=True),
+           args.out)
+
+
+def label(args, db, db_user):
+    '''Write the good churn, bad churn and test user CSVs of the notebook.'''
+    import activity_log
+    import define_classes
+    log = activity_log.ActivityLog.load(db, db_user, args.table)
+    good = define_classes.label_good_churn(log, log.user_ids, args.leave_time,
+                                           args.prechurn_time,
+                                           args.prechurn_act,
+                                           args.postchurn_time,
+                                           args.postchurn_act, args.as_of)
+    as_of = _as_of(args)
+    bad = define_classes.idendify_bad_churn_users(db, db_user, args.table,
+                                                  args.time_gone,
+                                                  args.prechurn_act, as_of=as_of)
+    test = define_classes.idendify_test_users(db, db_user, args.table,
+                                              args.time_gone_low,
+                                              args.time_gone_high,
+                                              args.prechurn_act, as_of=as_of)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    for name, frame in [('good_churn', good), ('bad_churn', bad),
+                        ('test_users', test)]:
+        _write(frame, os.path.join(args.out_dir, name + '.csv'))
+        sys.stderr.write('{}: {} rows\n'.format(name, len(frame)))
+
+
+def features(args, db, db_user):
+    '''Write the numeric and response text features of user windows.'''
+    import pandas as pd
+    import feature_building
+    import text_processing
+    users = pd.read_csv(args.windows)
+    if 'pre_churn_date' in users:
+        windows = users[['user_id', 'pre_churn_date', 'churn_date']].copy()
+    else:
+        windows = _windows(users, 'churn_date' if 'churn_date' in users
+                           else 'last_day', args.pre_churn_days)
+    feature_df = feature_building.feature_df_maker(db, db_user, windows,
+                                                   batch=True,
+                                                   as_of=_as_of(args))
+    response_df = text_processing.fetch_response_text(db, db_user, windows)
+    for column in ['response_count', 'response_len']:
+        feature_df[column] = response_df[column].values
+    _write(feature_df, args.out)
+
+
+def train(args, db, db_user):
+    '''
+    Train the notebook's model on good and bad churn CSVs written by label
+    and save it for score.
+    '''
+    import numpy as np
+    import pandas as pd
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import roc_auc_score
+    from sklearn.model_selection import train_test_split
+    import feature_building
+    import scoring
+    import text_processing
+    good = pd.read_csv(args.good)
+    bad = pd.read_csv(args.bad)
+    excluded = set(bad.user_id)
+    if args.test:
+        excluded |= set(pd.read_csv(args.test).user_id)
+    # first good churn event of users that are not bad churn or test users
+    good = good[~good.user_id.isin(excluded)]
+    good = good.sort_values(['user_id', 'churn_date']).drop_duplicates('user_id')
+    windows = pd.concat([_windows(good, 'churn_date', args.pre_churn_days),
+                         _windows(bad, 'last_day', args.pre_churn_days)],
+                        ignore_index=True)
+    y = np.r_[np.ones(len(good)), np.zeros(len(bad))]
+    as_of = _as_of(args)
+    if args.validation:
+        X_train, X_test, y_train, y_test = train_test_split(
+            windows, y, test_size=args.validation, stratify=y, random_state=67)
+    else:
+        X_train, y_train = windows, y
+    text_matrix, vectorizer, svd = text_processing.train_text_clusters(
+        db, db_user, X_train.reset_index(drop=True), args.no_svs)
+    nf_matrix = feature_building.feature_df_maker(db, db_user, X_train,
+                                                  batch=True, as_of=as_of)
+    matrix = _matrix(nf_matrix, text_matrix)
+    rfc = RandomForestClassifier(n_estimators=args.n_estimators, n_jobs=-1,
+                                 class_weight='balanced', random_state=67)
+    rfc.fit(matrix.values, y_train)
+    scoring.save_model(args.model, vectorizer, svd, rfc, matrix.columns,
+                       args.threshold, args.pre_churn_days)
+    sys.stderr.write('trained on {} windows\n'.format(len(X_train)))
+    if args.validation:
+        X_test = X_test.reset_index(drop=True)
+        test_matrix = _matrix(
+            feature_building.feature_df_maker(db, db_user, X_test, batch=True,
+                                              as_of=as_of),
+            text_processing.test_text_clusters(db, db_user, X_test,
+                                               vectorizer, svd))
+        test_matrix = test_matrix.reindex(columns=matrix.columns, fill_value=0)
+        probability = rfc.predict_proba(test_matrix.values)[:, 1]
+        sys.stderr.write('validation AUC: {:.3f}\n'.format(
+            roc_auc_score(y_test, probability)))
+
+
+def score(args, db, db_user):
+    '''
+    Score users by id, or update an incremental score of the test population
+    when --state is given.
+    '''
+    import pandas as pd
+    import scoring
+    scorer = scoring.GoodChurnScorer(args.model, db, db_user)
+    if args.state:
+        incremental = scoring.IncrementalScorer(scorer, args.state,
+                                                args.time_gone_low,
+                                                args.time_gone_high,
+                                                args.prechurn_act)
+        scores = incremental.run(args.as_of)
+        sys.stderr.write('{}\n'.format(incremental.changes))
+    else:
+        user_ids = list(args.user_id)
+        if args.users:
+            user_ids += list(pd.read_csv(args.users).user_id)
+        scores = scorer.score(user_ids, _as_of(args))
+    _write(scores, args.out)
+
+
+def cold_start(commands=None, repeat=3):
+    '''
+    Measure the start-up time of commands: for each, the best of repeat
+    fresh interpreters importing the command's modules.
+
+    Returns
+    -------
+    dict mapping command to seconds
+
+    Example
+    -------
+    >>> cli.cold_start()
+    {'features': 0.007, 'label': 0.005, 'score': 0.012, 'stats': 0.004, 'train': 0.013}
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for command in commands or sorted(COMMAND_MODULES):
+        code = ('import time; start = time.time(); import {}; '
+                'print(time.time() - start)').format(', '.join(COMMAND_MODULES[command]))
+        runs = []
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+            runs.append(float(out.decode().split()[-1]))
+        times[command] = min(runs)
+    return times
+
+
+def startup(args):
+    '''Print the cold-start import time of every command.'''
+    unknown = set(args.command) - set(COMMAND_MODULES)
+    if unknown:
+        raise SystemExit('unknown commands: {}'.format(', '.join(sorted(unknown))))
+    for command, seconds in sorted(cold_start(args.command, args.repeat).items()):
+        print('{:10s} {:.3f}s'.format(command, seconds))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='good_churn_project',
+        description='Good churn pipeline: user stats, churn labels, '
+                    'features, training and scoring.')
+    source = argparse.ArgumentParser(add_help=False)
+    source.add_argument('--db', default=os.environ.get('PGDATABASE'),
+                        help='postgreSQL data base (default $PGDATABASE)')
+    source.add_argument('--db-user', default=os.environ.get('PGUSER'),
+                        help='data base user (default $PGUSER)')
+    source.add_argument('--host', default='localhost')
+    source.add_argument('--snapshot', help='read a Snapshot directory '
+                                           'instead of the data base')
+    source.add_argument('--table', default='activity')
+    source.add_argument('--as-of', help='day the labels and features are '
+                                        'computed at (default: export day)')
+    source.add_argument('--timing', action='store_true',
+                        help='report start-up and run time on stderr')
+    source.add_argument('--out', help='output CSV (default stdout)')
+    labels = argparse.ArgumentParser(add_help=False)
+    labels.add_argument('--prechurn-act', type=int, default=5)
+    labels.add_argument('--time-gone-low', type=int, default=28)
+    labels.add_argument('--time-gone-high', type=int, default=60)
+    window = argparse.ArgumentParser(add_help=False)
+    window.add_argument('--pre-churn-days', type=int, default=14)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('stats', parents=[source], help=stats.__doc__)
+    p.set_defaults(func=stats)
+
+    p = commands.add_parser('label', parents=[source, labels], help=label.__doc__)
+    p.add_argument('--out-dir', default='.')
+    p.add_argument('--leave-time', type=int, default=28)
+    p.add_argument('--prechurn-time', type=int, default=14)
+    p.add_argument('--postchurn-time', type=int, default=14)
+    p.add_argument('--postchurn-act', type=int, default=5)
+    p.add_argument('--time-gone', type=int, default=200)
+    p.set_defaults(func=label)
+
+    p = commands.add_parser('features', parents=[source, window],
+                            help=features.__doc__)
+    p.add_argument('windows', help='CSV with user_id and churn_date (or '
+                                   'last_day) and optionally pre_churn_date')
+    p.set_defaults(func=features)
+
+    p = commands.add_parser('train', parents=[source, window], help=train.__doc__)
+    p.add_argument('--good', required=True, help='good_churn.csv from label')
+    p.add_argument('--bad', required=True, help='bad_churn.csv from label')
+    p.add_argument('--test', help='test_users.csv from label')
+    p.add_argument('--model', required=True, help='model file to write')
+    p.add_argument('--no-svs', type=int, default=15)
+    p.add_argument('--n-estimators', type=int, default=100)
+    p.add_argument('--threshold', type=float, default=0.22)
+    p.add_argument('--validation', type=float, default=0.2,
+                   help='fraction held out to report AUC (0 to skip)')
+    p.set_defaults(func=train)
+
+    p = commands.add_parser('score', parents=[source, labels], help=score.__doc__)
+    p.add_argument('--model', required=True, help='model file from train')
+    p.add_argument('--users', help='CSV with a user_id column')
+    p.add_argument('user_id', nargs='*', type=int)
+    p.add_argument('--state', help='state file of an incremental scorer')
+    p.set_defaults(func=score)
+
+    p = commands.add_parser('startup', help=startup.__doc__)
+    p.add_argument('command', nargs='*',
+                   help='commands to time: {}'.format(', '.join(sorted(COMMAND_MODULES))))
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=startup)
+    return parser
+
+
+def main(argv=None):
+    '''
+    Run a command.
+
+    Example
+    -------
+    $ python good_churn_project label --snapshot snap --out-dir labels
+    $ python good_churn_project train --snapshot snap --good labels/good_churn.csv \\
+          --bad labels/bad_churn.csv --test labels/test_users.csv --model model.pkl
+    $ python good_churn_project score --db churn --db-user me --model model.pkl \\
+          --state scores.pkl --out scores.csv
+    '''
+    args = _parser().parse_args(argv)
+    if args.func is startup:
+        return startup(args)
+    db, db_user = _source(args)
+    started = time.time()
+    try:
+        args.func(args, db, db_user)
+    finally:
+        if hasattr(db, 'close'):
+            db.close()
+    if args.timing:
+        sys.stderr.write('start-up {:.3f}s, {} {:.3f}s\n'.format(
+            started - _START, args.command, time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,43 @@
-import psycopg2 as pg2
 import pandas as pd
-from sqlalchemy import create_engine
+from io import StringIO
+import activity_log
+import db_session
+import instrumentation
+import schema
+import snapshot
+
+# Day the data was exported: the default "now" of the churn labels and of
+# the age feature. Backtests pass earlier days as as_of.
+AS_OF = '2016-04-04'
+
+USER_DF_COLUMNS = ['user_id', 'start_date', 'stop_date', 'activity_count']
+
+USER_STATS_COLUMNS = ['app_user', 'first_use', 'last_use', 'time_with_app',
+                      'num_uses', 'min_away', 'max_away', 'avg_away',
+                      'median_away']
+
+# Activity of one user in a date range, as prepared by
+# activity_dates_range_df: {} is the table, $1 = user_id, $2 and $3 the
+# bounds of the range.
+ACTIVITY_DATES_RANGE_QUERY = '''
+    SELECT date, id
+    FROM {}
+    WHERE user_id = $1
+    AND date > $2
+    AND date < $3'''
+
+# Users active after a date, as run by count_active.
+COUNT_ACTIVE_QUERY = '''WITH    churn AS
+    (
+    SELECT (MAX(date) > %s) AS still_in
+    FROM activity
+    GROUP BY user_id
+    )
+    SELECT COUNT (still_in)
+    FROM churn
+    WHERE still_in = 't'
+    ;
+    '''
 
 
 def user_df_maker(db, db_user, table):
@@ -9,7 +46,7 @@ def user_df_maker(db, db_user, table):
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
 
@@ -23,16 +60,33 @@ def user_df_maker(db, db_user, table):
     >>> users_df.user_id[1:3].values
     array([2848, 3565])
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
+    return collect_chunks(iter_user_df(db, db_user, table), USER_DF_COLUMNS)
+
+
+def iter_user_df(db, db_user, table, batch_size=10000):
+    '''
+    Streaming version of user_df_maker yielding typed DataFrame chunks read
+    through a server-side cursor.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    batch_size: int containing the number of rows per chunk
+
+    Returns
+    -------
+    generator of pandas DataFrames
+    '''
+    session = db_session.get_session(db, db_user)
     column_qurey = '''
     SELECT column_name
     FROM information_schema.columns
-    WHERE table_schema='public' AND table_name='{}'
+    WHERE table_schema='public' AND table_name=%s
     ;
-    '''.format(table)
-    cur.execute(column_qurey)
-    columns = cur.fetchall()
+    '''
+    columns = session.query(column_qurey, (table,))
     columns = [c[0] for c in columns]
     if 'created_at' in columns:
         created = 'created_at'
@@ -47,12 +101,10 @@ def user_df_maker(db, db_user, table):
     GROUP BY user_id
     ;
     '''.format(created, created, created, table)
-    cur.execute(sql)
-    user_df = pd.DataFrame(cur.fetchall(), columns=['user_id', 'start_date',
-                                                    'stop_date',
-                                                    'activity_count'])
-    conn.close()
-    return user_df
+    return stream_df(db, db_user, sql, USER_DF_COLUMNS, batch_size=batch_size,
+                     dtypes={'start_date': 'datetime64[ns]',
+                             'stop_date': 'datetime64[ns]',
+                             'activity_count': 'int64'})
 
 
 def activity_dates_df(db, db_user, table, app_user):
@@ -61,7 +113,7 @@ def activity_dates_df(db, db_user, table, app_user):
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
     app_user: int user_id
@@ -77,29 +129,66 @@ def activity_dates_df(db, db_user, table, app_user):
     >>> act_df.date[1]
     Timestamp('2015-01-19 22:27:33.266120')
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = 'SELECT date FROM {} WHERE user_id = {};'.format(table, int(app_user))
-    cur.execute(sql)
-    activity_dates = pd.DataFrame(cur.fetchall(),
+    session = db_session.get_session(db, db_user)
+    sql = 'SELECT date FROM {} WHERE user_id = $1'.format(table)
+    rows = session.query_prepared('activity_dates_{}'.format(table), sql,
+                                  (int(app_user),))
+    activity_dates = pd.DataFrame(rows,
     columns= ['date']).sort(['date'], ascending=True)
     next_activity = activity_dates['date'][1:]
     activity_dates = activity_dates[:len(activity_dates)-1]
     next_activity.index = activity_dates.index
     activity_dates['next'] = next_activity
     activity_dates['dif_time'] = activity_dates['next']-activity_dates['date']
-    conn.close()
     return activity_dates
 
-def user_stats_df(db, db_user, table):
+def iter_activity_dates(db, db_user, table, app_user, batch_size=10000):
+    '''
+    Streaming version of activity_dates_df yielding chunks of the date, next
+    and dif_time columns for a user, read in date order through a
+    server-side cursor.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    app_user: int user_id
+    batch_size: int containing the number of rows per chunk
+
+    Returns
+    -------
+    generator of pandas DataFrames
+    '''
+    sql = '''SELECT date FROM {} WHERE user_id = %s ORDER BY date
+    ;'''.format(table)
+    previous = None
+    for chunk in stream_df(db, db_user, sql, ['date'], (int(app_user),),
+                           batch_size, {'date': 'datetime64[ns]'}):
+        dates = chunk['date']
+        if previous is not None:
+            dates = pd.concat([pd.Series([previous]), dates], ignore_index=True)
+        previous = dates.iloc[-1]
+        activity_dates = pd.DataFrame({'date': dates.values[:-1],
+                                       'next': dates.values[1:]})
+        activity_dates['dif_time'] = activity_dates['next']-activity_dates['date']
+        if len(activity_dates):
+            yield activity_dates
+
+@instrumentation.instrumented
+def user_stats_df(db, db_user, table, bulk=False, user_ids=None):
     ''' Create a Pandas DataFrame containing the activity statistics for a list
     of users.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
+    bulk: bool, if True compute the statistics for all users from a single
+    query (see user_stats_bulk_df) instead of one query per user. Required
+    when db is a Snapshot.
+    user_ids: optional list of user_ids to restrict the statistics to
 
     Returns
     -------
@@ -111,9 +200,13 @@ def user_stats_df(db, db_user, table):
     >>> len(stats_df)
     13588
     '''
+    if bulk:
+        return user_stats_bulk_df(db, db_user, table, user_ids)
     user_stats = pd.DataFrame(columns= ['app_user','first_use', 'last_use', 'time_with_app', 'num_uses',
                                          'min_away', 'max_away', 'avg_away', 'median_away'])
     user_table = user_df_maker(db, db_user, table)
+    if user_ids is not None:
+        user_table = user_table[user_table.user_id.isin(user_ids)]
     for user_id in user_table['user_id']:
         # Addresses data that does not contain a user_id
         if not user_id > 0:
@@ -146,13 +239,114 @@ def user_stats_df(db, db_user, table):
 
     return user_stats
 
+def activity_gap_stats(activity):
+    '''
+    Compute the user_stats columns from a DataFrame of activity dates for many
+    users at once.
+
+    Parameters
+    ----------
+    activity: DataFrame with user_id and date columns
+
+    Returns
+    -------
+    DataFrame containing the activity statistics with the same columns and
+    values as user_stats_df, one row per user ordered by user_id.
+    '''
+    return activity_log.ActivityLog.from_frame(activity).gap_stats()
+
+@instrumentation.instrumented
+def user_stats_bulk_df(db, db_user, table, user_ids=None):
+    ''' Create the user_stats DataFrame for all users with one query.
+    All activity dates are fetched at once, ordered by user and date, and the
+    gap statistics are computed with a vectorized groupby.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    user_ids: optional list of user_ids to restrict the statistics to
+
+    Returns
+    -------
+    DataFrame containing the activity statistics, column for column the same
+    as user_stats_df.
+
+    Example
+    -------
+    >>> stats_df = data_collection.user_stats_bulk_df(db, db_user, 'activity')
+    >>> len(stats_df)
+    13588
+    '''
+    activity = load_activity(db, db_user, table, user_ids)
+    return activity_gap_stats(activity)
+
+
+def activity_cutoff(as_of):
+    '''
+    End of the day as_of: labels computed as of that day ignore activity
+    from this instant on.
+    '''
+    return pd.tslib.Timestamp(as_of).normalize() + pd.tslib.Timedelta(days=1)
+
+
+@instrumentation.instrumented
+def load_activity(db, db_user, table, user_ids=None):
+    '''
+    Fetch the activity dates of all users (or of a list of users) with one
+    query, ordered by user_id and date.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    user_ids: optional list of user_ids to restrict the query to
+
+    Returns
+    -------
+    DataFrame with user_id and date columns
+
+    Example
+    -------
+    >>> activity = data_collection.load_activity(db, db_user, 'activity')
+    '''
+    if isinstance(db, snapshot.Snapshot):
+        spec = snapshot.SNAPSHOT_TABLES[table]
+        activity = db.read(table, [spec['user'], spec['time']], user_ids)
+        activity.columns = ['user_id', 'date']
+        return activity[activity.user_id > 0].reset_index(drop=True)
+    session = db_session.get_session(db, db_user)
+    if user_ids is None:
+        sql = '''
+        SELECT user_id, date
+        FROM {}
+        WHERE user_id > 0
+        ORDER BY user_id, date
+        ;
+        '''.format(table)
+        rows = session.query(sql)
+    else:
+        sql = '''
+        SELECT user_id, date
+        FROM {}
+        WHERE user_id = ANY(%s)
+        ORDER BY user_id, date
+        ;
+        '''.format(table)
+        rows = session.query(sql, ([int(u) for u in user_ids],))
+    return pd.DataFrame(rows, columns=['user_id', 'date'])
+
+@instrumentation.instrumented
 def import_user_stats(db, db_user):
     '''
     Pull user_stats table from database.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
 
     Returns
@@ -163,37 +357,46 @@ def import_user_stats(db, db_user):
     Example
     -------
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
+    return collect_chunks(iter_user_stats(db, db_user), USER_STATS_COLUMNS)
+
+
+def iter_user_stats(db, db_user, batch_size=10000):
+    '''
+    Streaming version of import_user_stats yielding typed DataFrame chunks
+    read through a server-side cursor.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    batch_size: int containing the number of rows per chunk
+
+    Returns
+    -------
+    generator of pandas DataFrames
+    '''
     sql ='''SELECT app_user, first_use, last_use, time_with_app, num_uses,
     min_away, max_away, avg_away, median_away
     FROM user_stats;
     '''
-    cur.execute(sql)
-    user_stats = pd.DataFrame(cur.fetchall(), columns= ['app_user', 'first_use',
-                                                        'last_use',
-                                                        'time_with_app',
-                                                        'num_uses', 'min_away',
-                                                        'max_away', 'avg_away',
-                                                        'median_away'])
-    conn.close()
-    user_stats.time_with_app = pd.to_timedelta(user_stats.time_with_app, unit='ns')
-    user_stats.min_away = pd.to_timedelta(user_stats.min_away, unit='ns')
-    user_stats.max_away = pd.to_timedelta(user_stats.max_away, unit='ns')
-    user_stats.avg_away = pd.to_timedelta(user_stats.avg_away, unit='ns')
-    user_stats.median_away = pd.to_timedelta(user_stats.median_away, unit='ns')
-    return user_stats
+    dtypes = dict((column, 'timedelta64[ns]')
+                  for column in ['time_with_app', 'min_away', 'max_away',
+                                 'avg_away', 'median_away'])
+    return stream_df(db, db_user, sql, USER_STATS_COLUMNS,
+                     batch_size=batch_size, dtypes=dtypes)
+
 
 def create_activity_table(db, db_user):
     '''
     Create a table in the PostgreSQL data base containing user activity from
     multiple tables.
     This fuction is used to classify users as active and inactive during
-    different time periods.
+    different time periods. See update_activity_table to keep the table up
+    to date without rebuilding it.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
 
     Returns
@@ -201,40 +404,169 @@ def create_activity_table(db, db_user):
     table size
 
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE activity AS
-    SELECT sender_id AS user_id, created_at AS date, id, 'notifications' AS type
-    FROM notifications
-    ''')
-    cur.execute('''INSERT INTO activity
-    SELECT user_id, created_at AS date, id, 'answer_likes' AS type
-    FROM answer_likes
-    ''')
-    cur.execute('''INSERT INTO activity
-    SELECT user_id, created_at AS date, id, 'answers' AS type
-    FROM answers
-    ''')
-    cur.execute('''INSERT INTO activity
-    SELECT from_user_id AS user_id, created_at AS date, id, 'connections' AS type
-    FROM connections
-    ''')
-    conn.commit()
-    cur.execute('''SELECT count(*)
+    session = db_session.get_session(db, db_user)
+    with session.cursor() as cur:
+        cur.execute('''CREATE TABLE activity AS
+        SELECT sender_id AS user_id, created_at AS date, id, 'notifications' AS type
+        FROM notifications
+        ''')
+        cur.execute('''INSERT INTO activity
+        SELECT user_id, created_at AS date, id, 'answer_likes' AS type
+        FROM answer_likes
+        ''')
+        cur.execute('''INSERT INTO activity
+        SELECT user_id, created_at AS date, id, 'answers' AS type
+        FROM answers
+        ''')
+        cur.execute('''INSERT INTO activity
+        SELECT from_user_id AS user_id, created_at AS date, id, 'connections' AS type
+        FROM connections
+        ''')
+    table_size = session.query('''SELECT count(*)
     FROM activity
     ''')
-    table_size = cur.fetchall()
-    conn.close()
     return table_size
 
 
+# Source tables merged into the activity table and the column holding the
+# acting user in each of them.
+ACTIVITY_SOURCES = [('notifications', 'sender_id'),
+                    ('answer_likes', 'user_id'),
+                    ('answers', 'user_id'),
+                    ('connections', 'from_user_id')]
+
+
+@instrumentation.instrumented
+def update_activity_table(db, db_user, partitioned=False):
+    '''
+    Incrementally maintain the activity table. Only rows of the source tables
+    created after the watermark recorded for each source in the
+    activity_watermarks table are appended, so a daily refresh touches only
+    that day's rows. Reruns are idempotent: the rows and the new watermark
+    of a source are committed together and a unique (type, id, date) index
+    rejects duplicates. The first run creates the table and the covering
+    schema.ACTIVITY_INDEXES used by the per-user and range queries; an
+    activity table built by create_activity_table is adopted as is. If the
+    table is range-partitioned by month (partitioned=True on the first run,
+    or schema.partition_activity) the partitions of new months are created
+    before their rows are inserted.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    partitioned: bool, if True a new activity table is created partitioned
+    by month on date
+
+    Returns
+    -------
+    dict mapping each source table to the number of rows added
+
+    Example
+    -------
+    >>> data_collection.update_activity_table(db, db_user)
+    {'answer_likes': 112, 'answers': 31, 'connections': 40, 'notifications': 297}
+    '''
+    session = db_session.get_session(db, db_user)
+    with session.cursor() as cur:
+        cur.execute('''CREATE TABLE IF NOT EXISTS activity (
+        {}
+        ){}'''.format(schema.ACTIVITY_COLUMNS,
+                       ' PARTITION BY RANGE (date)' if partitioned else ''))
+        cur.execute('''CREATE TABLE IF NOT EXISTS activity_watermarks (
+        source text PRIMARY KEY,
+        last_created_at timestamp
+        )''')
+        schema.create_activity_indexes(cur)
+        partitioned = schema.is_partitioned(cur)
+
+    added = {}
+    for source, user_column in ACTIVITY_SOURCES:
+        with session.cursor() as cur:
+            cur.execute('''SELECT last_created_at FROM activity_watermarks
+            WHERE source = %s FOR UPDATE''', (source,))
+            watermark = cur.fetchall()
+            watermark = watermark[0][0] if watermark else None
+            # fix the upper bound first so rows arriving during the insert
+            # are left for the next run
+            cur.execute('''SELECT MIN(created_at), MAX(created_at) FROM {}
+            WHERE created_at > COALESCE(%s, '-infinity'::timestamp)
+            '''.format(source), (watermark,))
+            first, new_watermark = cur.fetchall()[0]
+            if new_watermark is None:
+                added[source] = 0
+                continue
+            if partitioned:
+                schema.ensure_activity_partitions(cur, first, new_watermark)
+            cur.execute('''INSERT INTO activity (user_id, date, id, type)
+            SELECT {}, created_at, id, %s
+            FROM {}
+            WHERE created_at > COALESCE(%s, '-infinity'::timestamp)
+            AND created_at <= %s
+            ON CONFLICT DO NOTHING
+            '''.format(user_column, source), (source, watermark, new_watermark))
+            added[source] = cur.rowcount
+            cur.execute('''INSERT INTO activity_watermarks (source, last_created_at)
+            VALUES (%s, %s)
+            ON CONFLICT (source) DO UPDATE SET last_created_at = EXCLUDED.last_created_at
+            ''', (source, new_watermark))
+    return added
+
+
+def activity_watermark(db, db_user, table='activity'):
+    '''
+    Return the latest activity date of the database or Snapshot, used to
+    tell whether cached features may be stale.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+
+    Returns
+    -------
+    Timestamp
+    '''
+    if isinstance(db, snapshot.Snapshot):
+        return db.watermark(table)
+    session = db_session.get_session(db, db_user)
+    return pd.tslib.Timestamp(session.query('SELECT MAX(date) FROM {}'.format(table))[0][0])
+
+
+
+def user_stats_version(db, db_user):
+    '''
+    Return a fingerprint of the user_stats the features read their away
+    times from, which changes whenever the table is rewritten with new
+    activity. A Snapshot computes the away times from its activity, so its
+    activity watermark is the version.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+
+    Returns
+    -------
+    string
+    '''
+    if isinstance(db, snapshot.Snapshot):
+        return str(db.watermark('activity'))
+    session = db_session.get_session(db, db_user)
+    rows = session.query('''SELECT count(*), sum(num_uses), max(last_use)
+    FROM user_stats''')
+    return '{}:{}:{}'.format(*rows[0])
+
 def count_active(db, db_user, table, last_date):
     '''
     Count the users that are active beyond a date.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     last_date: string formated like '2016-03-01'
 
@@ -242,22 +574,8 @@ def count_active(db, db_user, table, last_date):
     -------
     count
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = '''WITH    churn AS
-    (
-    SELECT (MAX(date) > '{}') AS still_in
-    FROM activity
-    GROUP BY user_id
-    )
-    SELECT COUNT (still_in)
-    FROM churn
-    WHERE still_in = 't'
-    ;
-    '''.format(last_date)
-    cur.execute(sql)
-    count = cur.fetchall()
-    conn.close()
+    session = db_session.get_session(db, db_user)
+    count = session.query(COUNT_ACTIVE_QUERY, (last_date,))
     return count
 
 def record_table(db, db_user, table):
@@ -265,7 +583,7 @@ def record_table(db, db_user, table):
     Save tables that are timeconsuming to creat in postgreSQL DB
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to create
 
@@ -276,6 +594,9 @@ def record_table(db, db_user, table):
     Example
     -------
     '''
+    from sqlalchemy import create_engine
+    if isinstance(db, db_session.DBSession):
+        db, db_user = db.db, db.db_user
     engine_str = 'postgresql://{}@localhost:5432/{}'.format(db_user, db)
     engine = create_engine(engine_str)
     table.to_sql(table, engine)
@@ -285,18 +606,97 @@ def activity_dates_range_df(db, db_user, table, app_user, date1, date2):
     # Create a Pandas DataFrame containing the activity date and id
     # for a given app user over a period between date1 and date2.
     #
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = '''
-    SELECT date, id
-    FROM {}
-    WHERE user_id = {}
-    AND date > '{}'
-    AND date < '{}';'''.format(table, int(app_user), date1, date2)
-    cur.execute(sql)
-    activity_dates = pd.DataFrame(cur.fetchall(),
+    session = db_session.get_session(db, db_user)
+    sql = ACTIVITY_DATES_RANGE_QUERY.format(table)
+    rows = session.query_prepared('activity_dates_range_{}'.format(table), sql,
+                                  (int(app_user), str(date1), str(date2)))
+    activity_dates = pd.DataFrame(rows,
                                     columns= ['date', 'id']).sort(['date'],
                                     ascending=True)
-    conn.close()
     activity_dates = activity_dates.reset_index(drop=True)
     return activity_dates
+
+def upload_windows(cur, user_df, table='user_windows'):
+    '''
+    Copy the (user_id, pre_churn_date, churn_date) windows of a DataFrame into
+    a temporary table on the cursor's connection. The table has an ord column
+    holding the row position in user_df and is dropped on commit, so it must
+    be used inside the same session.cursor() block.
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor borrowed from a DBSession
+    user_df: dataframe containing user_id, earliest day of the time window
+    (pre_churn_date) and the last day of the time window (churn_date)
+    table: string containing the name of the temporary table
+
+    Returns
+    -------
+    nothing
+    '''
+    cur.execute('''CREATE TEMPORARY TABLE {} (
+    ord integer,
+    user_id integer,
+    pre_churn_date timestamp,
+    churn_date timestamp
+    ) ON COMMIT DROP'''.format(table))
+    windows = pd.DataFrame({'ord': range(len(user_df)),
+                            'user_id': user_df.user_id.astype(int).values,
+                            'pre_churn_date': pd.to_datetime(user_df.pre_churn_date).values,
+                            'churn_date': pd.to_datetime(user_df.churn_date).values},
+                           columns=['ord', 'user_id', 'pre_churn_date',
+                                    'churn_date'])
+    buf = StringIO()
+    windows.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert('COPY {} FROM STDIN WITH CSV'.format(table), buf)
+    cur.execute('ANALYZE {}'.format(table))
+
+def stream_df(db, db_user, sql, columns, params=None, batch_size=10000,
+              dtypes=None):
+    '''
+    Run a query through a server-side cursor and yield the result as typed
+    DataFrame chunks, so peak memory is bounded by the batch size.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    sql: string containing the query with %s placeholders
+    columns: list of column names
+    params: sequence of values bound to the placeholders
+    batch_size: int containing the number of rows per chunk
+    dtypes: dict mapping column names to numpy dtypes; timedelta64 columns
+    are read from nanoseconds
+
+    Returns
+    -------
+    generator of pandas DataFrames
+
+    Example
+    -------
+    >>> for chunk in data_collection.stream_df(db, db_user,
+    ...         'SELECT user_id, date FROM activity', ['user_id', 'date']):
+    ...     counts = chunk.groupby('user_id').size()
+    '''
+    session = db_session.get_session(db, db_user)
+    for rows in session.stream(sql, params, batch_size):
+        chunk = pd.DataFrame(rows, columns=columns)
+        for column, dtype in (dtypes or {}).items():
+            if dtype == 'datetime64[ns]':
+                chunk[column] = pd.to_datetime(chunk[column])
+            elif dtype == 'timedelta64[ns]':
+                chunk[column] = pd.to_timedelta(chunk[column], unit='ns')
+            else:
+                chunk[column] = chunk[column].astype(dtype)
+        yield chunk
+
+def collect_chunks(chunks, columns):
+    '''
+    Concatenate the DataFrame chunks of a streaming reader into one
+    DataFrame.
+    '''
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
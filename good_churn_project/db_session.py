@@ -0,0 +1,207 @@
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+from psycopg2.pool import ThreadedConnectionPool
+import instrumentation
+
+
+class DBSession(object):
+    '''
+    Database session backed by a bounded pool of psycopg2 connections.
+    A session can be passed in place of the db name to every function in
+    data_collection, define_classes, feature_building and text_processing.
+
+    Parameters
+    ----------
+    db: string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    host: string containing the database host
+    minconn: int containing the number of connections opened up front
+    maxconn: int containing the most connections the pool will hold
+    cursor_factory: optional psycopg2 cursor class used by every cursor of
+    the session, e.g. benchmark.CountingCursor
+
+    Example
+    -------
+    >>> session = db_session.DBSession(db, db_user)
+    >>> stats_df = data_collection.user_stats_df(session, None, 'activity')
+    '''
+
+    def __init__(self, db, db_user, host='localhost', minconn=1, maxconn=4,
+                 cursor_factory=None):
+        self.db = db
+        self.db_user = db_user
+        self.host = host
+        self.pool = ThreadedConnectionPool(minconn, maxconn, dbname=db,
+                                           user=db_user, host=host,
+                                           cursor_factory=cursor_factory)
+        # names of the statements prepared on each pooled connection
+        self._prepared = {}
+        self._lock = threading.Lock()
+        self._cursor_ids = itertools.count()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection from the pool. The transaction is committed when
+        the block exits and rolled back if it raises. While instrumentation is
+        enabled the connection hands out InstrumentedCursors built on the
+        session's cursor_factory.
+        '''
+        instrumented = instrumentation.is_enabled()
+        start = time.time()
+        conn = self.pool.getconn()
+        if instrumented:
+            instrumentation.record_db('connect', start, time.time() - start,
+                                      query=False)
+            factory = conn.cursor_factory
+            conn.cursor_factory = instrumentation.instrumented_cursor(factory)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            # Prepared statements belong to the database session and survive
+            # a rollback; they are only lost with the connection.
+            if conn.closed:
+                with self._lock:
+                    self._prepared.pop(conn, None)
+            else:
+                conn.rollback()
+            raise
+        finally:
+            if instrumented:
+                conn.cursor_factory = factory
+            self.pool.putconn(conn)
+
+    @contextmanager
+    def cursor(self):
+        '''Borrow a connection from the pool and yield a cursor on it.'''
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def query(self, sql, params=None):
+        '''
+        Run a parameterized query and return all rows.
+
+        Parameters
+        ----------
+        sql: string containing the query with %s placeholders
+        params: sequence of values bound to the placeholders
+
+        Returns
+        -------
+        list of tuples
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, params)
+            if cur.description is None:
+                return []
+            return cur.fetchall()
+
+    def stream(self, sql, params=None, batch_size=10000):
+        '''
+        Run a query through a named server-side cursor and yield its rows in
+        batches, so only one batch is held in memory at a time.
+
+        Parameters
+        ----------
+        sql: string containing the query with %s placeholders
+        params: sequence of values bound to the placeholders
+        batch_size: int containing the number of rows per batch
+
+        Returns
+        -------
+        generator of lists of tuples
+        '''
+        with self.connection() as conn:
+            name = 'stream_{}'.format(next(self._cursor_ids))
+            cur = conn.cursor(name)
+            cur.itersize = batch_size
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cur.close()
+
+    def prepare(self, cur, name, sql):
+        '''
+        Prepare a statement on the connection of a cursor unless it already
+        has been. The statement uses $1, $2 ... placeholders.
+        '''
+        with self._lock:
+            prepared = self._prepared.setdefault(cur.connection, set())
+            if name in prepared:
+                return
+        cur.execute('PREPARE {} AS {}'.format(name, sql))
+        with self._lock:
+            prepared.add(name)
+
+    def execute_prepared(self, cur, name, sql, params):
+        '''
+        Execute a prepared statement on a cursor, preparing it first if this
+        connection has not seen it.
+
+        Parameters
+        ----------
+        cur: psycopg2 cursor borrowed from this session
+        name: string naming the prepared statement
+        sql: string containing the statement with $1, $2 ... placeholders
+        params: sequence of values for the placeholders
+        '''
+        self.prepare(cur, name, sql)
+        placeholders = ', '.join(['%s'] * len(params))
+        cur.execute('EXECUTE {} ({})'.format(name, placeholders), params)
+
+    def query_prepared(self, name, sql, params):
+        '''Execute a prepared statement and return all rows.'''
+        with self.cursor() as cur:
+            self.execute_prepared(cur, name, sql, params)
+            return cur.fetchall()
+
+    def close(self):
+        '''Close every connection in the pool.'''
+        self.pool.closeall()
+        self._prepared = {}
+
+
+_sessions = {}
+
+
+def get_session(db, db_user, host='localhost'):
+    '''
+    Return the DBSession to use for a (db, db_user) pair. If db already is a
+    DBSession it is returned unchanged, otherwise one shared session is kept
+    per database and user so the legacy (db, db_user) signatures reuse pooled
+    connections.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+
+    Returns
+    -------
+    DBSession
+    '''
+    if isinstance(db, DBSession):
+        return db
+    key = (db, db_user, host)
+    if key not in _sessions:
+        _sessions[key] = DBSession(db, db_user, host=host)
+    return _sessions[key]
+
+
+def close_sessions():
+    '''Close every shared session opened through get_session.'''
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
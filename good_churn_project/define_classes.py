@@ -1,6 +1,70 @@
+import itertools
+import numpy as np
 import pandas as pd
-import psycopg2 as pg2
+import activity_log
 import data_collection
+import instrumentation
+import snapshot
+
+# Test users as streamed by iter_test_users: the last activity of a user
+# is between the first two dates, activity on or after the third date is
+# ignored and the user has more activities than the fourth parameter.
+TEST_USERS_QUERY = '''WITH test AS
+    (
+    SELECT user_id, MAX(date) AS last_day,
+    count(date) AS activity_count,
+    (MAX(date) > %s AND MAX(date) < %s) AS in_window
+    FROM activity
+    WHERE date < %s
+    GROUP BY user_id
+    )
+    SELECT user_id, last_day, activity_count
+    FROM test
+    WHERE in_window = 't'
+    and activity_count > %s
+    ;
+    '''
+
+# Users who may have entered or left the test window, as read by
+# test_user_candidates: activity dated in [first, second) or activity of
+# the users of the array after the third date.
+TEST_USER_CANDIDATES_QUERY = '''WITH candidates AS
+    (
+    SELECT user_id
+    FROM activity
+    WHERE date >= %s AND date < %s
+    UNION
+    SELECT user_id
+    FROM activity
+    WHERE date > %s AND user_id = ANY(%s)
+    )
+    SELECT c.user_id, s.last_day, s.activity_count
+    FROM candidates c,
+    LATERAL (SELECT MAX(date) AS last_day, count(date) AS activity_count
+             FROM activity
+             WHERE user_id = c.user_id) s
+    ORDER BY c.user_id
+    ;
+    '''
+
+# Bad churn as streamed by iter_bad_churn_users: users without activity
+# after the first date, activity on or after the second date ignored, with
+# more activities than the third parameter.
+BAD_CHURN_QUERY = '''WITH churn AS
+    (
+    SELECT user_id, MAX(date) AS last_day, count(date) AS activity_count,
+    (MAX(date) > %s) AS still_in
+    FROM activity
+    WHERE date < %s
+    GROUP BY user_id
+    )
+    SELECT user_id, last_day, activity_count
+    FROM churn
+    WHERE still_in = 'f'
+    and activity_count > %s
+    ;
+    '''
+
 
 def select_churn_users(user_stats, time_away, minimum_total_uses):
     '''
@@ -36,7 +100,7 @@ def idendify_good_churn_user(db, db_user, table, app_user, leave_time,
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
     app_user: string containing the user_id
@@ -86,6 +150,7 @@ def idendify_good_churn_user(db, db_user, table, app_user, leave_time,
     return good_churns
 
 
+@instrumentation.instrumented
 def idendify_good_churn_across_user(db, db_user, table, user_ids, leave_time,
                                     prechurn_time, prechurn_act, postchurn_time,
                                     postchurn_act):
@@ -97,7 +162,7 @@ def idendify_good_churn_across_user(db, db_user, table, user_ids, leave_time,
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
     user_ids: list of user_ids to scan for good churn
@@ -127,18 +192,142 @@ def idendify_good_churn_across_user(db, db_user, table, user_ids, leave_time,
     return good_churns
 
 
-def idendify_bad_churn_users(db, db_user, table, time_gone, prechurn_act):
+@instrumentation.instrumented
+def label_good_churn(activity, user_ids, leave_time, prechurn_time,
+                     prechurn_act, postchurn_time, postchurn_act, as_of=None):
+    '''
+    Vectorized version of idendify_good_churn_across_user working on activity
+    already loaded in memory. Leave events are found with diffs of the sorted
+    activity times and the pre/post churn windows are counted with binary
+    searches in each user's history, so no SQL is issued and the activity can
+    be relabeled with other parameters at no query cost.
+
+    The prechurn window spans prechurn_time days before the churn day; the
+    per-user implementation always uses 14 days, so the two agree when
+    prechurn_time is 14.
+
+    Parameters
+    ----------
+    activity: ActivityLog, or DataFrame with user_id and date columns
+    user_ids: list of user_ids to scan for good churn
+    leave_time: int containing the number of days without activity
+    prechurn_time: int containing the number of prechurn days to monitor for
+    activity.
+    prechurn_act: int containing the number of activities in the prechurn_time
+    postchurn_time: int containing the number of postchurn days to monitor for
+    activity.
+    postchurn_act: int containing the number of activities in the postchurn_time
+    as_of: optional day the labels are computed at; only churn events whose
+    postchurn window has ended by the end of that day are kept
+
+    Returns
+    -------
+    good_churns: pandas DataFrame with the columns of
+    idendify_good_churn_across_user, ordered by user_ids then churn date.
+
+    Example
+    -------
+    >>> log = activity_log.ActivityLog.load(db, db_user)
+    >>> good_churns = define_classes.label_good_churn(log, user_ids,
+    ...                                               28, 14, 5, 14, 5)
+    '''
+    log = activity
+    if not isinstance(log, activity_log.ActivityLog):
+        log = activity_log.ActivityLog.from_frame(activity)
+    day = activity_log.DAY_NS
+    user_ids = pd.Series(user_ids).drop_duplicates()
+    rank = pd.Series(np.arange(len(user_ids)), index=user_ids.values)
+
+    seg = log.segments()
+    gaps = log.times[1:] - log.times[:-1]
+    leaving = np.flatnonzero((seg[1:] == seg[:-1]) & (gaps > leave_time * day))
+    ev_user = log.user_ids[seg[leaving]].astype(np.int64)
+    wanted = np.isin(ev_user, rank.index.values)
+    leaving = leaving[wanted]
+    ev_user = ev_user[wanted]
+    leave_day = log.times[leaving] - log.times[leaving] % day
+    return_day = log.times[leaving + 1] - log.times[leaving + 1] % day
+    if as_of is not None:
+        cutoff = data_collection.activity_cutoff(as_of).value
+        known = return_day + postchurn_time * day <= cutoff
+        leaving, ev_user = leaving[known], ev_user[known]
+        leave_day, return_day = leave_day[known], return_day[known]
+
+    # activity strictly inside (day - prechurn_time, day) and
+    # (return day, return day + postchurn_time)
+    pre = log.window_counts(ev_user, leave_day - prechurn_time * day, leave_day)
+    post = log.window_counts(ev_user, return_day,
+                             return_day + postchurn_time * day)
+
+    keep = np.flatnonzero((pre > prechurn_act) & (post > postchurn_act))
+    keep = keep[np.argsort(rank.loc[ev_user[keep]].values, kind='mergesort')]
+    good_churns = pd.DataFrame({
+        'user_id': ev_user[keep],
+        'churn_date': pd.to_datetime(leave_day[keep]).date,
+        'No_prechurn_activities': pre[keep],
+        'No_postchurn_activities': post[keep],
+        'dif_time': pd.to_timedelta(gaps[leaving][keep], unit='ns')},
+        columns=['user_id', 'churn_date', 'No_prechurn_activities',
+                 'No_postchurn_activities', 'dif_time'])
+    return good_churns
+
+
+@instrumentation.instrumented
+def idendify_good_churn_vectorized(db, db_user, table, user_ids, leave_time,
+                                   prechurn_time, prechurn_act, postchurn_time,
+                                   postchurn_act, as_of=None):
+    '''
+    Load the activity of a list of users with one query and label good churn
+    with label_good_churn. Same parameters and output as
+    idendify_good_churn_across_user, plus the as_of of label_good_churn.
+
+    Example
+    -------
+    >>> good_churns = define_classes.idendify_good_churn_vectorized(
+    ...     db, db_user, 'activity', user_ids, 28, 14, 5, 14, 5)
+    '''
+    log = activity_log.ActivityLog.load(db, db_user, table, user_ids)
+    return label_good_churn(log, user_ids, leave_time, prechurn_time,
+                            prechurn_act, postchurn_time, postchurn_act, as_of)
+
+
+def last_activity_df(activity):
+    '''
+    Summarize activity loaded in memory into the last activity date and
+    activity count of every user, as queried by idendify_bad_churn_users and
+    idendify_test_users.
+
+    Parameters
+    ----------
+    activity: DataFrame with user_id and date columns
+
+    Returns
+    -------
+    pandas DataFrame with user_id, last_day and activity_count columns
+    '''
+    grouped = activity.groupby('user_id', sort=True)['date']
+    return pd.DataFrame({'user_id': grouped.max().index.values,
+                         'last_day': grouped.max().values,
+                         'activity_count': grouped.size().values},
+                        columns=['user_id', 'last_day', 'activity_count'])
+
+
+@instrumentation.instrumented
+def idendify_bad_churn_users(db, db_user, table, time_gone, prechurn_act,
+                             as_of=data_collection.AS_OF):
     '''
     Create a Pandas DataFrame containing the time users that qualify
     as bad churn given the user_ids, time_gone (days) and  prechurn activity.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
     time_gone: int containing the number of days without activity
     prechurn_act: int containing the number of activities required
+    as_of: day the labels are computed at; later activity is ignored
 
     Returns
     -------
@@ -148,44 +337,69 @@ def idendify_bad_churn_users(db, db_user, table, time_gone, prechurn_act):
     -------
 
     '''
-    date_of_leave = pd.tslib.Timestamp('2016-04-04')-pd.tslib.Timedelta(days=time_gone)
+    date_of_leave = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone)
     date_of_leave = str(date_of_leave.date())
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = '''
-    WITH churn AS
-    (
-    SELECT user_id, MAX(date) AS last_day, count(date) AS activity_count,
-    (MAX(date) > '{}') AS still_in
-    FROM activity
-    GROUP BY user_id
-    )
-    SELECT user_id, last_day, activity_count
-    FROM churn
-    WHERE still_in = 'f'
-    and activity_count > {}
-    ;
-    '''.format(date_of_leave, prechurn_act)
-    cur.execute(sql)
-    bad_churn = pd.DataFrame(cur.fetchall(), columns= ['user_id', 'last_day',
-                                                        'activity_count'])
-    conn.close()
-    return bad_churn
+    if isinstance(db, snapshot.Snapshot):
+        activity = data_collection.load_activity(db, db_user, 'activity')
+        activity = activity[activity.date < data_collection.activity_cutoff(as_of)]
+        churn = last_activity_df(activity)
+        bad_churn = churn[~(churn.last_day > pd.tslib.Timestamp(date_of_leave))
+                          & (churn.activity_count > prechurn_act)]
+        return bad_churn.reset_index(drop=True)
+    return data_collection.collect_chunks(
+        iter_bad_churn_users(db, db_user, table, time_gone, prechurn_act,
+                             as_of=as_of),
+        ['user_id', 'last_day', 'activity_count'])
+
+
+def iter_bad_churn_users(db, db_user, table, time_gone, prechurn_act,
+                         batch_size=10000, as_of=data_collection.AS_OF):
+    '''
+    Streaming version of idendify_bad_churn_users yielding typed DataFrame
+    chunks read through a server-side cursor.
 
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    time_gone: int containing the number of days without activity
+    prechurn_act: int containing the number of activities required
+    batch_size: int containing the number of rows per chunk
+    as_of: day the labels are computed at; later activity is ignored
 
-def idendify_test_users(db, db_user, table, time_gone_low, time_gone_high, prechurn_act):
+    Returns
+    -------
+    generator of pandas DataFrames
+    '''
+    date_of_leave = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone)
+    date_of_leave = str(date_of_leave.date())
+    cutoff = str(data_collection.activity_cutoff(as_of))
+    return data_collection.stream_df(db, db_user, BAD_CHURN_QUERY,
+                                     ['user_id', 'last_day', 'activity_count'],
+                                     (date_of_leave, cutoff, prechurn_act),
+                                     batch_size,
+                                     {'last_day': 'datetime64[ns]',
+                                      'activity_count': 'int64'})
+
+
+@instrumentation.instrumented
+def idendify_test_users(db, db_user, table, time_gone_low, time_gone_high, prechurn_act,
+                        as_of=data_collection.AS_OF):
     '''
     Create a Pandas DataFrame containing users that will serve as test data
     given a time window of interest and prechurn activity.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
     db_user: string containing the user name for login to database
     table: string containing the database table to querry
     time_gone_low: int containing the least number of days without activity
     time_gone_high: int cntaining the most days withouth activity
     prechurn_act: int containing the number of activities required
+    as_of: day the test users are selected at; later activity is ignored
 
     Returns
     -------
@@ -195,32 +409,244 @@ def idendify_test_users(db, db_user, table, time_gone_low, time_gone_high, prech
     -------
 
     '''
-    date__gone_high = pd.tslib.Timestamp('2016-04-04')-pd.tslib.Timedelta(days=time_gone_low)
-    date__gone_low = pd.tslib.Timestamp('2016-04-04')-pd.tslib.Timedelta(days=time_gone_high)
+    date__gone_high = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone_low)
+    date__gone_low = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone_high)
     date__gone_high = str(date__gone_high.date())
     date__gone_low = str(date__gone_low.date())
+    if isinstance(db, snapshot.Snapshot):
+        activity = data_collection.load_activity(db, db_user, 'activity')
+        activity = activity[activity.date < data_collection.activity_cutoff(as_of)]
+        test = last_activity_df(activity)
+        in_window = ((test.last_day > pd.tslib.Timestamp(date__gone_low))
+                     & (test.last_day < pd.tslib.Timestamp(date__gone_high)))
+        test_data = test[in_window & (test.activity_count > prechurn_act)]
+        return test_data.reset_index(drop=True)
+
+    return data_collection.collect_chunks(
+        iter_test_users(db, db_user, table, time_gone_low, time_gone_high,
+                        prechurn_act, as_of=as_of),
+        ['user_id', 'last_day', 'activity_count'])
+
+
+def iter_test_users(db, db_user, table, time_gone_low, time_gone_high,
+                    prechurn_act, batch_size=10000, as_of=data_collection.AS_OF):
+    '''
+    Streaming version of idendify_test_users yielding typed DataFrame chunks
+    read through a server-side cursor.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    time_gone_low: int containing the least number of days without activity
+    time_gone_high: int cntaining the most days withouth activity
+    prechurn_act: int containing the number of activities required
+    batch_size: int containing the number of rows per chunk
+    as_of: day the test users are selected at; later activity is ignored
+
+    Returns
+    -------
+    generator of pandas DataFrames
+    '''
+    date__gone_high = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone_low)
+    date__gone_low = pd.tslib.Timestamp(as_of)-pd.tslib.Timedelta(days=time_gone_high)
+    date__gone_high = str(date__gone_high.date())
+    date__gone_low = str(date__gone_low.date())
+    cutoff = str(data_collection.activity_cutoff(as_of))
+    return data_collection.stream_df(db, db_user, TEST_USERS_QUERY,
+                                     ['user_id', 'last_day', 'activity_count'],
+                                     (date__gone_low, date__gone_high,
+                                      cutoff, prechurn_act), batch_size,
+                                     {'last_day': 'datetime64[ns]',
+                                      'activity_count': 'int64'})
+
+
+def test_user_candidates(db, db_user, table, since, until, watermark=None,
+                         user_ids=()):
+    '''
+    Last activity date and activity count of the users who may have entered
+    or left the test window since the previous run: users with activity
+    dated in [since, until) and users of user_ids with activity after the
+    previous watermark. Only the activity of those users is read, through
+    the (date) and (user_id, date) indexes of the activity table, so the
+    cost follows the number of churn events rather than the user base.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    since: earliest activity date of users that may have newly lapsed
+    until: upper bound of the test window
+    watermark: optional latest activity date seen by the previous run
+    user_ids: list of user_ids scored by the previous run
+
+    Returns
+    -------
+    pandas DataFrame with user_id, last_day and activity_count columns
+
+    Example
+    -------
+    >>> candidates = define_classes.test_user_candidates(db, db_user,
+    ...     'activity', '2016-03-20', '2016-03-21', '2016-04-03', scored_ids)
+    '''
+    since = pd.tslib.Timestamp(since)
+    until = pd.tslib.Timestamp(until)
+    user_ids = [int(u) for u in user_ids]
+    if isinstance(db, snapshot.Snapshot):
+        activity = data_collection.load_activity(db, db_user, 'activity')
+        crossed = (activity.date >= since) & (activity.date < until)
+        if watermark is not None:
+            crossed |= ((activity.date > pd.tslib.Timestamp(watermark))
+                        & activity.user_id.isin(user_ids))
+        candidates = activity.user_id[crossed].unique()
+        return last_activity_df(activity[activity.user_id.isin(candidates)])
+    if watermark is None:
+        watermark = until
+    return data_collection.collect_chunks(
+        data_collection.stream_df(db, db_user, TEST_USER_CANDIDATES_QUERY,
+                                  ['user_id', 'last_day', 'activity_count'],
+                                  (str(since), str(until),
+                                   str(pd.tslib.Timestamp(watermark)), user_ids),
+                                  dtypes={'last_day': 'datetime64[ns]',
+                                          'activity_count': 'int64'}),
+        ['user_id', 'last_day', 'activity_count'])
+
+
+SWEEP_PARAMETERS = ['leave_time', 'prechurn_time', 'prechurn_act',
+                    'postchurn_time', 'postchurn_act', 'time_gone']
+
+
+def label_sweep(activity, grid, user_ids=None, labels=False, as_of=None):
+    '''
+    Good and bad churn class sizes for every combination of a grid of label
+    parameters, computed in one pass over activity already loaded in memory.
+    The leave events and their gaps are found once for the shortest
+    leave_time, the pre and post churn window counts once per
+    prechurn_time and postchurn_time, and the last activity of every user
+    once; each combination is then a set of boolean masks over these
+    arrays. Labels are the same as label_good_churn and
+    idendify_bad_churn_users with the same parameters.
+
+    Parameters
+    ----------
+    activity: ActivityLog, or DataFrame with user_id and date columns
+    grid: dict mapping the names in SWEEP_PARAMETERS to lists of values;
+    missing names take the notebook's values (28, 14, 5, 14, 5, 200)
+    user_ids: optional list of user_ids to scan for good churn, by default
+    every user of the activity
+    labels: bool, if True add good_user_ids and bad_user_ids columns holding
+    the label sets of each combination
+    as_of: optional day the labels are computed at, as in label_good_churn
+    and idendify_bad_churn_users; by default bad churn is computed as of
+    data_collection.AS_OF and every good churn event is kept
+
+    Returns
+    -------
+    pandas DataFrame with one row per combination: the parameters, n_good
+    (users with at least one good churn), n_good_events, n_bad and overlap
+    (users labeled both good and bad churn)
+
+    Example
+    -------
+    >>> log = activity_log.ActivityLog.load(db, db_user)
+    >>> sweep = define_classes.label_sweep(log, {'leave_time': [21, 28, 42],
+    ...                                          'prechurn_act': [3, 5, 10],
+    ...                                          'time_gone': [100, 200]})
+    '''
+    log = activity
+    if not isinstance(log, activity_log.ActivityLog):
+        log = activity_log.ActivityLog.from_frame(activity)
+    defaults = {'leave_time': 28, 'prechurn_time': 14, 'prechurn_act': 5,
+                'postchurn_time': 14, 'postchurn_act': 5, 'time_gone': 200}
+    values = [sorted(set(grid.get(name, [defaults[name]])))
+              for name in SWEEP_PARAMETERS]
+    day = activity_log.DAY_NS
+
+    # leave events of the shortest leave_time; longer ones are subsets
+    seg = log.segments()
+    gaps = log.times[1:] - log.times[:-1]
+    leaving = np.flatnonzero((seg[1:] == seg[:-1])
+                             & (gaps > min(values[0]) * day))
+    if user_ids is not None:
+        wanted = np.isin(log.user_ids[seg[leaving]],
+                         np.asarray(user_ids, dtype=np.int64))
+        leaving = leaving[wanted]
+    ev_pos = seg[leaving]
+    ev_user = log.user_ids[ev_pos].astype(np.int64)
+    ev_gap = gaps[leaving]
+    leave_day = log.times[leaving] - log.times[leaving] % day
+    return_day = log.times[leaving + 1] - log.times[leaving + 1] % day
+    reference = pd.tslib.Timestamp(data_collection.AS_OF if as_of is None else as_of)
+    cutoff = data_collection.activity_cutoff(reference).value
+    pre = dict((t, log.window_counts(ev_user, leave_day - t * day, leave_day))
+               for t in values[1])
+    post = dict((t, log.window_counts(ev_user, return_day,
+                                      return_day + t * day))
+                for t in values[3])
+
+    # activity count and last activity of every user up to the cutoff
+    counts = log.search(log.user_ids, np.full(len(log.user_ids), cutoff))
+    last = log.times[log.offsets[:-1] + np.maximum(counts, 1) - 1]
+
+    rows = []
+    for params in itertools.product(*values):
+        leave_time, prechurn_time, prechurn_act, postchurn_time, \
+            postchurn_act, time_gone = params
+        keep = ((ev_gap > leave_time * day)
+                & (pre[prechurn_time] > prechurn_act)
+                & (post[postchurn_time] > postchurn_act))
+        if as_of is not None:
+            keep &= return_day + postchurn_time * day <= cutoff
+        good = np.zeros(len(log.user_ids), dtype=bool)
+        good[ev_pos[keep]] = True
+        date_of_leave = (reference - pd.tslib.Timedelta(days=time_gone)).normalize()
+        bad = (last <= date_of_leave.value) & (counts > prechurn_act)
+        row = list(params) + [int(good.sum()), int(keep.sum()),
+                              int(bad.sum()), int((good & bad).sum())]
+        if labels:
+            row += [log.user_ids[good].astype(np.int64),
+                    log.user_ids[bad].astype(np.int64)]
+        rows.append(row)
+    columns = SWEEP_PARAMETERS + ['n_good', 'n_good_events', 'n_bad', 'overlap']
+    if labels:
+        columns += ['good_user_ids', 'bad_user_ids']
+    return pd.DataFrame(rows, columns=columns)
+
+
+@instrumentation.instrumented
+def sweep_churn_labels(db, db_user, table, grid, user_ids=None, labels=False,
+                       as_of=None):
+    '''
+    Load the activity once and run label_sweep over a grid of label
+    parameters.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    grid: dict mapping the names in SWEEP_PARAMETERS to lists of values
+    user_ids: optional list of user_ids to scan for good churn
+    labels: bool, if True also return the label sets
+    as_of: optional day the labels are computed at, as in label_sweep
+
+    Returns
+    -------
+    pandas DataFrame, as label_sweep
+
+    Example
+    -------
+    >>> define_classes.sweep_churn_labels(db, db_user, 'activity',
+    ...                                   {'leave_time': [21, 28, 42],
+    ...                                    'postchurn_act': [3, 5]})
+    '''
+    log = activity_log.ActivityLog.load(db, db_user, table)
+    return label_sweep(log, grid, user_ids, labels, as_of)
 
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = '''WITH test AS
-    (
-    SELECT user_id, MAX(date) AS last_day,
-    count(date) AS activity_count,
-    (MAX(date) > '{}' AND MAX(date) < '{}') AS in_window
-    FROM activity
-    GROUP BY user_id
-    )
-    SELECT user_id, last_day, activity_count
-    FROM test
-    WHERE in_window = 't'
-    and activity_count > {}
-    ;
-    '''.format(date__gone_low, date__gone_high, prechurn_act)
-    cur.execute(sql)
-    test_data = pd.DataFrame(cur.fetchall(), columns= ['user_id', 'last_day',
-                                                        'activity_count'])
-    conn.close()
-    return test_data
 
 def add_class_to_df(df, good_churn_user_id):
     '''
@@ -1,8 +1,86 @@
-import psycopg2 as pg2
+import numpy as np
 import pandas as pd
+import activity_log
+import data_collection
+import db_session
+import instrumentation
+import snapshot
 
+FEATURE_COLUMNS = ['user_id', 'response_likes', 'no_responses',
+                   'accepted_connections', 'made_connections',
+                   'send_notification', 'median_away', 'avg_away', 'age']
 
-def feature_maker(db, db_user, user_id, date1, date2):
+# Count queries run by feature_maker, prepared once per pooled connection.
+# Each takes $1 = user_id, $2 = first day and $3 = last day of the window.
+FEATURE_COUNT_QUERIES = [
+    ('feature_answer_likes', '''SELECT count(answer_id)
+    FROM answer_likes
+    WHERE user_id = $1
+    AND created_at < $3
+    AND created_at > $2'''),
+    ('feature_answers', '''SELECT count( id )
+    FROM answers
+    WHERE user_id = $1
+    AND created_at < $3
+    AND created_at > $2'''),
+    ('feature_accepted_connections', '''SELECT count( id )
+    FROM connections
+    WHERE to_user_id = $1
+    AND created_at < $3
+    AND created_at > $2'''),
+    ('feature_made_connections', '''SELECT count( id )
+    FROM connections
+    WHERE from_user_id = $1
+    AND created_at < $3
+    AND created_at > $2'''),
+    ('feature_send_notification', '''SELECT count( id )
+    FROM notifications
+    WHERE sender_id = $1
+    AND created_at < $3
+    AND created_at > $2'''),
+]
+
+USER_STATS_QUERY = '''SELECT median_away, avg_away
+    FROM user_stats
+    WHERE app_user = $1'''
+
+BIRTHDATE_QUERY = '''SELECT birthdate
+    FROM users
+    WHERE id = $1'''
+
+# Set-based version of the feature_maker queries run against the windows
+# uploaded by data_collection.upload_windows.
+FEATURE_BATCH_QUERY = '''
+    SELECT w.ord,
+    (SELECT count(answer_id) FROM answer_likes a
+     WHERE a.user_id = w.user_id
+     AND a.created_at < w.churn_date AND a.created_at > w.pre_churn_date),
+    (SELECT count( id ) FROM answers a
+     WHERE a.user_id = w.user_id
+     AND a.created_at < w.churn_date AND a.created_at > w.pre_churn_date),
+    (SELECT count( id ) FROM connections c
+     WHERE c.to_user_id = w.user_id
+     AND c.created_at < w.churn_date AND c.created_at > w.pre_churn_date),
+    (SELECT count( id ) FROM connections c
+     WHERE c.from_user_id = w.user_id
+     AND c.created_at < w.churn_date AND c.created_at > w.pre_churn_date),
+    (SELECT count( id ) FROM notifications n
+     WHERE n.sender_id = w.user_id
+     AND n.created_at < w.churn_date AND n.created_at > w.pre_churn_date),
+    s.median_away, s.avg_away, u.birthdate
+    FROM {} w
+    LEFT JOIN LATERAL
+    (SELECT median_away, avg_away FROM user_stats
+     WHERE app_user = w.user_id LIMIT 1) s ON true
+    LEFT JOIN LATERAL
+    (SELECT birthdate FROM users WHERE id = w.user_id LIMIT 1) u ON true
+    ORDER BY w.ord
+    ;
+    '''
+
+
+def feature_maker(db, db_user, user_id, date1, date2,
+                  as_of=data_collection.AS_OF):
     '''
     Constructs a feature set for a user in time range
     Calls on following tables: answer_likes, answers, connections, notifications
@@ -10,11 +88,12 @@ def feature_maker(db, db_user, user_id, date1, date2):
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     user_id: int containing user id
     date1: string containing the earliest day of the time window
     date2: string containing the last day of the time window
+    as_of: day the age of the user is computed at
 
     Returns
     -------
@@ -24,100 +103,46 @@ def feature_maker(db, db_user, user_id, date1, date2):
     -------
 
     '''
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    sql = '''SELECT count(answer_id)
-    FROM answer_likes
-    WHERE user_id = {}
-    AND created_at < '{}'
-    AND created_at > '{}'
-    ;
-    '''.format(user_id, date2, date1)
-    cur.execute(sql)
-    answer_likes = cur.fetchall()
+    session = db_session.get_session(db, db_user)
+    window = (int(user_id), str(date1), str(date2))
+    with session.cursor() as cur:
+        counts = []
+        for name, sql in FEATURE_COUNT_QUERIES:
+            session.execute_prepared(cur, name, sql, window)
+            counts.append(cur.fetchall())
+        answer_likes, answers, accepted_connections, made_connections, \
+            send_notification = counts
 
-    sql = '''SELECT count( id )
-    FROM answers
-    WHERE user_id = {}
-    AND created_at < '{}'
-    AND created_at > '{}'
-    ;
-    '''.format(user_id, date2, date1)
-    cur.execute(sql)
-    answers = cur.fetchall()
-
-    sql = '''SELECT count( id )
-    FROM connections
-    WHERE to_user_id = {}
-    AND created_at < '{}'
-    AND created_at > '{}'
-    ;
-    '''.format(user_id, date2, date1)
-    cur.execute(sql)
-    accepted_connections = cur.fetchall()
-
-    sql = '''SELECT count( id )
-    FROM connections
-    WHERE from_user_id = {}
-    AND created_at < '{}'
-    AND created_at > '{}'
-    ;
-    '''.format(user_id, date2, date1)
-    cur.execute(sql)
-    made_connections = cur.fetchall()
-
-    sql = '''SELECT count( id )
-    FROM notifications
-    WHERE sender_id = {}
-    AND created_at < '{}'
-    AND created_at > '{}'
-    ;
-    '''.format(user_id, date2, date1)
-    cur.execute(sql)
-    send_notification = cur.fetchall()
-
-    sql = '''SELECT median_away
-    FROM user_stats
-    WHERE app_user = {}
-    ;
-    '''.format(user_id)
-    cur.execute(sql)
-    median_away = cur.fetchall()
-
-    sql = '''SELECT avg_away
-    FROM user_stats
-    WHERE app_user = {}
-    ;
-    '''.format(user_id)
-    cur.execute(sql)
-    avg_away = cur.fetchall()
+        session.execute_prepared(cur, 'feature_user_stats', USER_STATS_QUERY,
+                                 (int(user_id),))
+        user_stats = cur.fetchall()
 
-    sql = '''SELECT birthdate
-    FROM users
-    WHERE id = {}
-    ;
-    '''.format(user_id)
-    cur.execute(sql)
-    bd = cur.fetchall()
-    age = (pd.tslib.Timestamp('2016-04-04')-bd[0][0])
+        session.execute_prepared(cur, 'feature_birthdate', BIRTHDATE_QUERY,
+                                 (int(user_id),))
+        bd = cur.fetchall()
+    age = (pd.tslib.Timestamp(as_of)-bd[0][0])
     age = age.days/365.0
 
-    conn.close()
     return [user_id, int(answer_likes[0][0]), int(answers[0][0]),
     int(accepted_connections[0][0]), int(made_connections[0][0]),
-    int(send_notification[0][0]), int(median_away[0][0]), int(avg_away[0][0]), age]
+    int(send_notification[0][0]), int(user_stats[0][0]), int(user_stats[0][1]), age]
 
 
-def feature_df_maker(db, db_user, user_df):
+@instrumentation.instrumented
+def feature_df_maker(db, db_user, user_df, batch=False,
+                     as_of=data_collection.AS_OF):
     '''
     Constructs feature DataFrame for list of users.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     user_df: dataframe containing user_id, earliest day of the time window
     (pre_churn_date) and the last day of the time window (churn_date)
+    batch: bool, if True build all rows with one set-based query (see
+    feature_df_batch_maker) instead of calling feature_maker per user.
+    as_of: day the age of the users is computed at
 
     Returns
     -------
@@ -126,11 +151,126 @@ def feature_df_maker(db, db_user, user_df):
     Example
     -------
     '''
+    if batch:
+        return feature_df_batch_maker(db, db_user, user_df, as_of=as_of)
     feature_df = pd.DataFrame(columns= ['user_id', 'response_likes', 'no_responses',
     'accepted_connections', 'made_connections',
     'send_notification', 'median_away', 'avg_away', 'age'])
     for index, user in user_df.iterrows():
-        features = pd.Series(feature_maker(db, db_user, user.user_id, user.pre_churn_date, user.churn_date), index= ['user_id', 'response_likes', 'no_responses',
+        features = pd.Series(feature_maker(db, db_user, user.user_id, user.pre_churn_date, user.churn_date, as_of), index= ['user_id', 'response_likes', 'no_responses',
          'accepted_connections', 'made_connections','send_notification', 'median_away', 'avg_away', 'age'])
         feature_df = feature_df.append(features, ignore_index=True)
     return feature_df
+
+
+@instrumentation.instrumented
+def feature_df_batch_maker(db, db_user, user_df, store=None,
+                           as_of=data_collection.AS_OF):
+    '''
+    Constructs the feature DataFrame for a list of users in one round-trip.
+    The windows are copied into a temporary table and every count, away
+    statistic and birthdate is computed by a single query joined against it.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    user_df: dataframe containing user_id, earliest day of the time window
+    (pre_churn_date) and the last day of the time window (churn_date)
+    store: optional FeatureStore; only windows missing from it are computed
+    as_of: day the age of the users is computed at
+
+    Returns
+    -------
+    Pandas DataFrame containing the features for each user, in the order of
+    user_df and with the same columns as feature_df_maker.
+
+    Example
+    -------
+    >>> feature_df = feature_building.feature_df_batch_maker(db, db_user, X_train)
+    '''
+    if store is not None:
+        watermark = data_collection.activity_watermark(db, db_user)
+        # the age column depends on as_of, so other days are cached apart
+        kind = 'features'
+        if str(pd.tslib.Timestamp(as_of).date()) != data_collection.AS_OF:
+            kind = 'features as of {}'.format(pd.tslib.Timestamp(as_of).date())
+        # the away times are read from user_stats, which is rewritten as
+        # activity arrives, closed windows included
+        kind = '{} (user_stats {})'.format(
+            kind, data_collection.user_stats_version(db, db_user))
+        return store.cached_frame(kind, user_df,
+                                  lambda df: feature_df_batch_maker(db, db_user, df,
+                                                                    as_of=as_of),
+                                  watermark, FEATURE_COLUMNS)
+    if isinstance(db, snapshot.Snapshot):
+        return snapshot_feature_df(db, user_df, as_of)
+    session = db_session.get_session(db, db_user)
+    with session.cursor() as cur:
+        data_collection.upload_windows(cur, user_df, 'feature_windows')
+        cur.execute(FEATURE_BATCH_QUERY.format('feature_windows'))
+        rows = cur.fetchall()
+    features = pd.DataFrame(rows, columns=['ord', 'response_likes',
+                                           'no_responses',
+                                           'accepted_connections',
+                                           'made_connections',
+                                           'send_notification', 'median_away',
+                                           'avg_away', 'birthdate'])
+    features['user_id'] = user_df.user_id.values
+    age = pd.tslib.Timestamp(as_of) - pd.to_datetime(features.birthdate)
+    features['age'] = age.dt.days/365.0
+    return features[['user_id', 'response_likes', 'no_responses',
+                     'accepted_connections', 'made_connections',
+                     'send_notification', 'median_away', 'avg_away', 'age']]
+
+
+def snapshot_feature_df(snap, user_df, as_of=data_collection.AS_OF):
+    '''
+    Constructs the feature DataFrame of feature_df_batch_maker from a local
+    Snapshot instead of the database. Window counts come from ActivityLogs of
+    the activity and connections tables, the away statistics are recomputed
+    from the users' activity and the age from users.birthdate.
+
+    Parameters
+    ----------
+    snap: Snapshot
+    user_df: dataframe containing user_id, pre_churn_date and churn_date
+    as_of: day the age of the users is computed at
+
+    Returns
+    -------
+    Pandas DataFrame containing the features for each user
+    '''
+    user_ids = user_df.user_id.unique()
+    log = activity_log.ActivityLog.load(snap, None, 'activity', user_ids)
+    window = (user_df.user_id.values, user_df.pre_churn_date.values,
+              user_df.churn_date.values)
+    features = pd.DataFrame({'user_id': user_df.user_id.values})
+    for column, kind in [('response_likes', 'answer_likes'),
+                         ('no_responses', 'answers'),
+                         ('made_connections', 'connections'),
+                         ('send_notification', 'notifications')]:
+        features[column] = log.window_counts(*window, activity_type=kind)
+    connections = snap.read('connections', ['to_user_id', 'created_at'])
+    connections.columns = ['user_id', 'date']
+    accepted = activity_log.ActivityLog.from_frame(connections)
+    features['accepted_connections'] = accepted.window_counts(*window)
+
+    stats = log.gap_stats(legacy=False).set_index('app_user')
+    # user_stats stores the away times as nanoseconds; users without
+    # activity are NaN, as the NULLs of the user_stats join
+    for column in ['median_away', 'avg_away']:
+        away = pd.to_timedelta(stats[column].reindex(user_df.user_id.values))
+        missing = pd.isnull(away.values)
+        nanoseconds = away.values.astype('timedelta64[ns]').astype(np.int64)
+        features[column] = (np.where(missing, np.nan, nanoseconds)
+                            if missing.any() else nanoseconds)
+
+    users = snap.read('users', ['id', 'birthdate'], user_ids).drop_duplicates('id')
+    birthdate = users.set_index('id').birthdate.reindex(user_df.user_id.values)
+    age = pd.tslib.Timestamp(as_of) - pd.to_datetime(birthdate)
+    features['age'] = age.dt.days.values/365.0
+    return features[['user_id', 'response_likes', 'no_responses',
+                     'accepted_connections', 'made_connections',
+                     'send_notification', 'median_away', 'avg_away', 'age']]
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import shelve
+import pandas as pd
+
+# Bump when the definition of a cached feature changes so that rows computed
+# by older code are not reused.
+FEATURE_VERSION = 1
+
+
+class FeatureStore(object):
+    '''
+    Cache of computed feature rows keyed by feature kind, definition version,
+    user_id and (pre_churn_date, churn_date) window. Rows are kept in an
+    in-memory LRU tier backed by an on-disk shelve tier.
+
+    Each row remembers the activity watermark (latest activity date) at the
+    time it was computed. A row whose window was still open at that time
+    (watermark before churn_date) is invalidated once the watermark moves,
+    since new activity may have landed inside the window; rows of closed
+    windows are reused forever. Rows that also depend on other mutable data
+    put a version of it in their kind, as feature_df_batch_maker does for
+    the user_stats table.
+
+    Parameters
+    ----------
+    path: optional string containing the file of the on-disk tier
+    capacity: int containing the number of rows kept in memory
+    version: int containing the feature-definition version
+
+    Example
+    -------
+    >>> store = feature_store.FeatureStore('features.db')
+    >>> feature_df = feature_building.feature_df_batch_maker(db, db_user,
+    ...                                                      X_train, store=store)
+    >>> store.stats
+    {'memory_hits': 0, 'disk_hits': 2200, 'misses': 0, 'invalidated': 0}
+    '''
+
+    def __init__(self, path=None, capacity=100000, version=FEATURE_VERSION):
+        self.capacity = capacity
+        self.version = version
+        self.memory = OrderedDict()
+        self.disk = shelve.open(path) if path else None
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'invalidated': 0}
+
+    def _key(self, kind, user_id, pre_churn_date, churn_date):
+        return '{}|{}|{}|{}|{}'.format(kind, self.version, int(user_id),
+                                       pd.tslib.Timestamp(pre_churn_date).isoformat(),
+                                       pd.tslib.Timestamp(churn_date).isoformat())
+
+    def get(self, kind, user_id, pre_churn_date, churn_date, watermark):
+        '''
+        Return a cached row, or None if it is missing or stale.
+
+        Parameters
+        ----------
+        kind: string naming the feature set, e.g. 'features'
+        user_id: int containing user id
+        pre_churn_date: earliest day of the time window
+        churn_date: last day of the time window
+        watermark: latest activity date of the data source
+        '''
+        key = self._key(kind, user_id, pre_churn_date, churn_date)
+        entry = self.memory.get(key)
+        tier = 'memory_hits'
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            tier = 'disk_hits'
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        row, computed_at = entry
+        if (computed_at < pd.tslib.Timestamp(churn_date)
+                and pd.tslib.Timestamp(watermark) > computed_at):
+            self.stats['invalidated'] += 1
+            self.stats['misses'] += 1
+            self.memory.pop(key, None)
+            return None
+        self.stats[tier] += 1
+        self._remember(key, entry)
+        return row
+
+    def put(self, kind, user_id, pre_churn_date, churn_date, row, watermark):
+        '''Cache a row computed when the data source was at watermark.'''
+        key = self._key(kind, user_id, pre_churn_date, churn_date)
+        entry = (row, pd.tslib.Timestamp(watermark))
+        self._remember(key, entry)
+        if self.disk is not None:
+            self.disk[key] = entry
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def cached_frame(self, kind, user_df, compute, watermark, columns):
+        '''
+        Build a DataFrame with one row per user window, computing only the
+        windows that are not cached.
+
+        Parameters
+        ----------
+        kind: string naming the feature set
+        user_df: dataframe containing user_id, pre_churn_date and churn_date
+        compute: function taking the uncached rows of user_df and returning
+        their DataFrame, one row per window in the same order
+        watermark: latest activity date of the data source
+        columns: list of the columns of the result
+
+        Returns
+        -------
+        pandas DataFrame in the order of user_df
+        '''
+        windows = list(zip(user_df.user_id, user_df.pre_churn_date,
+                           user_df.churn_date))
+        rows = [self.get(kind, u, pre, churn, watermark)
+                for u, pre, churn in windows]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            computed = compute(user_df.iloc[missing])
+            for i, row in zip(missing, computed[columns].itertuples(index=False)):
+                rows[i] = tuple(row)
+                self.put(kind, windows[i][0], windows[i][1], windows[i][2],
+                         rows[i], watermark)
+        return pd.DataFrame(rows, columns=columns)
+
+    def close(self):
+        '''Flush and close the on-disk tier.'''
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
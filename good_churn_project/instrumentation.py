@@ -0,0 +1,298 @@
+from functools import wraps
+import json
+import os
+import threading
+import time
+from psycopg2.extensions import cursor as _cursor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Instrumentation is off unless enable() is called; while off, instrumented
+# functions cost one flag check and DB sessions use their normal cursors.
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_events = []
+_stages = {}
+_origin = time.time()
+
+
+def enable():
+    '''
+    Start recording pipeline stages and DB calls.
+
+    Example
+    -------
+    >>> instrumentation.enable()
+    >>> stats_df = data_collection.user_stats_df(db, db_user, 'activity')
+    >>> instrumentation.write_report('report.json')
+    >>> instrumentation.write_trace('trace.json')
+    '''
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    '''Stop recording; what was recorded is kept until reset.'''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''Drop everything recorded so far.'''
+    global _origin
+    with _lock:
+        del _events[:]
+        _stages.clear()
+        _origin = time.time()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _peak_rss_mb():
+    # Process high-water mark; ru_maxrss is in kB on Linux and bytes on macOS.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2.0**20 if os.uname()[0] == 'Darwin' else 2.0**10)
+
+
+def _new_totals():
+    return {'calls': 0, 'seconds': 0.0, 'queries': 0, 'db_seconds': 0.0,
+            'connect_seconds': 0.0, 'rows': 0, 'bytes': 0,
+            'peak_rss_mb': None}
+
+
+def _emit(name, category, start, seconds, args):
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': int((start - _origin) * 1e6), 'dur': int(seconds * 1e6),
+             'pid': os.getpid(), 'tid': threading.current_thread().ident,
+             'args': args}
+    with _lock:
+        _events.append(event)
+
+
+class stage(object):
+    '''
+    Context manager recording a pipeline stage: wall time, and the queries,
+    DB time, connection time, rows and bytes of the DB calls made inside it
+    (nested stages count towards every enclosing stage), and the peak RSS of
+    the process when it ends.
+
+    Example
+    -------
+    >>> with instrumentation.stage('training matrix'):
+    ...     training_matrix = training_nf_matrix.join(training_text_matrix)
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.totals = None
+
+    def __enter__(self):
+        if _enabled:
+            self.totals = _new_totals()
+            _stack().append(self.totals)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.totals is None:
+            return False
+        seconds = time.time() - self.start
+        _stack().pop()
+        totals = self.totals
+        totals['calls'] = 1
+        totals['seconds'] = seconds
+        totals['peak_rss_mb'] = _peak_rss_mb()
+        with _lock:
+            summary = _stages.setdefault(self.name, _new_totals())
+            for key in ['calls', 'seconds', 'queries', 'db_seconds',
+                        'connect_seconds', 'rows', 'bytes']:
+                summary[key] += totals[key]
+            summary['peak_rss_mb'] = max(summary['peak_rss_mb'] or 0,
+                                         totals['peak_rss_mb'] or 0)
+        args = dict((k, v) for k, v in totals.items() if k not in ('calls', 'seconds'))
+        _emit(self.name, 'stage', self.start, seconds, args)
+        self.totals = None
+        return False
+
+
+def instrumented(func=None, name=None):
+    '''
+    Decorator recording every call of a function as a stage named after the
+    function (module.function) unless a name is given.
+
+    Example
+    -------
+    >>> @instrumentation.instrumented
+    ... def user_stats_df(db, db_user, table, bulk=False):
+    ...     ...
+    '''
+    if func is None:
+        return lambda f: instrumented(f, name)
+    stage_name = name or '{}.{}'.format(func.__module__, func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with stage(stage_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record_db(kind, start, seconds, rows=0, nbytes=0, query=True):
+    '''
+    Record one DB call: add it to every open stage of the thread and to the
+    timeline. kind is e.g. 'execute', 'fetch' or 'connect'.
+    '''
+    for totals in _stack():
+        if kind == 'connect':
+            totals['connect_seconds'] += seconds
+        else:
+            totals['db_seconds'] += seconds
+        totals['queries'] += 1 if query else 0
+        totals['rows'] += rows
+        totals['bytes'] += nbytes
+    _emit(kind, 'db', start, seconds, {'rows': rows, 'bytes': nbytes})
+
+
+def _row_bytes(rows):
+    # Approximate size of fetched rows: text length for strings and bytes,
+    # 8 bytes for every other value.
+    total = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes, bytearray, memoryview)):
+                total += len(value)
+            else:
+                total += 8
+    return total
+
+
+class InstrumentedCursor(_cursor):
+    '''
+    psycopg2 cursor recording the time, rows and approximate bytes of every
+    statement and fetch. DBSession switches its connections to this cursor,
+    or to instrumented_cursor of their own cursor factory, while
+    instrumentation is enabled.
+    '''
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).execute(sql, params)
+        finally:
+            nbytes = len(sql) if isinstance(sql, (str, bytes)) else 0
+            record_db('execute', start, time.time() - start, nbytes=nbytes)
+
+    def executemany(self, sql, params):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).executemany(sql, params)
+        finally:
+            record_db('executemany', start, time.time() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.time()
+        before = file.tell() if hasattr(file, 'tell') else 0
+        try:
+            return super(InstrumentedCursor, self).copy_expert(sql, file, size)
+        finally:
+            after = file.tell() if hasattr(file, 'tell') else 0
+            record_db('copy', start, time.time() - start, nbytes=after - before)
+
+    def _fetched(self, start, rows):
+        # fetches of named cursors are round-trips to the server
+        record_db('fetch', start, time.time() - start, len(rows),
+                  _row_bytes(rows), query=self.name is not None)
+        return rows
+
+    def fetchone(self):
+        start = time.time()
+        row = super(InstrumentedCursor, self).fetchone()
+        self._fetched(start, [row] if row is not None else [])
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        if size is None:
+            return self._fetched(start, super(InstrumentedCursor, self).fetchmany())
+        return self._fetched(start, super(InstrumentedCursor, self).fetchmany(size))
+
+    def fetchall(self):
+        start = time.time()
+        return self._fetched(start, super(InstrumentedCursor, self).fetchall())
+
+
+_instrumented_factories = {}
+
+
+def instrumented_cursor(factory):
+    '''
+    InstrumentedCursor recording on top of a connection's cursor factory,
+    e.g. benchmark.CountingCursor, so both keep working.
+
+    Parameters
+    ----------
+    factory: psycopg2 cursor class or None
+
+    Returns
+    -------
+    cursor class
+    '''
+    if factory is None or factory is _cursor or issubclass(factory, InstrumentedCursor):
+        return InstrumentedCursor
+    with _lock:
+        if factory not in _instrumented_factories:
+            _instrumented_factories[factory] = type(
+                'Instrumented' + factory.__name__, (InstrumentedCursor, factory), {})
+        return _instrumented_factories[factory]
+
+
+def report():
+    '''
+    Totals per stage name.
+
+    Returns
+    -------
+    dict mapping stage name to calls, seconds, queries, db_seconds,
+    connect_seconds, other_seconds (time outside the database, e.g. pandas),
+    rows, bytes and peak_rss_mb
+    '''
+    with _lock:
+        stages = dict((name, dict(totals)) for name, totals in _stages.items())
+    for totals in stages.values():
+        totals['other_seconds'] = (totals['seconds'] - totals['db_seconds']
+                                   - totals['connect_seconds'])
+    return stages
+
+
+def write_report(path):
+    '''Write report() as JSON.'''
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+
+
+def write_trace(path):
+    '''
+    Write the recorded stages and DB calls as a Chrome trace, to be opened
+    in chrome://tracing or Perfetto.
+    '''
+    with _lock:
+        events = list(_events)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
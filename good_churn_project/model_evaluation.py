@@ -0,0 +1,297 @@
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import pandas as pd
+import feature_building
+import text_processing
+
+# Model families compared by evaluate_models: (name, estimator class or its
+# dotted path, grid of hyperparameters). The notebook's model is the first
+# random_forest entry. Paths are imported when the models are fit.
+MODEL_GRIDS = [
+    ('random_forest', 'sklearn.ensemble.RandomForestClassifier',
+     {'n_estimators': [100], 'class_weight': ['balanced'],
+      'min_samples_leaf': [1, 5]}),
+    ('extra_trees', 'sklearn.ensemble.ExtraTreesClassifier',
+     {'n_estimators': [100], 'class_weight': ['balanced'],
+      'min_samples_leaf': [1, 5]}),
+    ('gradient_boosting', 'sklearn.ensemble.GradientBoostingClassifier',
+     {'n_estimators': [100], 'learning_rate': [0.05, 0.1], 'max_depth': [3]}),
+    ('ada_boost', 'sklearn.ensemble.AdaBoostClassifier', {'n_estimators': [100]}),
+    ('decision_tree', 'sklearn.tree.DecisionTreeClassifier',
+     {'class_weight': ['balanced'], 'min_samples_leaf': [5]}),
+    ('logistic_regression', 'sklearn.linear_model.LogisticRegression',
+     {'class_weight': ['balanced'], 'C': [1.0], 'max_iter': [1000]}),
+]
+
+# The FeatureMatrix opened by each worker process.
+_matrix = None
+
+
+def save_matrix(path, features, texts, y):
+    '''
+    Persist a feature matrix for evaluate_models: the numeric features as a
+    float64 .npy array, the classes, and the response texts as a sparse
+    term count matrix (CountVectorizer with the English stop words of
+    text_processing). The text is stored as counts rather than TF-IDF/SVD
+    features so the text model can be fit inside each fold.
+
+    Parameters
+    ----------
+    path: string containing the directory to write to
+    features: DataFrame of numeric features, one row per user window
+    texts: list of response texts, in the order of features
+    y: list of classes, in the order of features
+
+    Returns
+    -------
+    FeatureMatrix opened on path
+    '''
+    from sklearn.feature_extraction.text import CountVectorizer
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    numeric = features.fillna(0).astype(np.float64)
+    np.save(os.path.join(path, 'numeric.npy'), numeric.values)
+    np.save(os.path.join(path, 'y.npy'), np.asarray(y).astype(np.int64))
+    counts = CountVectorizer(stop_words='english').fit_transform(texts).tocsr()
+    counts.sort_indices()
+    for name in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(path, 'counts_{}.npy'.format(name)),
+                getattr(counts, name))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'columns': [str(c) for c in numeric.columns],
+                   'n_terms': counts.shape[1]}, f)
+    return FeatureMatrix(path)
+
+
+def build_matrix(db, db_user, user_df, y, path):
+    '''
+    Build the notebook's features of a set of user windows once and persist
+    them with save_matrix.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    user_df: dataframe containing user_id, pre_churn_date and churn_date
+    y: list of classes, in the order of user_df
+    path: string containing the directory to write to
+
+    Returns
+    -------
+    FeatureMatrix opened on path
+
+    Example
+    -------
+    >>> matrix = model_evaluation.build_matrix(db, db_user, X, y, 'cv_matrix')
+    >>> results = model_evaluation.evaluate_models('cv_matrix')
+    '''
+    features = feature_building.feature_df_maker(db, db_user, user_df, batch=True)
+    response_df = text_processing.fetch_response_text(db, db_user, user_df)
+    features = features.drop('user_id', axis=1)
+    features['response_len'] = response_df.response_len.values
+    return save_matrix(path, features, response_df.response_text.values, y)
+
+
+class FeatureMatrix(object):
+    '''
+    Feature matrix written by save_matrix, opened as memory-mapped arrays so
+    that processes opening the same path share its pages instead of holding
+    copies.
+
+    Parameters
+    ----------
+    path: string containing the directory written by save_matrix
+    '''
+
+    def __init__(self, path):
+        from scipy import sparse
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.numeric = np.load(os.path.join(path, 'numeric.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+        arrays = [np.load(os.path.join(path, 'counts_{}.npy'.format(name)),
+                          mmap_mode='r')
+                  for name in ['data', 'indices', 'indptr']]
+        self.counts = sparse.csr_matrix(tuple(arrays),
+                                        shape=(len(self.y), meta['n_terms']),
+                                        copy=False)
+
+    def __len__(self):
+        return len(self.y)
+
+    def fold_path(self, fold, part):
+        return os.path.join(self.path, 'fold_{}_{}.npy'.format(fold, part))
+
+
+def text_features(counts, train, test, no_SVs, random_state=None):
+    '''
+    TF-IDF and SVD text features of a train/test split, fit on the training
+    rows only. The training vocabulary and IDF weights are those a
+    TfidfVectorizer fit on the training texts would learn.
+
+    Parameters
+    ----------
+    counts: sparse term count matrix of all rows
+    train: array of training row positions
+    test: array of test row positions
+    no_SVs: int containing the number of singular values to retain
+    random_state: int seeding the SVD
+
+    Returns
+    -------
+    train_svd, test_svd: arrays with no_SVs columns
+    '''
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.feature_extraction.text import TfidfTransformer
+    train_counts = counts[train]
+    vocabulary = np.flatnonzero(train_counts.getnnz(axis=0))
+    train_counts = train_counts[:, vocabulary]
+    tfidf = TfidfTransformer().fit(train_counts)
+    svd = TruncatedSVD(n_components=no_SVs, random_state=random_state)
+    train_svd = svd.fit_transform(tfidf.transform(train_counts))
+    test_svd = svd.transform(tfidf.transform(counts[test][:, vocabulary]))
+    return train_svd, test_svd
+
+
+def _estimator(spec):
+    # estimator class from a class or its dotted path
+    if not isinstance(spec, str):
+        return spec
+    module, name = spec.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def _init_worker(path):
+    global _matrix
+    _matrix = FeatureMatrix(path)
+
+
+def _fold_task(task):
+    # Fit the text model of one fold and write its train and test matrices.
+    fold, train, test, no_SVs, random_state = task
+    start = time.time()
+    train_svd, test_svd = text_features(_matrix.counts, train, test, no_SVs,
+                                        random_state)
+    np.save(_matrix.fold_path(fold, 'train'),
+            np.hstack([_matrix.numeric[train], train_svd]))
+    np.save(_matrix.fold_path(fold, 'test'),
+            np.hstack([_matrix.numeric[test], test_svd]))
+    return time.time() - start
+
+
+def _model_task(task):
+    from sklearn.metrics import roc_auc_score
+    name, estimator, params, fold, train, test, random_state = task
+    X_train = np.load(_matrix.fold_path(fold, 'train'), mmap_mode='r')
+    X_test = np.load(_matrix.fold_path(fold, 'test'), mmap_mode='r')
+    model = _estimator(estimator)(**params)
+    defaults = model.get_params()
+    # one core per task for the parallel ensembles; the pool provides the
+    # parallelism
+    if 'n_jobs' in defaults and 'n_estimators' in defaults and 'n_jobs' not in params:
+        model.set_params(n_jobs=1)
+    if 'random_state' in defaults and 'random_state' not in params:
+        model.set_params(random_state=random_state)
+    start = time.time()
+    model.fit(X_train, _matrix.y[train])
+    fit_seconds = time.time() - start
+    start = time.time()
+    probability = model.predict_proba(X_test)[:, 1]
+    predict_seconds = time.time() - start
+    return {'model': name, 'params': json.dumps(params, sort_keys=True),
+            'fold': fold, 'auc': roc_auc_score(_matrix.y[test], probability),
+            'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds,
+            'n_train': len(train), 'n_test': len(test)}
+
+
+def _run(func, tasks, path, n_workers):
+    if n_workers == 1:
+        _init_worker(path)
+        return [func(task) for task in tasks]
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                initargs=(path,))
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def evaluate_models(path, models=None, n_folds=5, no_SVs=15, n_workers=None,
+                    random_state=67):
+    '''
+    Stratified k-fold cross-validation of several model families and
+    hyperparameter grids on a feature matrix written by save_matrix. The
+    text TF-IDF/SVD model is fit inside each fold on its training rows, then
+    every (model, hyperparameters, fold) is fit in a process pool. Workers
+    open the matrix and the fold matrices as memory-mapped files, so they
+    share them without copying.
+
+    Parameters
+    ----------
+    path: string containing the directory written by save_matrix
+    models: list of (name, estimator class or dotted path, dict of lists of
+    hyperparameter values), MODEL_GRIDS by default
+    n_folds: int containing the number of folds
+    no_SVs: int containing the number of singular values of the text model
+    n_workers: int containing the number of processes, all cores by default
+    random_state: int seeding the folds, the SVD and the models
+
+    Returns
+    -------
+    pandas DataFrame with one row per model, hyperparameters and fold: model,
+    params, fold, auc, fit_seconds, predict_seconds, text_seconds (fit of the
+    fold's text model), n_train and n_test
+
+    Example
+    -------
+    >>> results = model_evaluation.evaluate_models('cv_matrix', n_folds=5)
+    >>> model_evaluation.summarize(results)
+    '''
+    from sklearn.model_selection import StratifiedKFold
+    matrix = FeatureMatrix(path)
+    models = MODEL_GRIDS if models is None else models
+    n_workers = n_workers or multiprocessing.cpu_count()
+    splitter = StratifiedKFold(n_splits=n_folds, shuffle=True,
+                               random_state=random_state)
+    folds = list(splitter.split(np.zeros(len(matrix)), matrix.y))
+    text_seconds = _run(_fold_task,
+                        [(k, train, test, no_SVs, random_state)
+                         for k, (train, test) in enumerate(folds)],
+                        path, n_workers)
+    tasks = []
+    for name, estimator, grid in models:
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[key] for key in keys]):
+            params = dict(zip(keys, values))
+            for k, (train, test) in enumerate(folds):
+                tasks.append((name, estimator, params, k, train, test,
+                              random_state))
+    try:
+        results = pd.DataFrame(_run(_model_task, tasks, path, n_workers))
+    finally:
+        for k in range(len(folds)):
+            for part in ['train', 'test']:
+                os.remove(matrix.fold_path(k, part))
+    results['text_seconds'] = np.asarray(text_seconds)[results.fold.values]
+    return results[['model', 'params', 'fold', 'auc', 'fit_seconds',
+                    'predict_seconds', 'text_seconds', 'n_train', 'n_test']]
+
+
+def summarize(results):
+    '''
+    Mean and standard deviation of the AUC and mean timings of every model
+    and hyperparameters of evaluate_models, best AUC first.
+    '''
+    summary = results.groupby(['model', 'params']).agg(
+        auc_mean=('auc', 'mean'), auc_std=('auc', 'std'),
+        fit_seconds=('fit_seconds', 'mean'),
+        predict_seconds=('predict_seconds', 'mean'))
+    return summary.sort_values('auc_mean', ascending=False).reset_index()
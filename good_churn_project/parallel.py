@@ -0,0 +1,219 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+import activity_log
+import data_collection
+import db_session
+import define_classes
+import feature_building
+import snapshot
+import text_processing
+
+
+def shard_users(user_ids, n_shards):
+    '''
+    Split user_ids into contiguous user_id ranges of similar size.
+
+    Parameters
+    ----------
+    user_ids: list of user_ids
+    n_shards: int containing the number of shards
+
+    Returns
+    -------
+    list of sorted int64 arrays, one per non-empty shard
+    '''
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    return [shard for shard in np.array_split(user_ids, n_shards) if len(shard)]
+
+
+def _source(db, db_user):
+    # Describe the data source so each worker can open its own connection;
+    # pooled connections cannot be shared across processes.
+    if isinstance(db, db_session.DBSession):
+        return ('db', db.db, db.db_user, db.host)
+    if isinstance(db, snapshot.Snapshot):
+        return ('snapshot', db.path)
+    return ('db', db, db_user, 'localhost')
+
+
+def _open(source):
+    if source[0] == 'snapshot':
+        return snapshot.Snapshot(source[1]), None
+    return db_session.get_session(source[1], source[2], host=source[3]), None
+
+
+def _init_worker():
+    # Forget sessions inherited through fork without closing them, closing
+    # would tear down the parent's sockets.
+    db_session._sessions.clear()
+
+
+def _user_stats_task(task):
+    source, table, user_ids = task
+    db, db_user = _open(source)
+    return activity_log.ActivityLog.load(db, db_user, table, user_ids).gap_stats()
+
+
+def _good_churn_task(task):
+    source, table, user_ids, params, as_of = task
+    db, db_user = _open(source)
+    return define_classes.idendify_good_churn_vectorized(db, db_user, table,
+                                                         user_ids, *params,
+                                                         as_of=as_of)
+
+
+def _feature_task(task):
+    source, user_df, as_of = task
+    db, db_user = _open(source)
+    return feature_building.feature_df_batch_maker(db, db_user, user_df,
+                                                   as_of=as_of)
+
+
+def _text_task(task):
+    source, user_df = task
+    db, db_user = _open(source)
+    return text_processing.fetch_response_text(db, db_user, user_df)
+
+
+def _run(func, tasks, n_workers):
+    if n_workers == 1:
+        # in process: the caller's sessions are reused, not forgotten
+        return [func(task) for task in tasks]
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker)
+    try:
+        # map keeps the results in task order
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _window_shards(user_df, n_workers):
+    # Split a window DataFrame by user_id range, remembering row positions.
+    user_df = user_df.reset_index(drop=True)
+    shards = shard_users(user_df.user_id, n_workers)
+    position = np.searchsorted([s[-1] for s in shards],
+                               user_df.user_id.values.astype(np.int64))
+    return [user_df[position == i] for i in range(len(shards))]
+
+
+def _concat(results, columns):
+    # pd.concat raises on an empty list, e.g. when there are no users
+    if not results:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(results, ignore_index=True)
+
+
+def _in_original_order(results, shards, columns):
+    if not shards:
+        return pd.DataFrame(columns=columns)
+    rows = np.concatenate([shard.index.values for shard in shards])
+    merged = _concat(results, columns)
+    return merged.iloc[np.argsort(rows, kind='mergesort')].reset_index(drop=True)
+
+
+def parallel_user_stats(db, db_user, table, user_ids, n_workers=None):
+    '''
+    Compute the user_stats DataFrame with a process pool, each worker
+    loading and summarizing the activity of one user_id range.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    table: string containing the database table to querry
+    user_ids: list of user_ids
+    n_workers: int containing the number of processes, defaults to the
+    number of cores
+
+    Returns
+    -------
+    DataFrame containing the activity statistics ordered by user_id, as
+    returned by data_collection.user_stats_df in bulk mode.
+
+    Example
+    -------
+    >>> users = data_collection.user_df_maker(db, db_user, 'activity')
+    >>> stats_df = parallel.parallel_user_stats(db, db_user, 'activity',
+    ...                                         users.user_id, n_workers=32)
+    '''
+    n_workers = n_workers or multiprocessing.cpu_count()
+    source = _source(db, db_user)
+    shards = shard_users([u for u in user_ids if u > 0], n_workers)
+    results = _run(_user_stats_task,
+                   [(source, table, list(shard)) for shard in shards], n_workers)
+    return _concat(results, data_collection.USER_STATS_COLUMNS)
+
+
+def parallel_good_churn(db, db_user, table, user_ids, leave_time,
+                        prechurn_time, prechurn_act, postchurn_time,
+                        postchurn_act, n_workers=None,
+                        as_of=data_collection.AS_OF):
+    '''
+    Label good churn with a process pool, each worker running
+    define_classes.idendify_good_churn_vectorized over one user_id range.
+    Same parameters and output (including row order) as
+    idendify_good_churn_vectorized, plus n_workers; as_of defaults to the
+    export day.
+
+    Example
+    -------
+    >>> good_churns = parallel.parallel_good_churn(db, db_user, 'activity',
+    ...                                            user_ids, 28, 14, 5, 14, 5)
+    '''
+    n_workers = n_workers or multiprocessing.cpu_count()
+    source = _source(db, db_user)
+    params = (leave_time, prechurn_time, prechurn_act, postchurn_time,
+              postchurn_act)
+    shards = shard_users(user_ids, n_workers)
+    results = _run(_good_churn_task,
+                   [(source, table, list(shard), params, as_of)
+                    for shard in shards],
+                   n_workers)
+    good_churns = _concat(results, ['user_id', 'churn_date',
+                                    'No_prechurn_activities',
+                                    'No_postchurn_activities', 'dif_time'])
+    rank = pd.Series(np.arange(len(user_ids)), index=list(user_ids))
+    rank = rank[~rank.index.duplicated()]
+    order = np.argsort(rank.loc[good_churns.user_id.values].values, kind='mergesort')
+    return good_churns.iloc[order].reset_index(drop=True)
+
+
+def parallel_feature_df(db, db_user, user_df, n_workers=None,
+                        as_of=data_collection.AS_OF):
+    '''
+    Build the feature DataFrame of feature_building.feature_df_batch_maker
+    with a process pool, one user_id range per worker, the age feature
+    computed at as_of. Rows are returned in the order of user_df.
+
+    Example
+    -------
+    >>> feature_df = parallel.parallel_feature_df(db, db_user, X_train)
+    '''
+    n_workers = n_workers or multiprocessing.cpu_count()
+    source = _source(db, db_user)
+    shards = _window_shards(user_df, n_workers)
+    results = _run(_feature_task, [(source, shard, as_of) for shard in shards],
+                   n_workers)
+    return _in_original_order(results, shards, feature_building.FEATURE_COLUMNS)
+
+
+def parallel_response_text(db, db_user, user_df, n_workers=None):
+    '''
+    Fetch the response text of text_processing.fetch_response_text with a
+    process pool, one user_id range per worker. Rows are returned in the
+    order of user_df.
+
+    Example
+    -------
+    >>> response_df = parallel.parallel_response_text(db, db_user, X_train)
+    '''
+    n_workers = n_workers or multiprocessing.cpu_count()
+    source = _source(db, db_user)
+    shards = _window_shards(user_df, n_workers)
+    results = _run(_text_task, [(source, shard) for shard in shards], n_workers)
+    return _in_original_order(results, shards,
+                              ['user_id', 'response_text', 'response_count',
+                               'response_len'])
@@ -0,0 +1,306 @@
+import importlib
+import re
+import pandas as pd
+import db_session
+
+ACTIVITY_COLUMNS = '''user_id integer,
+    date timestamp,
+    id bigint,
+    type text'''
+
+# Indexes of the activity table. The unique index holds the partition key
+# (date) so it can be created on a partitioned table; the others cover the
+# per-user range queries (activity_dates_range_df reads date and id,
+# ActivityLog.load reads date and type) and the date range scans of the
+# churn queries, so both can be answered with index-only scans.
+ACTIVITY_INDEXES = [
+    ('activity_type_id_date_idx',
+     'CREATE UNIQUE INDEX IF NOT EXISTS activity_type_id_date_idx '
+     'ON activity (type, id, date)'),
+    ('activity_user_id_date_covering_idx',
+     'CREATE INDEX IF NOT EXISTS activity_user_id_date_covering_idx '
+     'ON activity (user_id, date) INCLUDE (id, type)'),
+    ('activity_date_user_id_idx',
+     'CREATE INDEX IF NOT EXISTS activity_date_user_id_idx '
+     'ON activity (date) INCLUDE (user_id)'),
+]
+
+# Indexes replaced by the covering ones above.
+SUPERSEDED_INDEXES = ['activity_user_id_date_idx', 'activity_date_idx']
+
+# Indexes of the source and lookup tables read by feature_building: each
+# count query filters on a user column and a created_at range and counts a
+# column included in the index.
+SOURCE_INDEXES = [
+    ('answers_user_id_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS answers_user_id_created_at_idx '
+     'ON answers (user_id, created_at) INCLUDE (id)'),
+    ('answer_likes_user_id_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS answer_likes_user_id_created_at_idx '
+     'ON answer_likes (user_id, created_at) INCLUDE (answer_id)'),
+    ('connections_from_user_id_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS connections_from_user_id_created_at_idx '
+     'ON connections (from_user_id, created_at) INCLUDE (id)'),
+    ('connections_to_user_id_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS connections_to_user_id_created_at_idx '
+     'ON connections (to_user_id, created_at) INCLUDE (id)'),
+    ('notifications_sender_id_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS notifications_sender_id_created_at_idx '
+     'ON notifications (sender_id, created_at) INCLUDE (id)'),
+    ('user_stats_app_user_idx',
+     'CREATE INDEX IF NOT EXISTS user_stats_app_user_idx '
+     'ON user_stats (app_user) INCLUDE (median_away, avg_away)'),
+    ('users_id_birthdate_idx',
+     'CREATE INDEX IF NOT EXISTS users_id_birthdate_idx '
+     'ON users (id) INCLUDE (birthdate)'),
+]
+
+# Queries checked by explain_hot_queries: (name, dotted path of the SQL the
+# project runs, names of its positional placeholders in order, relation put
+# in place of the {} table of the SQL). The SQL is imported by hot_queries
+# and its placeholders renamed to the %(name)s parameters of
+# explain_hot_queries.
+HOT_QUERIES = [
+    ('activity_dates_range', 'data_collection.ACTIVITY_DATES_RANGE_QUERY',
+     ['user_id', 'date1', 'date2'], 'activity'),
+    ('test_user_candidates', 'define_classes.TEST_USER_CANDIDATES_QUERY',
+     ['date1', 'date2', 'date1', 'user_ids'], 'activity'),
+    ('count_active', 'data_collection.COUNT_ACTIVE_QUERY', ['date2'],
+     'activity'),
+    ('test_users', 'define_classes.TEST_USERS_QUERY',
+     ['date1', 'date2', 'cutoff', 'prechurn_act'], 'activity'),
+    ('bad_churn', 'define_classes.BAD_CHURN_QUERY',
+     ['date1', 'cutoff', 'prechurn_act'], 'activity'),
+    ('feature_batch', 'feature_building.FEATURE_BATCH_QUERY', [],
+     '(SELECT 0 AS ord, %(user_id)s AS user_id, %(date2)s AS churn_date, '
+     '%(date1)s AS pre_churn_date)'),
+]
+
+# Placeholders of feature_building.FEATURE_COUNT_QUERIES, in order.
+FEATURE_QUERY_PARAMS = ['user_id', 'date1', 'date2']
+
+
+def _named(sql, names):
+    # $1, $2 ... or successive %s placeholders renamed to %(name)s
+    sql = re.sub(r'\$(\d)', lambda m: '%({})s'.format(names[int(m.group(1)) - 1]),
+                 sql)
+    names = iter(names)
+    return re.sub(r'%s', lambda m: '%({})s'.format(next(names)), sql)
+
+
+def hot_queries():
+    '''
+    The SQL of HOT_QUERIES followed by feature_building.FEATURE_COUNT_QUERIES,
+    with their placeholders renamed user_id, date1, date2, cutoff,
+    prechurn_act and user_ids. The feature batch query reads a single window
+    of user_id from date1 to date2 in place of the uploaded windows.
+
+    Returns
+    -------
+    list of (name, sql) pairs
+    '''
+    # imported here: these modules import data_collection, which imports
+    # this module
+    import feature_building
+    queries = []
+    for name, path, names, table in HOT_QUERIES:
+        module, attribute = path.rsplit('.', 1)
+        sql = getattr(importlib.import_module(module), attribute)
+        queries.append((name, _named(sql, names).replace('{}', table)))
+    return queries + [(name, _named(sql, FEATURE_QUERY_PARAMS))
+                      for name, sql in feature_building.FEATURE_COUNT_QUERIES]
+
+
+def is_partitioned(cur, table='activity'):
+    '''True if table exists and is a partitioned table.'''
+    cur.execute('SELECT relkind FROM pg_class WHERE relname = %s', (table,))
+    rows = cur.fetchall()
+    return bool(rows) and rows[0][0] == 'p'
+
+
+def month_starts(first, last):
+    '''First day of every month from the month of first to that of last.'''
+    first = pd.tslib.Timestamp(first).normalize().replace(day=1)
+    last = pd.tslib.Timestamp(last)
+    return list(pd.date_range(first, last, freq='MS'))
+
+
+def partition_name(month):
+    return 'activity_{:%Y_%m}'.format(month)
+
+
+def ensure_activity_partitions(cur, first, last):
+    '''
+    Create the monthly partitions of the activity table holding dates from
+    first to last that do not exist yet.
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor borrowed from a DBSession
+    first: earliest date that will be inserted
+    last: latest date that will be inserted
+
+    Returns
+    -------
+    list of the partition names
+    '''
+    names = []
+    for month in month_starts(first, last):
+        end = month + pd.DateOffset(months=1)
+        name = partition_name(month)
+        cur.execute('''CREATE TABLE IF NOT EXISTS {} PARTITION OF activity
+        FOR VALUES FROM (%s) TO (%s)'''.format(name),
+                    (str(month.date()), str(end.date())))
+        names.append(name)
+    return names
+
+
+def create_activity_indexes(cur):
+    '''Create the ACTIVITY_INDEXES on the cursor's connection.'''
+    for name, sql in ACTIVITY_INDEXES:
+        cur.execute(sql)
+
+
+def partition_activity(db, db_user):
+    '''
+    Convert an existing activity table (e.g. built by
+    data_collection.create_activity_table) into a table range-partitioned by
+    month on date, with the ACTIVITY_INDEXES. Queries filtering on date then
+    only read the partitions of the months they cover. Runs in one
+    transaction; data_collection.update_activity_table adds the partitions
+    of new months as rows arrive.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+
+    Returns
+    -------
+    list of the partition names
+
+    Example
+    -------
+    >>> schema.partition_activity(db, db_user)
+    ['activity_2015_01', 'activity_2015_02', ...]
+    '''
+    session = db_session.get_session(db, db_user)
+    with session.cursor() as cur:
+        if is_partitioned(cur):
+            cur.execute('SELECT MIN(date), MAX(date) FROM activity')
+            first, last = cur.fetchall()[0]
+            return [] if first is None else [partition_name(m)
+                                             for m in month_starts(first, last)]
+        cur.execute('LOCK TABLE activity IN ACCESS EXCLUSIVE MODE')
+        cur.execute('ALTER TABLE activity RENAME TO activity_unpartitioned')
+        cur.execute('''CREATE TABLE activity (
+    {}
+    ) PARTITION BY RANGE (date)'''.format(ACTIVITY_COLUMNS))
+        cur.execute('SELECT MIN(date), MAX(date) FROM activity_unpartitioned')
+        first, last = cur.fetchall()[0]
+        names = []
+        if first is not None:
+            names = ensure_activity_partitions(cur, first, last)
+        cur.execute('''INSERT INTO activity (user_id, date, id, type)
+        SELECT user_id, date, id, type FROM activity_unpartitioned
+        WHERE date IS NOT NULL''')
+        cur.execute('DROP TABLE activity_unpartitioned')
+        create_activity_indexes(cur)
+        cur.execute('ANALYZE activity')
+    return names
+
+
+def create_covering_indexes(db, db_user):
+    '''
+    Create the covering ACTIVITY_INDEXES and SOURCE_INDEXES and drop the
+    plain activity indexes they replace.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+
+    Returns
+    -------
+    list of the index names
+    '''
+    session = db_session.get_session(db, db_user)
+    with session.cursor() as cur:
+        create_activity_indexes(cur)
+        for name, sql in SOURCE_INDEXES:
+            cur.execute(sql)
+        for name in SUPERSEDED_INDEXES:
+            cur.execute('DROP INDEX IF EXISTS {}'.format(name))
+        for table in ['activity', 'answers', 'answer_likes', 'connections',
+                      'notifications', 'user_stats', 'users']:
+            cur.execute('ANALYZE {}'.format(table))
+    return [name for name, sql in ACTIVITY_INDEXES + SOURCE_INDEXES]
+
+
+def explain(db, db_user, sql, params=None, analyze=False):
+    '''
+    Return the plan of a query as a list of lines.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    sql: string containing the query
+    params: sequence or dict of values bound to the placeholders
+    analyze: bool, if True run the query and report actual times and buffers
+    '''
+    options = 'ANALYZE, BUFFERS' if analyze else 'COSTS'
+    session = db_session.get_session(db, db_user)
+    rows = session.query('EXPLAIN ({}) {}'.format(options, sql), params)
+    return [row[0] for row in rows]
+
+
+def explain_hot_queries(db, db_user, user_id=None, date1=None, date2=None,
+                        analyze=False):
+    '''
+    EXPLAIN the project's hot queries (hot_queries()) and summarize whether
+    they use index-only scans, fall back to sequential scans and how many
+    activity partitions they read.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    user_id: int containing the user of the per-user queries; defaults to the
+    user of the latest activity
+    date1: start of the date range; defaults to 14 days before date2
+    date2: end of the date range; defaults to the latest activity date
+    analyze: bool, if True run the queries (EXPLAIN ANALYZE)
+
+    Returns
+    -------
+    DataFrame with query, index_only_scan, seq_scans, partitions and plan
+    columns
+
+    Example
+    -------
+    >>> schema.explain_hot_queries(db, db_user)[['query', 'index_only_scan',
+    ...                                          'partitions']]
+    '''
+    session = db_session.get_session(db, db_user)
+    if user_id is None or date2 is None:
+        latest = session.query('''SELECT user_id, date FROM activity
+        ORDER BY date DESC LIMIT 1''')[0]
+        user_id = latest[0] if user_id is None else user_id
+        date2 = latest[1] if date2 is None else date2
+    date2 = pd.tslib.Timestamp(date2)
+    date1 = date2 - pd.tslib.Timedelta(days=14) if date1 is None else pd.tslib.Timestamp(date1)
+    params = {'user_id': int(user_id), 'date1': date1.to_pydatetime(),
+              'date2': date2.to_pydatetime(),
+              'cutoff': (date2 + pd.tslib.Timedelta(days=1)).to_pydatetime(),
+              'prechurn_act': 5, 'user_ids': [int(user_id)]}
+    rows = []
+    for name, sql in hot_queries():
+        plan = explain(db, db_user, sql, params, analyze)
+        text = '\n'.join(plan)
+        rows.append([name, 'Index Only Scan' in text,
+                     text.count('Seq Scan'),
+                     len(set(re.findall(r'on (activity_\d{4}_\d{2})', text))),
+                     text])
+    return pd.DataFrame(rows, columns=['query', 'index_only_scan', 'seq_scans',
+                                       'partitions', 'plan'])
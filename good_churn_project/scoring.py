@@ -0,0 +1,360 @@
+import json
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import data_collection
+import db_session
+import define_classes
+import feature_building
+import snapshot
+import text_processing
+
+# Probability above which a user is labeled good churn, chosen at ~0.8 TPR.
+THRESHOLD = 0.22
+
+# Number of days before the last activity used as the feature window.
+PRE_CHURN_DAYS = 14
+
+
+def save_model(path, vectorizer, svd, classifier, columns,
+               threshold=THRESHOLD, pre_churn_days=PRE_CHURN_DAYS):
+    '''
+    Save the fitted text models and classifier for GoodChurnScorer.
+
+    Parameters
+    ----------
+    path: string containing the file to write
+    vectorizer: TF-IDF model from text_processing.train_text_clusters
+    svd: SVD model from text_processing.train_text_clusters
+    classifier: fitted classifier with predict_proba
+    columns: list of the training matrix columns, in order
+    threshold: float probability above which a user is good churn
+    pre_churn_days: int containing the length of the feature window in days
+
+    Example
+    -------
+    >>> scoring.save_model('good_churn.pkl', vectorizer, svd, rfc, X_train.columns)
+    '''
+    model = {'vectorizer': vectorizer, 'svd': svd, 'classifier': classifier,
+             'columns': list(columns), 'threshold': threshold,
+             'pre_churn_days': pre_churn_days}
+    with open(path, 'wb') as f:
+        pickle.dump(model, f, pickle.HIGHEST_PROTOCOL)
+
+
+class GoodChurnScorer(object):
+    '''
+    Score users for good churn with models loaded once. Features are built
+    in bulk (feature_building.feature_df_batch_maker and
+    text_processing.fetch_response_text) for each batch of users, joined as
+    in the training notebook and passed to predict_proba in vectorized
+    batches. The window of each user is the pre_churn_days before their last
+    activity.
+
+    Parameters
+    ----------
+    path: string containing the file written by save_model
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    batch_size: int containing the number of users scored per batch
+    store: optional FeatureStore caching the features
+
+    Example
+    -------
+    >>> scorer = scoring.GoodChurnScorer('good_churn.pkl', db, db_user)
+    >>> scores = scorer.score(test_users.user_id)
+    >>> scorer.report()
+    '''
+
+    def __init__(self, path, db, db_user, batch_size=5000, store=None):
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+        self.vectorizer = model['vectorizer']
+        self.svd = model['svd']
+        self.classifier = model['classifier']
+        self.columns = model['columns']
+        self.threshold = model['threshold']
+        self.pre_churn_days = model['pre_churn_days']
+        self.db = db
+        self.db_user = db_user
+        self.batch_size = batch_size
+        self.store = store
+        self.requests = []
+
+    def windows(self, user_ids):
+        '''
+        Build the (user_id, pre_churn_date, churn_date) windows of users from
+        their last activity. Users without activity are dropped.
+        '''
+        user_ids = [int(u) for u in user_ids]
+        if isinstance(self.db, snapshot.Snapshot):
+            activity = data_collection.load_activity(self.db, self.db_user,
+                                                     'activity', user_ids)
+            last_day = define_classes.last_activity_df(activity)[['user_id', 'last_day']]
+            last_day.columns = ['user_id', 'churn_date']
+        else:
+            session = db_session.get_session(self.db, self.db_user)
+            rows = session.query('''SELECT user_id, MAX(date)
+            FROM activity
+            WHERE user_id = ANY(%s)
+            GROUP BY user_id
+            ;''', (user_ids,))
+            last_day = pd.DataFrame(rows, columns=['user_id', 'churn_date'])
+        user_df = pd.DataFrame({'user_id': user_ids}).merge(last_day, on='user_id')
+        user_df['churn_date'] = pd.to_datetime(user_df.churn_date)
+        user_df['pre_churn_date'] = (user_df.churn_date
+                                     - pd.tslib.Timedelta(days=self.pre_churn_days))
+        return user_df
+
+    def score_windows(self, user_df, as_of=data_collection.AS_OF):
+        '''
+        Score users with known windows.
+
+        Parameters
+        ----------
+        user_df: dataframe containing user_id, pre_churn_date and churn_date
+        as_of: day the features are computed at
+
+        Returns
+        -------
+        DataFrame with user_id, probability and good_churn columns
+        '''
+        results = []
+        for start in range(0, len(user_df), self.batch_size):
+            batch = user_df.iloc[start:start + self.batch_size]
+            nf_matrix = feature_building.feature_df_batch_maker(
+                self.db, self.db_user, batch, store=self.store, as_of=as_of)
+            response_df = text_processing.fetch_response_text(
+                self.db, self.db_user, batch, store=self.store)
+            svdMatrix = self.svd.transform(
+                self.vectorizer.transform(response_df.response_text))
+            text_matrix = pd.concat([response_df.user_id.reset_index(drop=True),
+                                     response_df.response_len.reset_index(drop=True),
+                                     pd.DataFrame(svdMatrix)], axis=1)
+            matrix = nf_matrix.set_index('user_id').join(text_matrix.set_index('user_id'))
+            matrix = matrix.fillna(0).reindex(columns=self.columns, fill_value=0)
+            probability = self.classifier.predict_proba(matrix.values)[:, 1]
+            results.append(pd.DataFrame({'user_id': matrix.index.values,
+                                         'probability': probability}))
+        if not results:
+            return pd.DataFrame(columns=['user_id', 'probability', 'good_churn'])
+        scores = pd.concat(results, ignore_index=True)
+        scores['good_churn'] = scores.probability > self.threshold
+        return scores
+
+    def score(self, user_ids, as_of=data_collection.AS_OF):
+        '''
+        Score users by id and record the request latency and throughput.
+        as_of is the day the features are computed at.
+
+        Returns
+        -------
+        DataFrame with user_id, probability and good_churn columns
+        '''
+        start = time.time()
+        scores = self.score_windows(self.windows(user_ids), as_of=as_of)
+        seconds = time.time() - start
+        self.requests.append({'users': len(scores), 'seconds': seconds})
+        return scores
+
+    def report(self):
+        '''
+        Latency and throughput of the requests served so far.
+
+        Returns
+        -------
+        dict with the number of requests and users, the mean and maximum
+        latency in seconds and the throughput in users per second
+        '''
+        if not self.requests:
+            return {'requests': 0, 'users': 0}
+        seconds = np.array([r['seconds'] for r in self.requests])
+        users = sum(r['users'] for r in self.requests)
+        return {'requests': len(self.requests), 'users': users,
+                'mean_latency': float(seconds.mean()),
+                'max_latency': float(seconds.max()),
+                'users_per_second': users / float(seconds.sum() or 1)}
+
+
+class IncrementalScorer(object):
+    '''
+    Daily scoring of the test population (users whose last activity is
+    between time_gone_high and time_gone_low days before as_of and who have
+    more than prechurn_act activities, as in define_classes.idendify_test_users)
+    that only rescores the users whose state changed since the previous run.
+
+    The state saved between runs holds the scored users with their last
+    activity, their scores, the previous as_of and the activity watermark.
+    Each run reads the delta with define_classes.test_user_candidates:
+    users who newly crossed the inactivity threshold, scored users who came
+    back (activity after the watermark) and then drops the users who aged
+    out of the window, without a GROUP BY over the whole activity table.
+
+    Parameters
+    ----------
+    scorer: GoodChurnScorer
+    state_path: string containing the file holding the state between runs
+    time_gone_low: int containing the least number of days without activity
+    time_gone_high: int containing the most days without activity
+    prechurn_act: int containing the number of activities required
+
+    After each run, changes counts the users added to the population, the
+    previous users rescored, removed and kept: kept + rescored + removed is
+    the previous population and added + rescored + kept the new one.
+
+    Example
+    -------
+    >>> daily = scoring.IncrementalScorer(scorer, 'daily_state.pkl', 14, 60, 10)
+    >>> scores = daily.run('2016-04-05')
+    >>> daily.changes
+    {'added': 41, 'rescored': 2, 'removed': 37, 'kept': 2113}
+    '''
+
+    def __init__(self, scorer, state_path, time_gone_low, time_gone_high,
+                 prechurn_act):
+        self.scorer = scorer
+        self.state_path = state_path
+        self.time_gone_low = time_gone_low
+        self.time_gone_high = time_gone_high
+        self.prechurn_act = prechurn_act
+        self.changes = {}
+        try:
+            with open(state_path, 'rb') as f:
+                self.state = pickle.load(f)
+        except (IOError, OSError):
+            self.state = None
+
+    def _bounds(self, as_of):
+        low = as_of - pd.tslib.Timedelta(days=self.time_gone_high)
+        high = as_of - pd.tslib.Timedelta(days=self.time_gone_low)
+        return low, high
+
+    def run(self, as_of=None):
+        '''
+        Update the scored population to as_of and save the state.
+
+        Parameters
+        ----------
+        as_of: day of the run; defaults to the day of the latest activity
+
+        Returns
+        -------
+        DataFrame with user_id, last_day, activity_count, probability and
+        good_churn columns for every user of the test population
+        '''
+        db, db_user = self.scorer.db, self.scorer.db_user
+        watermark = data_collection.activity_watermark(db, db_user)
+        if as_of is None:
+            as_of = watermark
+        as_of = pd.tslib.Timestamp(as_of).normalize()
+        low, high = self._bounds(as_of)
+        columns = ['user_id', 'last_day', 'activity_count', 'probability',
+                   'good_churn']
+        if self.state is None:
+            previous = pd.DataFrame(columns=columns)
+            since, last_watermark = low, None
+        else:
+            previous = self.state['scores']
+            since = max(self._bounds(self.state['as_of'])[1], low)
+            last_watermark = self.state['watermark']
+        candidates = define_classes.test_user_candidates(
+            db, db_user, 'activity', since, high, last_watermark,
+            previous.user_id)
+        qualified = candidates[(candidates.last_day > low)
+                               & (candidates.last_day < high)
+                               & (candidates.activity_count > self.prechurn_act)]
+
+        # previous users that are still in the window and did not come back
+        kept = previous[(previous.last_day > low)
+                        & ~previous.user_id.isin(candidates.user_id)]
+        known = previous.set_index('user_id').last_day
+        is_known = qualified.user_id.isin(previous.user_id)
+        changed = qualified[is_known].user_id.map(known) != qualified[is_known].last_day
+        rescore = pd.concat([qualified[~is_known], qualified[is_known][changed]])
+        unchanged = qualified[is_known][~changed].merge(
+            previous[['user_id', 'probability', 'good_churn']], on='user_id')
+
+        windows = pd.DataFrame({'user_id': rescore.user_id.values,
+                                'churn_date': rescore.last_day.values})
+        windows['pre_churn_date'] = (windows.churn_date
+                                     - pd.tslib.Timedelta(days=self.scorer.pre_churn_days))
+        scores = self.scorer.score_windows(windows, as_of=as_of)
+        scored = rescore.merge(scores[['user_id', 'probability', 'good_churn']],
+                               on='user_id')
+        current = pd.concat([kept, unchanged, scored], ignore_index=True)
+        current = current[columns].sort_values('user_id').reset_index(drop=True)
+
+        self.changes = {'added': int((~is_known).sum()),
+                        'rescored': int(changed.sum()),
+                        'removed': (len(previous) - len(kept) - len(unchanged)
+                                    - int(changed.sum())),
+                        'kept': len(kept) + len(unchanged)}
+        self.state = {'as_of': as_of, 'watermark': watermark, 'scores': current}
+        with open(self.state_path, 'wb') as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        return current
+
+
+def serve(scorer, port=8765, host='127.0.0.1'):
+    '''
+    Serve a GoodChurnScorer over local HTTP until interrupted.
+
+    POST /score with a JSON body {"user_ids": [...]} returns a JSON list of
+    {"user_id", "probability", "good_churn"} objects; GET /report returns
+    GoodChurnScorer.report().
+
+    Example
+    -------
+    >>> scoring.serve(scoring.GoodChurnScorer('good_churn.pkl', db, db_user))
+    '''
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/report':
+                self._send(200, scorer.report())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self._send(404, {'error': 'not found'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                body = None
+            user_ids = body.get('user_ids') if isinstance(body, dict) else None
+            if (not isinstance(user_ids, list)
+                    or not all(isinstance(u, int) and not isinstance(u, bool)
+                               for u in user_ids)):
+                self._send(400, {'error': 'expected {"user_ids": [int, ...]}'})
+                return
+            try:
+                scores = scorer.score(user_ids)
+                rows = [{'user_id': int(row.user_id),
+                         'probability': float(row.probability),
+                         'good_churn': bool(row.good_churn)}
+                        for row in scores.itertuples(index=False)]
+            except Exception as e:
+                self._send(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+                return
+            self._send(200, rows)
+
+    server = HTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import db_session
+
+# Tables exported to a snapshot. 'user' is the column used to partition rows
+# by user_id range and 'time' the column holding the incremental refresh
+# high-water mark (None means the table is reloaded on every refresh).
+SNAPSHOT_TABLES = {
+    'activity': {'user': 'user_id', 'time': 'date',
+                 'columns': [('user_id', 'int'), ('date', 'time'),
+                             ('id', 'int'), ('type', 'str')]},
+    'answers': {'user': 'user_id', 'time': 'created_at',
+                'columns': [('id', 'int'), ('user_id', 'int'),
+                            ('created_at', 'time'), ('body', 'str')]},
+    'connections': {'user': 'from_user_id', 'time': 'created_at',
+                    'columns': [('id', 'int'), ('from_user_id', 'int'),
+                                ('to_user_id', 'int'), ('created_at', 'time')]},
+    'users': {'user': 'id', 'time': None,
+              'columns': [('id', 'int'), ('birthdate', 'time')]},
+}
+
+
+class Snapshot(object):
+    '''
+    Local columnar copy of the activity, answers, connections and users
+    tables. Every table is split into partitions by user_id range and each
+    column of a partition is stored as a numpy file that is memory-mapped on
+    read; text columns are stored as one utf-8 byte array plus offsets.
+    Rewritten partitions go to a new version directory and the manifest,
+    saved last, switches to them, so a crash leaves the previous snapshot.
+
+    A Snapshot can be passed in place of the db name to
+    data_collection.user_stats_df (bulk mode), data_collection.load_activity,
+    the define_classes labeling functions and
+    feature_building.feature_df_batch_maker.
+
+    Parameters
+    ----------
+    path: string containing the directory holding the snapshot
+    partition_size: int containing the number of user_ids per partition
+
+    Example
+    -------
+    >>> snap = snapshot.Snapshot('activity_snapshot')
+    >>> snap.refresh(db, db_user)
+    >>> stats_df = data_collection.user_stats_df(snap, None, 'activity', bulk=True)
+    '''
+
+    def __init__(self, path, partition_size=10000):
+        self.path = path
+        self.partition_size = partition_size
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            self.partition_size = self.manifest['partition_size']
+        else:
+            self.manifest = {'partition_size': partition_size, 'tables': {}}
+        # partition directories replaced since the manifest was last saved
+        self._replaced = []
+
+    def watermark(self, table):
+        '''Return the latest time column value stored for a table, or None.'''
+        info = self.manifest['tables'].get(table)
+        if info is None or info['watermark'] is None:
+            return None
+        return pd.Timestamp(info['watermark'])
+
+    def refresh(self, db, db_user, tables=None):
+        '''
+        Pull rows newer than each table's high-water mark from the database
+        and append them to the snapshot. The first refresh exports the full
+        tables.
+
+        Parameters
+        ----------
+        db: DBSession or string containing name of local postgreSQL data base
+        db_user: string containing the user name for login to database
+        tables: list of table names to refresh, defaults to all of them
+
+        Returns
+        -------
+        dict mapping table name to the number of rows added
+        '''
+        session = db_session.get_session(db, db_user)
+        added = {}
+        for table in tables or sorted(SNAPSHOT_TABLES):
+            spec = SNAPSHOT_TABLES[table]
+            names = [c for c, kind in spec['columns']]
+            sql = 'SELECT {} FROM {} WHERE {} IS NOT NULL'.format(
+                ', '.join(names), table, spec['user'])
+            params = None
+            watermark = self.watermark(table)
+            if spec['time'] is not None and watermark is not None:
+                sql += ' AND {} > %s'.format(spec['time'])
+                params = (watermark.to_pydatetime(),)
+            rows = pd.DataFrame(session.query(sql, params), columns=names)
+            if spec['time'] is None:
+                self._clear(table)
+            added[table] = self.append(table, rows)
+        return added
+
+    def append(self, table, rows):
+        '''
+        Append a DataFrame of new rows to a table of the snapshot, rewriting
+        only the partitions the rows fall into.
+
+        Returns
+        -------
+        int containing the number of rows added
+        '''
+        spec = SNAPSHOT_TABLES[table]
+        info = self.manifest['tables'].setdefault(
+            table, {'watermark': None, 'partitions': [], 'rows': 0})
+        if len(rows) == 0:
+            self._save_manifest()
+            return 0
+        rows = _typed(rows, spec['columns'])
+        part = (rows[spec['user']].values // self.partition_size) * self.partition_size
+        versions = info.setdefault('versions', {})
+        for lo in np.unique(part):
+            lo = int(lo)
+            new = rows[part == lo]
+            version = versions.get(str(lo))
+            if lo in info['partitions']:
+                new = pd.concat([self._read_partition(table, lo), new],
+                                ignore_index=True)
+            else:
+                info['partitions'].append(lo)
+            sort_by = [spec['user']] + ([spec['time']] if spec['time'] else [])
+            new = new.sort_values(sort_by, kind='mergesort')
+            # the partition in use is only replaced by saving the manifest
+            versions[str(lo)] = (version or 0) + 1
+            self._write_partition(table, lo, new)
+            self._replaced.append(self._partition_dir(table, lo, version))
+        info['partitions'].sort()
+        info['rows'] += len(rows)
+        if spec['time'] is not None:
+            latest = rows[spec['time']].max()
+            if info['watermark'] is None or latest > pd.Timestamp(info['watermark']):
+                info['watermark'] = str(latest)
+        self._save_manifest()
+        return len(rows)
+
+    def read(self, table, columns=None, user_ids=None):
+        '''
+        Read a table of the snapshot into a DataFrame sorted by user_id and
+        time. Numeric columns are memory-mapped.
+
+        Parameters
+        ----------
+        table: string containing the table name
+        columns: list of column names, defaults to all columns
+        user_ids: optional list of user_ids; only the partitions holding
+        them are read
+
+        Returns
+        -------
+        pandas DataFrame
+        '''
+        spec = SNAPSHOT_TABLES[table]
+        info = self.manifest['tables'].get(table, {'partitions': []})
+        columns = columns or [c for c, kind in spec['columns']]
+        partitions = info['partitions']
+        if user_ids is not None:
+            user_ids = np.asarray(user_ids, dtype=np.int64)
+            wanted = set((user_ids // self.partition_size) * self.partition_size)
+            partitions = [lo for lo in partitions if lo in wanted]
+        frames = [self._read_partition(table, lo, columns) for lo in partitions]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        frame = pd.concat(frames, ignore_index=True)
+        if user_ids is not None:
+            frame = frame[frame[spec['user']].isin(user_ids)]
+            frame = frame.reset_index(drop=True)
+        return frame
+
+    def _partition_dir(self, table, lo, version=-1):
+        # version -1 is the version in the manifest, None the unversioned
+        # directory of snapshots written before partitions were versioned
+        if version == -1:
+            info = self.manifest['tables'].get(table, {})
+            version = info.get('versions', {}).get(str(lo))
+        name = '{}-{}'.format(lo, lo + self.partition_size - 1)
+        if version is not None:
+            name += '.{}'.format(version)
+        return os.path.join(self.path, table, name)
+
+    def _read_partition(self, table, lo, columns=None):
+        spec = SNAPSHOT_TABLES[table]
+        kinds = dict(spec['columns'])
+        columns = columns or [c for c, kind in spec['columns']]
+        directory = self._partition_dir(table, lo)
+        data = {}
+        for column in columns:
+            base = os.path.join(directory, column)
+            if kinds[column] == 'str':
+                text = np.load(base + '.data.npy', mmap_mode='r')
+                offsets = np.load(base + '.offsets.npy')
+                raw = text.tobytes()
+                data[column] = [raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+                                for i in range(len(offsets) - 1)]
+            elif kinds[column] == 'time':
+                data[column] = np.load(base + '.npy', mmap_mode='r').view('datetime64[ns]')
+            else:
+                data[column] = np.load(base + '.npy', mmap_mode='r')
+        return pd.DataFrame(data, columns=columns)
+
+    def _write_partition(self, table, lo, frame):
+        spec = SNAPSHOT_TABLES[table]
+        directory = self._partition_dir(table, lo)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for column, kind in spec['columns']:
+            base = os.path.join(directory, column)
+            if kind == 'str':
+                encoded = [v.encode('utf-8') for v in frame[column]]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(v) for v in encoded])
+                text = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+                _save(base + '.data.npy', text)
+                _save(base + '.offsets.npy', offsets)
+            elif kind == 'time':
+                _save(base + '.npy', frame[column].values.astype('datetime64[ns]').view(np.int64))
+            else:
+                _save(base + '.npy', frame[column].values.astype(np.int64))
+
+    def _clear(self, table):
+        info = self.manifest['tables'].get(table)
+        if info is not None:
+            self._replaced.extend(self._partition_dir(table, lo)
+                                  for lo in info['partitions'])
+            info['partitions'] = []
+            info['rows'] = 0
+
+    def _save_manifest(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.rename(tmp, self.manifest_path)
+        current = set(self._partition_dir(table, lo)
+                      for table, info in self.manifest['tables'].items()
+                      for lo in info['partitions'])
+        for directory in self._replaced:
+            if directory not in current and os.path.isdir(directory):
+                shutil.rmtree(directory)
+        self._replaced = []
+
+
+def _typed(rows, columns):
+    # Convert a fetched DataFrame to the column types stored in a snapshot.
+    rows = rows.copy()
+    for column, kind in columns:
+        if kind == 'int':
+            rows[column] = rows[column].fillna(-1).astype(np.int64)
+        elif kind == 'time':
+            rows[column] = pd.to_datetime(rows[column])
+        else:
+            rows[column] = rows[column].fillna('').astype(str)
+    return rows
+
+
+def _save(path, array):
+    # Write through a temporary file so readers never see a partial column.
+    tmp = path + '.tmp.npy'
+    np.save(tmp, array)
+    os.rename(tmp, path)
@@ -0,0 +1,313 @@
+from io import StringIO
+import numpy as np
+import pandas as pd
+import activity_log
+import data_collection
+import db_session
+import schema
+import snapshot
+
+DAY = activity_log.DAY_NS
+HOUR = DAY // 24
+MINUTE = HOUR // 60
+
+# Probability of each kind of event in a session, in the order of
+# activity_log.ACTIVITY_TYPES.
+TYPE_PROBABILITIES = [0.45, 0.3, 0.15, 0.1]
+
+# Words used for answer bodies; each user favours a topic so the TF-IDF/SVD
+# text features have some structure.
+TOPICS = [
+    ['coffee', 'brunch', 'pizza', 'cooking', 'restaurant', 'wine', 'tacos',
+     'dinner', 'recipe', 'sushi'],
+    ['hiking', 'running', 'yoga', 'climbing', 'gym', 'cycling', 'surfing',
+     'trail', 'marathon', 'camping'],
+    ['movies', 'music', 'concert', 'books', 'netflix', 'podcast', 'guitar',
+     'festival', 'album', 'theater'],
+    ['travel', 'beach', 'paris', 'flight', 'road', 'trip', 'mountains',
+     'island', 'passport', 'weekend'],
+    ['dog', 'cat', 'puppy', 'walk', 'park', 'rescue', 'kitten', 'vet',
+     'leash', 'fetch'],
+]
+COMMON_WORDS = ['love', 'really', 'like', 'great', 'fun', 'favorite', 'best',
+                'time', 'good', 'always', 'new', 'friends', 'city', 'life']
+
+# Tables written by load_postgres, in load order.
+SCHEMA = [
+    ('users', '''CREATE TABLE users (
+    id integer PRIMARY KEY,
+    birthdate timestamp
+    )'''),
+    ('answers', '''CREATE TABLE answers (
+    id bigint PRIMARY KEY,
+    user_id integer,
+    created_at timestamp,
+    body text
+    )'''),
+    ('answer_likes', '''CREATE TABLE answer_likes (
+    id bigint PRIMARY KEY,
+    answer_id bigint,
+    user_id integer,
+    created_at timestamp
+    )'''),
+    ('connections', '''CREATE TABLE connections (
+    id bigint PRIMARY KEY,
+    from_user_id integer,
+    to_user_id integer,
+    created_at timestamp
+    )'''),
+    ('notifications', '''CREATE TABLE notifications (
+    id bigint PRIMARY KEY,
+    sender_id integer,
+    created_at timestamp
+    )'''),
+    ('user_stats', '''CREATE TABLE user_stats (
+    app_user integer,
+    first_use timestamp,
+    last_use timestamp,
+    time_with_app bigint,
+    num_uses integer,
+    min_away bigint,
+    max_away bigint,
+    avg_away bigint,
+    median_away bigint
+    )'''),
+]
+
+
+class SyntheticData(object):
+    '''
+    Generator of a synthetic copy of the app database with the tables and
+    columns the pipeline queries: users(id, birthdate), answers(id, user_id,
+    created_at, body), answer_likes(id, answer_id, user_id, created_at),
+    connections(id, from_user_id, to_user_id, created_at),
+    notifications(id, sender_id, created_at) and the derived activity and
+    user_stats tables.
+
+    Every user signs up at a random time and then opens the app in sessions
+    until they leave for good. Sessions are bursts of events a few minutes
+    apart; the time between sessions is usually hours to days, with
+    occasional multi-week breaks, so the data contains good churn (users who
+    come back after a long break) as well as bad churn. Users are generated
+    in chunks with vectorized numpy code so memory is bounded by chunk_size,
+    which lets the same code produce 10k or 10M users.
+
+    Parameters
+    ----------
+    n_users: int containing the number of users
+    start: first day of the data
+    end: day the data was exported (the pipeline's '2016-04-04')
+    chunk_size: int containing the number of users generated at once
+    session_gap_hours: float containing the mean hours between sessions
+    break_probability: float containing the chance a gap is a long break
+    break_days: float containing the mean length of a long break in days
+    leave_probability: float containing the chance a user leaves for good
+    after a session
+    burst_size: float containing the mean number of events per session
+    seed: int seeding the generator
+
+    Example
+    -------
+    >>> data = synthetic.SyntheticData(100000, seed=0)
+    >>> data.load_postgres(db, db_user)
+    >>> snap = data.load_snapshot('synthetic_snapshot')
+    '''
+
+    def __init__(self, n_users, start='2015-01-01', end='2016-04-04',
+                 chunk_size=50000, session_gap_hours=30.0,
+                 break_probability=0.03, break_days=30.0,
+                 leave_probability=0.05, burst_size=3.0, seed=0):
+        self.n_users = n_users
+        self.start = pd.tslib.Timestamp(start)
+        self.end = pd.tslib.Timestamp(end)
+        self.chunk_size = chunk_size
+        self.session_gap_hours = session_gap_hours
+        self.break_probability = break_probability
+        self.break_days = break_days
+        self.leave_probability = leave_probability
+        self.burst_size = burst_size
+        self.seed = seed
+
+    def chunks(self):
+        '''
+        Generate the tables one chunk of users at a time. The same seed
+        always produces the same data.
+
+        Returns
+        -------
+        generator of dicts mapping table name to DataFrame; every chunk holds
+        the complete history of its users
+        '''
+        next_id = {'answers': 1, 'answer_likes': 1, 'connections': 1,
+                   'notifications': 1}
+        for number, first in enumerate(range(1, self.n_users + 1, self.chunk_size)):
+            rng = np.random.RandomState([self.seed, number])
+            n = min(self.chunk_size, self.n_users + 1 - first)
+            yield self._chunk(rng, np.arange(first, first + n), next_id)
+
+    def _chunk(self, rng, user_ids, next_id):
+        n = len(user_ids)
+        start, end = self.start.value, self.end.value
+        signup = start + (rng.rand(n) * 0.9 * (end - start)).astype(np.int64)
+        age_days = ((18 + rng.gamma(3.0, 4.0, n)) * 365.25 * DAY).astype(np.int64)
+        users = pd.DataFrame({'id': user_ids,
+                              'birthdate': pd.DatetimeIndex((end - age_days).astype('datetime64[ns]')).normalize()},
+                             columns=['id', 'birthdate'])
+
+        # sessions: a user keeps coming back until a geometric number of
+        # sessions is used up
+        n_sessions = rng.geometric(self.leave_probability, n)
+        session_user = np.repeat(np.arange(n), n_sessions)
+        is_break = rng.rand(len(session_user)) < self.break_probability
+        gaps = np.where(is_break,
+                        rng.exponential(self.break_days * DAY, len(session_user)),
+                        rng.exponential(self.session_gap_hours * HOUR,
+                                        len(session_user))).astype(np.int64)
+        session_time = signup[session_user] + _segment_cumsum(gaps, n_sessions)
+
+        # events: bursts a few minutes apart within each session
+        n_events = rng.geometric(1.0 / self.burst_size, len(session_user))
+        event_session = np.repeat(np.arange(len(session_user)), n_events)
+        offsets = rng.exponential(3 * MINUTE, len(event_session)).astype(np.int64)
+        times = session_time[event_session] + _segment_cumsum(offsets, n_events)
+        owner = session_user[event_session]
+        keep = times < end
+        times, owner = times[keep], owner[keep]
+        types = rng.choice(len(TYPE_PROBABILITIES), len(times), p=TYPE_PROBABILITIES)
+
+        tables = {'users': users}
+        tables['notifications'] = self._rows(
+            'notifications', next_id, types == 0, owner, times, user_ids,
+            'sender_id')
+        answer_likes = self._rows('answer_likes', next_id, types == 1, owner,
+                                  times, user_ids, 'user_id')
+        answer_likes['answer_id'] = rng.randint(1, max(next_id['answers'], 2),
+                                                len(answer_likes))
+        tables['answer_likes'] = answer_likes[['id', 'answer_id', 'user_id',
+                                               'created_at']]
+        answers = self._rows('answers', next_id, types == 2, owner, times,
+                             user_ids, 'user_id')
+        answers['body'] = _bodies(rng, user_ids[owner[types == 2]] % len(TOPICS))
+        tables['answers'] = answers
+        connections = self._rows('connections', next_id, types == 3, owner,
+                                 times, user_ids, 'from_user_id')
+        connections['to_user_id'] = rng.randint(1, self.n_users + 1,
+                                                len(connections))
+        tables['connections'] = connections[['id', 'from_user_id', 'to_user_id',
+                                             'created_at']]
+
+        activity = pd.DataFrame({'user_id': user_ids[owner],
+                                 'date': times.astype('datetime64[ns]'),
+                                 'type': np.array(activity_log.ACTIVITY_TYPES)[types]},
+                                columns=['user_id', 'date', 'id', 'type'])
+        for code, name in enumerate(activity_log.ACTIVITY_TYPES):
+            activity.loc[types == code, 'id'] = tables[name].id.values
+        activity['id'] = activity.id.astype(np.int64)
+        tables['activity'] = activity.sort_values(['user_id', 'date'],
+                                                  kind='mergesort').reset_index(drop=True)
+        return tables
+
+    def _rows(self, table, next_id, mask, owner, times, user_ids, user_column):
+        count = int(mask.sum())
+        ids = np.arange(next_id[table], next_id[table] + count)
+        next_id[table] += count
+        frame = pd.DataFrame({'id': ids,
+                              'created_at': times[mask].astype('datetime64[ns]')})
+        frame[user_column] = user_ids[owner[mask]]
+        return frame[['id', user_column, 'created_at']]
+
+    def load_postgres(self, db, db_user, partitioned=False):
+        '''
+        Create the tables in a local PostgreSQL database, copy the data in
+        chunk by chunk, then build the activity table with
+        data_collection.update_activity_table and add the covering indexes
+        of schema.create_covering_indexes. Existing tables of the same names
+        are dropped.
+
+        Parameters
+        ----------
+        db: DBSession or string containing name of local postgreSQL data base
+        db_user: string containing the user name for login to database
+        partitioned: bool, if True the activity table is partitioned by month
+
+        Returns
+        -------
+        dict mapping table name to the number of rows loaded
+        '''
+        session = db_session.get_session(db, db_user)
+        with session.cursor() as cur:
+            for table, ddl in SCHEMA + [('activity', None),
+                                        ('activity_watermarks', None)]:
+                cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+                if ddl is not None:
+                    cur.execute(ddl)
+        loaded = dict((table, 0) for table, ddl in SCHEMA)
+        for tables in self.chunks():
+            tables['user_stats'] = _user_stats_rows(tables['activity'])
+            with session.cursor() as cur:
+                for table, ddl in SCHEMA:
+                    _copy(cur, table, tables[table])
+                    loaded[table] += len(tables[table])
+        added = data_collection.update_activity_table(db, db_user, partitioned)
+        loaded['activity'] = sum(added.values())
+        schema.create_covering_indexes(db, db_user)
+        return loaded
+
+    def load_snapshot(self, path):
+        '''
+        Write the data to a Snapshot, the embedded stand-in for the database
+        accepted by the bulk functions of data_collection, define_classes and
+        feature_building.
+
+        Parameters
+        ----------
+        path: string containing the directory of the snapshot
+
+        Returns
+        -------
+        Snapshot
+        '''
+        snap = snapshot.Snapshot(path, partition_size=self.chunk_size)
+        for tables in self.chunks():
+            for table in sorted(snapshot.SNAPSHOT_TABLES):
+                snap.append(table, tables[table])
+        return snap
+
+
+def _segment_cumsum(values, lengths):
+    # Running sum of values restarting at 0 at the start of every segment.
+    values = values.copy()
+    starts = np.cumsum(lengths) - lengths
+    values[starts[lengths > 0]] = 0
+    total = np.cumsum(values)
+    return total - np.repeat(total[starts[lengths > 0]], lengths[lengths > 0])
+
+
+def _bodies(rng, topics):
+    # Short answers mixing common words with words of each user's topic.
+    lengths = 1 + rng.poisson(8, len(topics))
+    topic = np.repeat(topics, lengths)
+    words = np.array(TOPICS)[topic, rng.randint(0, len(TOPICS[0]), len(topic))]
+    common = rng.rand(len(topic)) < 0.4
+    words[common] = np.array(COMMON_WORDS)[rng.randint(0, len(COMMON_WORDS),
+                                                       common.sum())]
+    ends = np.cumsum(lengths)
+    return [' '.join(words[e - l:e]) for e, l in zip(ends, lengths)]
+
+
+def _user_stats_rows(activity):
+    # user_stats rows of a chunk in the layout of the user_stats table:
+    # away times in nanoseconds and no first/last use for single activities.
+    rows = activity_log.ActivityLog.from_frame(activity).gap_stats(legacy=False)
+    for column in ['time_with_app', 'min_away', 'max_away', 'avg_away',
+                   'median_away']:
+        rows[column] = rows[column].values.view(np.int64)
+    return rows[data_collection.USER_STATS_COLUMNS]
+
+
+def _copy(cur, table, frame):
+    buf = StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(
+        table, ', '.join(frame.columns)), buf)
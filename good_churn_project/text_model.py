@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class StreamingTextModel(object):
+    '''
+    Out-of-core replacement for the TfidfVectorizer + TruncatedSVD pair used
+    by text_processing. Documents are hashed into a fixed number of features,
+    the IDF weights are accumulated one chunk at a time and the SVD is fit
+    with randomized subspace iteration, where every pass over the corpus only
+    accumulates an n_features x (n_components + oversample) matrix. Memory
+    is bounded by the chunk size and n_features, not by the corpus size.
+
+    Parameters
+    ----------
+    n_components: int containing the number of singular values to retain
+    n_features: int containing the number of hashed features
+    n_iter: int containing the number of subspace iterations (one pass over
+    the corpus each)
+    oversample: int containing the extra dimensions of the random subspace
+    random_state: int seeding the random subspace
+
+    Example
+    -------
+    >>> model = text_model.StreamingTextModel(n_components=15)
+    >>> svd_matrix = model.fit_transform(lambda: iter(text_chunks))
+    '''
+
+    def __init__(self, n_components=15, n_features=2**18, n_iter=2,
+                 oversample=10, random_state=None):
+        self.n_components = n_components
+        self.n_features = n_features
+        self.n_iter = n_iter
+        self.oversample = oversample
+        self.random_state = random_state
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self.vectorizer = HashingVectorizer(n_features=n_features,
+                                            stop_words='english',
+                                            alternate_sign=False, norm=None)
+        self.idf_ = None
+        self.components_ = None
+        self.singular_values_ = None
+
+    def _tfidf(self, texts):
+        from sklearn.preprocessing import normalize
+        counts = self.vectorizer.transform(texts)
+        counts.data = counts.data * self.idf_[counts.indices]
+        return normalize(counts)
+
+    def fit_transform(self, chunks):
+        '''
+        Fit the model on a corpus read in chunks and return the SVD features
+        of every document.
+
+        Parameters
+        ----------
+        chunks: callable returning a fresh iterable of lists of documents;
+        it is called once per pass over the corpus
+
+        Returns
+        -------
+        numpy array with one row per document and n_components columns
+        '''
+        # pass 1: document frequencies for smooth IDF, as TfidfVectorizer
+        df = np.zeros(self.n_features, dtype=np.int64)
+        n_docs = 0
+        for texts in chunks():
+            counts = self.vectorizer.transform(texts)
+            df += np.bincount(counts.indices, minlength=self.n_features)
+            n_docs += counts.shape[0]
+        self.idf_ = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+
+        # subspace iteration on X'X, one pass each
+        rng = np.random.RandomState(self.random_state)
+        width = self.n_components + self.oversample
+        basis, _ = np.linalg.qr(rng.standard_normal((self.n_features, width)))
+        for i in range(self.n_iter):
+            product = np.zeros((self.n_features, width))
+            for texts in chunks():
+                tfidf = self._tfidf(texts)
+                product += tfidf.T.dot(tfidf.dot(basis))
+            basis, _ = np.linalg.qr(product)
+
+        # last pass: project every document on the basis and solve the small
+        # eigenproblem of the projected Gram matrix
+        gram = np.zeros((width, width))
+        projected = []
+        for texts in chunks():
+            chunk = self._tfidf(texts).dot(basis)
+            gram += chunk.T.dot(chunk)
+            projected.append(chunk)
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        top = np.argsort(eigenvalues)[::-1][:self.n_components]
+        rotation = eigenvectors[:, top]
+        self.components_ = basis.dot(rotation).T
+        self.singular_values_ = np.sqrt(np.maximum(eigenvalues[top], 0))
+        if not projected:
+            return np.zeros((0, self.n_components))
+        return np.vstack(projected).dot(rotation)
+
+    def transform(self, texts):
+        '''
+        SVD features of a list of documents.
+
+        Returns
+        -------
+        numpy array with one row per document and n_components columns
+        '''
+        return np.asarray(self._tfidf(texts).dot(self.components_.T))
@@ -1,28 +1,158 @@
-import psycopg2 as pg2
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-stop_words = stopwords.words('english')
-from nltk.stem.snowball import SnowballStemmer
-from nltk.stem.wordnet import WordNetLemmatizer
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
 import pandas as pd
 import numpy as np
-from sklearn.decomposition import TruncatedSVD
+import data_collection
+import db_session
+import instrumentation
+import snapshot
+import text_model
 
+RESPONSE_TEXT_QUERY = '''
+    SELECT w.ord, w.user_id, a.response_text, a.response_count
+    FROM {} w
+    LEFT JOIN LATERAL
+    (SELECT string_agg(body,' ') AS response_text,
+     count(user_id) AS response_count
+     FROM answers
+     WHERE user_id = w.user_id
+     AND created_at > w.pre_churn_date
+     AND created_at < w.churn_date) a ON true
+    ORDER BY w.ord
+    '''
+
+
+def iter_response_text(db, db_user, user_df, batch_size=1000):
+    '''
+    Stream the aggregated response text of every user window with one query
+    read through a server-side cursor.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    user_df: dataframe containing user_id, earliest day of the time window
+    (pre_churn_date) and the last day of the time window (churn_date)
+    batch_size: int containing the number of rows fetched per round-trip
+
+    Returns
+    -------
+    generator of pandas DataFrames with user_id, response_text,
+    response_count and response_len columns, in the order of user_df.
+    Windows without responses get response_text '0' and zero count/length.
+
+    Example
+    -------
+    '''
+    session = db_session.get_session(db, db_user)
+    with session.connection() as conn:
+        cur = conn.cursor()
+        data_collection.upload_windows(cur, user_df, 'text_windows')
+        cur.close()
+        stream = conn.cursor('response_text_stream')
+        stream.itersize = batch_size
+        stream.execute(RESPONSE_TEXT_QUERY.format('text_windows'))
+        while True:
+            rows = stream.fetchmany(batch_size)
+            if not rows:
+                break
+            chunk = pd.DataFrame(rows, columns=['ord', 'user_id',
+                                                'response_text',
+                                                'response_count'])
+            missing = chunk.response_text.isnull()
+            chunk.loc[missing, 'response_text'] = '0'
+            chunk.loc[missing, 'response_count'] = 0
+            chunk['response_len'] = chunk.response_text.str.len()
+            chunk.loc[missing, 'response_len'] = 0
+            yield chunk[['user_id', 'response_text', 'response_count',
+                         'response_len']]
+        stream.close()
+
+
+@instrumentation.instrumented
+def fetch_response_text(db, db_user, user_df, batch_size=1000, store=None):
+    '''
+    Fetch the aggregated response text, count and length for every user
+    window. Shared by the training and scoring text stages.
+
+    Parameters
+    ----------
+    db: DBSession, Snapshot or string containing name of local postgreSQL
+    data base
+    db_user: string containing the user name for login to database
+    user_df: dataframe containing user_id, pre_churn_date and churn_date
+    batch_size: int containing the number of rows fetched per round-trip
+    store: optional FeatureStore; only windows missing from it are fetched
+
+    Returns
+    -------
+    response_df: pandas DataFrame
+
+    Example
+    -------
+    >>> response_df = text_processing.fetch_response_text(db, db_user, X_train)
+    '''
+    columns = ['user_id', 'response_text', 'response_count', 'response_len']
+    if store is not None:
+        watermark = data_collection.activity_watermark(db, db_user)
+        return store.cached_frame('response_text', user_df,
+                                  lambda df: fetch_response_text(db, db_user, df,
+                                                                 batch_size),
+                                  watermark, columns)
+    if isinstance(db, snapshot.Snapshot):
+        return snapshot_response_text(db, user_df)
+    chunks = list(iter_response_text(db, db_user, user_df, batch_size))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def snapshot_response_text(snap, user_df):
+    '''
+    Constructs the response text DataFrame of fetch_response_text from a
+    local Snapshot instead of the database.
+
+    Parameters
+    ----------
+    snap: Snapshot
+    user_df: dataframe containing user_id, pre_churn_date and churn_date
+
+    Returns
+    -------
+    response_df: pandas DataFrame, in the order of user_df
+    '''
+    windows = pd.DataFrame({'ord': np.arange(len(user_df)),
+                            'user_id': user_df.user_id.values,
+                            'pre_churn_date': pd.to_datetime(user_df.pre_churn_date).values,
+                            'churn_date': pd.to_datetime(user_df.churn_date).values})
+    answers = snap.read('answers', ['user_id', 'created_at', 'body'],
+                        windows.user_id.unique())
+    joined = windows.merge(answers, on='user_id')
+    joined = joined[(joined.created_at > joined.pre_churn_date)
+                    & (joined.created_at < joined.churn_date)]
+    grouped = joined.groupby('ord').body
+    text = grouped.agg(' '.join).reindex(windows.ord.values)
+    count = grouped.size().reindex(windows.ord.values).fillna(0)
+    missing = text.isnull().values
+    response_df = pd.DataFrame({'user_id': windows.user_id.values,
+                                'response_text': text.fillna('0').values,
+                                'response_count': count.values.astype(np.int64)})
+    response_df['response_len'] = response_df.response_text.str.len()
+    response_df.loc[missing, 'response_len'] = 0
+    return response_df
 
-def train_text_clusters(db, db_user, train_user_df, no_SVs):
+
+@instrumentation.instrumented
+def train_text_clusters(db, db_user, train_user_df, no_SVs, store=None):
     '''
     transforms text data from traing users using TF-IDF and reduces features
     using SVD.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     train_user_ids: string containing user_ids to train the text anaysis model
     no_SVs: int containing the number of singular values to retain.
+    store: optional FeatureStore caching the fetched response text
 
     Returns
     -------
@@ -34,32 +164,10 @@ def train_text_clusters(db, db_user, train_user_df, no_SVs):
     -------
 
     '''
-    response_df = pd.DataFrame(columns= ['user_id', 'response_text', 'response_count'])
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    for index, train_user in train_user_df.iterrows():
-        sql = '''
-        SELECT user_id,
-        string_agg(body,' ') AS response_text,
-        count(user_id) AS response_count
-        FROM answers
-        WHERE user_id = {}
-        AND created_at > '{}'
-        AND created_at < '{}'
-        GROUP BY user_id
-        LIMIT 10;
-        '''.format(train_user.user_id, train_user.pre_churn_date, train_user.churn_date)
-        cur.execute(sql)
-        query = cur.fetchall()
-        if not len(query) > 0:
-            resp_series = pd.Series([train_user.user_id, '0', 0], index = ['user_id', 'response_text', 'response_count'])
-            resp_series['response_len'] = 0
-            response_df = response_df.append(resp_series, ignore_index=True)
-            continue
-        resp_series = pd.Series(query[0], index = ['user_id', 'response_text', 'response_count'])
-        resp_series['response_len'] = len(resp_series.response_text)
-        response_df = response_df.append(resp_series, ignore_index=True)
-    conn.close()
+    # scikit-learn is only imported by the stages that fit a text model
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    response_df = fetch_response_text(db, db_user, train_user_df, store=store)
     vectorizer = TfidfVectorizer(stop_words='english')
     model = vectorizer.fit_transform(response_df['response_text'])
     svd = TruncatedSVD(n_components = no_SVs)
@@ -68,18 +176,20 @@ def train_text_clusters(db, db_user, train_user_df, no_SVs):
     return response_df, vectorizer, svd
 
 
-def test_text_clusters(db, db_user, test_user_df, vectorizer_model, svd):
+@instrumentation.instrumented
+def test_text_clusters(db, db_user, test_user_df, vectorizer_model, svd, store=None):
     '''
     transforms text data from test users using TF-IDF and SVD models built
     with training data.
 
     Parameters
     ----------
-    db: string containing name of local postgreSQL data base
+    db: DBSession or string containing name of local postgreSQL data base
     db_user: string containing the user name for login to database
     test_user_df: DataFrame containing user_ids
     vectorizer_model: TF-IDF model built with training data.
     svd: SVD model built with training data.
+    store: optional FeatureStore caching the fetched response text
 
     Returns
     -------
@@ -90,35 +200,7 @@ def test_text_clusters(db, db_user, test_user_df, vectorizer_model, svd):
 
     '''
 
-    response_df = pd.DataFrame(columns= ['user_id', 'response_text', 'response_count'])
-    conn = pg2.connect(dbname=db, user=db_user, host='localhost')
-    cur = conn.cursor()
-    for index, test_user in test_user_df.iterrows():
-        sql = '''
-        SELECT user_id,
-        string_agg(body,' ') AS response_text,
-        count(user_id) AS response_count
-        FROM answers
-        WHERE user_id = {}
-        AND created_at > '{}'
-        AND created_at < '{}'
-        GROUP BY user_id
-        LIMIT 10;
-        '''.format(test_user.user_id, test_user.pre_churn_date, test_user.churn_date)
-        cur.execute(sql)
-        query = cur.fetchall()
-        if not len(query) > 0:
-            resp_series = pd.Series([test_user.user_id, '0', 0],
-                                    index = ['user_id', 'response_text',
-                                                'response_count'])
-            resp_series['response_len'] = 0
-            response_df = response_df.append(resp_series, ignore_index=True)
-            continue
-        resp_series = pd.Series(query[0], index = ['user_id', 'response_text',
-                                                    'response_count'])
-        resp_series['response_len'] = len(resp_series.response_text)
-        response_df = response_df.append(resp_series, ignore_index=True)
-    conn.close()
+    response_df = fetch_response_text(db, db_user, test_user_df, store=store)
 
     test_data_vect = vectorizer_model.transform(response_df['response_text'])
 
@@ -126,3 +208,81 @@ def test_text_clusters(db, db_user, test_user_df, vectorizer_model, svd):
     response_df = pd.concat([response_df.user_id, response_df.response_len,
                                 pd.DataFrame(svdMatrix)], axis=1)
     return response_df
+
+
+@instrumentation.instrumented
+def train_text_clusters_streaming(db, db_user, train_user_df, no_SVs,
+                                  batch_size=1000, n_features=2**18):
+    '''
+    Out-of-core version of train_text_clusters. The response text is
+    streamed in chunks and fit with a StreamingTextModel (hashed TF-IDF and
+    randomized SVD), so memory stays bounded as the answers table grows.
+    The corpus is read once per pass of the model.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    train_user_df: DataFrame containing user_id, pre_churn_date and churn_date
+    no_SVs: int containing the number of singular values to retain.
+    batch_size: int containing the number of users per chunk
+    n_features: int containing the number of hashed features
+
+    Returns
+    -------
+    answer_df: pandas DataFrame
+    model: fitted StreamingTextModel
+
+    Example
+    -------
+    >>> training_text_matrix, model = text_processing.train_text_clusters_streaming(
+    ...     db, db_user, X_train, 15)
+    '''
+    meta = []
+
+    def chunks():
+        del meta[:]
+        for chunk in iter_response_text(db, db_user, train_user_df, batch_size):
+            meta.append(chunk[['user_id', 'response_len']])
+            yield chunk.response_text.tolist()
+
+    model = text_model.StreamingTextModel(n_components=no_SVs,
+                                          n_features=n_features)
+    svdMatrix = model.fit_transform(chunks)
+    response_df = data_collection.collect_chunks(meta, ['user_id', 'response_len'])
+    response_df = pd.concat([response_df.user_id, response_df.response_len,
+                             pd.DataFrame(svdMatrix)], axis=1)
+    return response_df, model
+
+
+@instrumentation.instrumented
+def test_text_clusters_streaming(db, db_user, test_user_df, model,
+                                 batch_size=1000):
+    '''
+    Transform text data from test users chunk by chunk with a model built by
+    train_text_clusters_streaming.
+
+    Parameters
+    ----------
+    db: DBSession or string containing name of local postgreSQL data base
+    db_user: string containing the user name for login to database
+    test_user_df: DataFrame containing user_id, pre_churn_date and churn_date
+    model: fitted StreamingTextModel
+    batch_size: int containing the number of users per chunk
+
+    Returns
+    -------
+    response_df: pandas DataFrame
+
+    Example
+    -------
+    >>> testing_text_matrix = text_processing.test_text_clusters_streaming(
+    ...     db, db_user, X_test, model)
+    '''
+    frames = []
+    for chunk in iter_response_text(db, db_user, test_user_df, batch_size):
+        chunk = chunk.reset_index(drop=True)
+        svdMatrix = model.transform(chunk.response_text.tolist())
+        frames.append(pd.concat([chunk.user_id, chunk.response_len,
+                                 pd.DataFrame(svdMatrix)], axis=1))
+    return data_collection.collect_chunks(frames, ['user_id', 'response_len'])
@@ -0,0 +1,340 @@
+import math
+import pickle
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+import data_collection
+import db_session
+import snapshot
+
+
+class GapSketch(object):
+    '''
+    Mergeable quantile sketch of inter-activity gaps. Gaps are counted in
+    logarithmic buckets so that any quantile is returned within a relative
+    error alpha of the true value, using O(log(max gap / min gap) / alpha)
+    memory whatever the number of gaps.
+
+    Parameters
+    ----------
+    alpha: float containing the relative accuracy of the quantiles
+    '''
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, gaps):
+        '''Add an array of gaps in nanoseconds to the sketch.'''
+        gaps = np.asarray(gaps, dtype=np.float64)
+        positive = gaps[gaps > 0]
+        self.zeros += len(gaps) - len(positive)
+        self.count += len(gaps)
+        if len(positive):
+            keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma),
+                                     return_counts=True)
+            for key, count in zip(keys.astype(int), counts):
+                self.buckets[key] = self.buckets.get(key, 0) + int(count)
+
+    def merge(self, other):
+        '''Add the gaps counted by another sketch with the same alpha.'''
+        self.zeros += other.zeros
+        self.count += other.count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def _value_at(self, rank):
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def median(self):
+        '''
+        Median gap in nanoseconds. For an even count the two middle gaps are
+        averaged as pandas does, so the result is within a relative error
+        alpha of the exact median.
+        '''
+        if self.count == 0:
+            return float('nan')
+        low = self._value_at((self.count - 1) // 2)
+        high = self._value_at(self.count // 2)
+        return (low + high) / 2
+
+
+class UserState(object):
+    '''Running activity statistics of one user.'''
+
+    def __init__(self, exact, alpha):
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.gap_min = None
+        self.gap_max = None
+        self.gap_sum = 0
+        if exact:
+            self.gaps = []
+            self.sketch = None
+        else:
+            self.gaps = None
+            self.sketch = GapSketch(alpha)
+
+    def placement(self, times):
+        '''
+        Where sorted activity times go relative to the stored activity:
+        'after' the last activity, 'before' the first one, or None when they
+        fall inside the stored range, where the gaps they split are no
+        longer known.
+        '''
+        if self.first is None or times[0] >= self.last:
+            return 'after'
+        if times[-1] <= self.first:
+            return 'before'
+        return None
+
+    def add(self, times):
+        '''Add sorted activity times that are before or after the stored ones.'''
+        place = self.placement(times)
+        if place is None:
+            raise ValueError('activity inside the stored range of the user')
+        if self.first is None:
+            gaps = np.diff(times)
+            self.first = int(times[0])
+            self.last = int(times[-1])
+        elif place == 'after':
+            gaps = np.diff(np.r_[self.last, times])
+            self.last = int(times[-1])
+        else:
+            gaps = np.diff(np.r_[times, self.first])
+            self.first = int(times[0])
+        self.count += len(times)
+        if len(gaps) == 0:
+            return
+        low, high = int(gaps.min()), int(gaps.max())
+        self.gap_min = low if self.gap_min is None else min(self.gap_min, low)
+        self.gap_max = high if self.gap_max is None else max(self.gap_max, high)
+        self.gap_sum += int(gaps.sum())
+        if self.gaps is not None:
+            self.gaps.append(gaps)
+        else:
+            self.sketch.add(gaps)
+
+    def median_gap(self):
+        if self.gaps is not None:
+            return np.median(np.concatenate(self.gaps))
+        return self.sketch.median()
+
+
+class UserStatsStore(object):
+    '''
+    Incrementally maintained version of the user_stats table. Each user keeps
+    the first and last activity time, the activity count, the min, max and
+    sum of the gaps between activities and either all gaps (exact=True) or a
+    GapSketch of them for the median, so new activity costs O(new events)
+    instead of a full recompute.
+
+    Built from scratch with exact=True, to_frame reproduces
+    data_collection.user_stats_df exactly. With exact=False every column is
+    exact except median_away, which is within a relative error alpha.
+
+    Parameters
+    ----------
+    exact: bool, if True keep every gap to compute exact medians
+    alpha: float containing the relative accuracy of the streamed median
+
+    Example
+    -------
+    >>> store = user_stats_store.UserStatsStore()
+    >>> store.refresh(db, db_user)
+    >>> store.write_user_stats(db, db_user)
+    >>> user_stats = data_collection.import_user_stats(db, db_user)
+    '''
+
+    def __init__(self, exact=False, alpha=0.01):
+        self.exact = exact
+        self.alpha = alpha
+        self.users = {}
+        self.watermark = None
+        self.changed = set()
+
+    def update(self, activity):
+        '''
+        Add new activity to the store. Each user's new activity must be
+        entirely after or entirely before the activity already stored for
+        that user: activity inside a user's stored range would split a gap
+        the store no longer has, so it raises ValueError and nothing is
+        added.
+
+        Parameters
+        ----------
+        activity: DataFrame with user_id and date columns
+
+        Returns
+        -------
+        int containing the number of users updated
+        '''
+        activity = activity[activity.user_id > 0]
+        if len(activity) == 0:
+            return 0
+        users = activity.user_id.values.astype(np.int64)
+        times = pd.to_datetime(activity.date).values.astype('datetime64[ns]').astype(np.int64)
+        order = np.lexsort((times, users))
+        users = users[order]
+        times = times[order]
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+        ends = np.r_[starts[1:], len(users)]
+        inside = [int(users[start]) for start, end in zip(starts, ends)
+                  if int(users[start]) in self.users
+                  and self.users[int(users[start])].placement(times[start:end]) is None]
+        if inside:
+            raise ValueError('activity of {} users (e.g. user_id {}) falls inside '
+                             'their stored activity; rebuild the store'.format(
+                                 len(inside), inside[0]))
+        for start, end in zip(starts, ends):
+            user_id = int(users[start])
+            state = self.users.get(user_id)
+            if state is None:
+                state = self.users[user_id] = UserState(self.exact, self.alpha)
+            state.add(times[start:end])
+            self.changed.add(user_id)
+        latest = pd.Timestamp(int(times.max()))
+        if self.watermark is None or latest > self.watermark:
+            self.watermark = latest
+        return len(starts)
+
+    def merge(self, other):
+        '''
+        Merge a store built over a disjoint set of users, e.g. another shard
+        of the user_id range.
+        '''
+        overlap = set(self.users) & set(other.users)
+        if overlap:
+            raise ValueError('stores share {} users'.format(len(overlap)))
+        self.users.update(other.users)
+        self.changed |= other.changed
+        if other.watermark is not None and (self.watermark is None
+                                            or other.watermark > self.watermark):
+            self.watermark = other.watermark
+
+    def refresh(self, db, db_user, table='activity'):
+        '''
+        Pull activity newer than the store's watermark from the database (or
+        Snapshot) and add it to the store. Rows inserted since the last
+        refresh with a date at or before the watermark cannot be pulled this
+        way; they are detected by counting the activity up to the watermark
+        and raise ValueError, as the store must then be rebuilt.
+
+        Returns
+        -------
+        int containing the number of users updated
+        '''
+        stored = sum(state.count for state in self.users.values())
+        if self.watermark is None or isinstance(db, snapshot.Snapshot):
+            activity = data_collection.load_activity(db, db_user, table)
+            activity = activity[activity.user_id > 0]
+            if self.watermark is not None:
+                before = int((activity.date <= self.watermark).sum())
+                activity = activity[activity.date > self.watermark]
+        else:
+            session = db_session.get_session(db, db_user)
+            watermark = self.watermark.to_pydatetime()
+            sql = '''
+            SELECT count(*)
+            FROM {}
+            WHERE user_id > 0
+            AND date <= %s
+            ;
+            '''.format(table)
+            before = session.query(sql, (watermark,))[0][0]
+            sql = '''
+            SELECT user_id, date
+            FROM {}
+            WHERE user_id > 0
+            AND date > %s
+            ;
+            '''.format(table)
+            activity = pd.DataFrame(session.query(sql, (watermark,)),
+                                    columns=['user_id', 'date'])
+        if self.watermark is not None and before != stored:
+            raise ValueError('{} rows at or before the watermark {} are not in '
+                             'the store; rebuild the store'.format(
+                                 before - stored, self.watermark))
+        return self.update(activity)
+
+    def to_frame(self, user_ids=None):
+        '''
+        Build the user_stats DataFrame, with the columns and values of
+        data_collection.user_stats_df, ordered by user_id.
+        '''
+        rows = []
+        for user_id in sorted(self.users if user_ids is None else user_ids):
+            state = self.users[user_id]
+            # Addresses users that only have one activity.
+            if state.count == 1:
+                zero = pd.tslib.Timedelta(0)
+                rows.append([user_id, zero, zero, zero, 1, zero, zero, zero, zero])
+                continue
+            n_gaps = state.count - 1
+            rows.append([user_id, pd.tslib.Timestamp(state.first),
+                         pd.tslib.Timestamp(state.last),
+                         pd.tslib.Timedelta(state.last - state.first),
+                         state.count,
+                         pd.tslib.Timedelta(state.gap_min),
+                         pd.tslib.Timedelta(state.gap_max),
+                         pd.tslib.Timedelta(state.gap_sum)/n_gaps,
+                         pd.tslib.Timedelta(state.median_gap())])
+        return pd.DataFrame(rows, columns=['app_user', 'first_use', 'last_use',
+                                           'time_with_app', 'num_uses',
+                                           'min_away', 'max_away', 'avg_away',
+                                           'median_away'], dtype=object)
+
+    def write_user_stats(self, db, db_user):
+        '''
+        Write the users changed since the last write into the user_stats
+        table read by data_collection.import_user_stats and
+        feature_building.feature_maker. Away times are stored as nanoseconds.
+
+        Returns
+        -------
+        int containing the number of rows written
+        '''
+        if not self.changed:
+            return 0
+        stats = self.to_frame(self.changed)
+        rows = []
+        for row in stats.itertuples(index=False):
+            single = row.num_uses == 1
+            rows.append((int(row.app_user),
+                         None if single else row.first_use.to_pydatetime(),
+                         None if single else row.last_use.to_pydatetime(),
+                         int(row.time_with_app.value), int(row.num_uses),
+                         int(row.min_away.value), int(row.max_away.value),
+                         int(row.avg_away.value), int(row.median_away.value)))
+        session = db_session.get_session(db, db_user)
+        with session.cursor() as cur:
+            cur.execute('DELETE FROM user_stats WHERE app_user = ANY(%s)',
+                        ([r[0] for r in rows],))
+            execute_values(cur, '''INSERT INTO user_stats (app_user, first_use,
+            last_use, time_with_app, num_uses, min_away, max_away, avg_away,
+            median_away) VALUES %s''', rows)
+        self.changed = set()
+        return len(rows)
+
+    def save(self, path):
+        '''Pickle the store to a file.'''
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        '''Load a store pickled with save.'''
+        with open(path, 'rb') as f:
+            return pickle.load(f)